@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+### Define the accounts of the multi-account mode. ###
+# A single process serves several GRDF accounts listed in a json file. Each account runs
+# with its own copy of the parameters : GRDF login, database, Mqtt topic and Home Assistant
+# device name, so the data of the accounts stay isolated from each other.
+
+import os
+import re
+import copy
+import json
+import logging
+
+# Constants
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$") # the name is used in paths, topics and thread names
+ACCOUNT_KEYS = { # key of the accounts file : parameter
+    "grdf_username": "grdfUsername",
+    "grdf_password": "grdfPassword",
+    "grdf_startdate": "grdfStartDate",
+    "mqtt_topic": "mqttTopic",
+    "hass_device_name": "hassDeviceName",
+    "db_path": "dbPath",
+    "price_path": "pricePath",
+    "influxdb_bucket": "influxBucket",
+    "export_path": "exportPath",
+}
+
+
+# Class Account
+class Account:
+
+    # Constructor : the parameters of the account are the common ones, overwritten by the account keys
+    def __init__(self,accountJson,myParams):
+
+        self.name = accountJson.get("name")
+        if not self.name or not NAME_PATTERN.match(self.name):
+            raise ValueError(f"Account name {self.name!r} must be made of letters, digits, - and _.")
+        unknownKeys = set(accountJson) - set(ACCOUNT_KEYS) - {"name"}
+        if unknownKeys:
+            raise ValueError(f"Account {self.name} : unknown key(s) {', '.join(sorted(unknownKeys))}.")
+        if not accountJson.get("grdf_username") or not accountJson.get("grdf_password"):
+            raise ValueError(f"Account {self.name} : grdf_username and grdf_password are mandatory.")
+
+        self.params = copy.copy(myParams)
+        self.params.accountName = self.name
+        self.params.dbPath = os.path.join(myParams.dbPath, self.name)
+        self.params.mqttTopic = myParams.mqttTopic + "/" + self.name
+        self.params.hassDeviceName = myParams.hassDeviceName + " " + self.name
+        if myParams.exportPath:
+            self.params.exportPath = os.path.join(myParams.exportPath, self.name)
+        for key, attribute in ACCOUNT_KEYS.items():
+            if key in accountJson:
+                setattr(self.params, attribute, accountJson[key])
+
+
+# Return the accounts of a json file, raise ValueError when the file is not valid
+def loadAccounts(path,myParams):
+
+    logging.debug("Loading accounts from file %s...",path)
+    with open(path) as file:
+        accountJsonList = json.load(file)
+    if not isinstance(accountJsonList, list) or not accountJsonList:
+        raise ValueError(f"Accounts file {path} must hold a non-empty list of accounts.")
+    accountList = [Account(accountJson,myParams) for accountJson in accountJsonList]
+
+    # Accounts must not share their data
+    for key, attribute in (("name", "accountName"), ("db_path", "dbPath"), ("mqtt_topic", "mqttTopic"), ("hass_device_name", "hassDeviceName"), ("export_path", "exportPath")):
+        valueList = [getattr(myAccount.params, attribute) for myAccount in accountList]
+        duplicateList = sorted(set(value for value in valueList if value is not None and valueList.count(value) > 1))
+        if duplicateList:
+            raise ValueError(f"Accounts must have distinct {key} : {', '.join(duplicateList)} used several times.")
+
+    # Each account has its own database directory
+    for myAccount in accountList:
+        os.makedirs(myAccount.params.dbPath, exist_ok=True)
+
+    return accountList
+
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+### Define the anomaly detector of the daily consumption. ###
+# Each new day of informative measures is compared to the usual consumption of its weekday : rolling
+# statistics (exponentially weighted mean and variance) are kept by PCE and weekday in the database,
+# and the expected energy is adjusted to the heating degree days of the day when GRDF provides its
+# temperature. Only the days received since the last scored day are scored and added to the
+# statistics : the history is read once, on the first run of the detector, and again when days
+# older than the last scored day are stored (gap backfill, correction of GRDF).
+# A day is an anomaly when its score (deviation from the expected energy, in standard deviations)
+# crosses the threshold : a high consumption (leak), no consumption while some is expected (stuck
+# meter), or an index going backwards (index reset).
+
+import math
+import logging
+import datetime
+
+# Constants
+WARMUP_COUNT = 4 # days of a weekday added to the statistics before the days of this weekday are scored
+MIN_DEVIATION = 1.0 # kWh, minimal standard deviation, otherwise a steady consumption makes any change an anomaly
+MIN_HDD_VARIANCE = 1.0 # (°C.d)², below it the degree days do not explain the consumption (summer)
+KIND_HIGH = "high_consumption"
+KIND_STUCK = "stuck_meter"
+KIND_RESET = "index_reset"
+
+
+# Class WeekdayStats : rolling statistics of the daily energy of a weekday
+class WeekdayStats():
+
+    def __init__(self,row=None):
+
+        self.count, self.mean, self.variance, self.hddMean, self.hddVariance, self.covariance = row or (0, 0.0, 0.0, None, None, None)
+
+
+    # Return the energy expected for a day, adjusted to its degree days when known
+    def getExpected(self,hdd):
+
+        if hdd is None or self.hddMean is None or self.hddVariance < MIN_HDD_VARIANCE:
+            return self.mean
+        # More degree days never lower the expected energy
+        return max(self.mean + max(self.covariance / self.hddVariance, 0) * (hdd - self.hddMean), 0)
+
+
+    # Return the standard deviation of the energy around the expected energy
+    def getDeviation(self):
+        return max(math.sqrt(self.variance), MIN_DEVIATION)
+
+
+    # Add a day to the statistics, the first days weigh as in a plain average
+    def update(self,alpha,energy,hdd,expected):
+
+        weight = max(alpha, 1 / (self.count + 1))
+        delta = energy - self.mean
+        if self.count:
+            self.variance = (1 - weight) * self.variance + weight * (energy - expected) ** 2
+        self.mean += weight * delta
+        if hdd is not None:
+            if self.hddMean is None:
+                self.hddMean, self.hddVariance, self.covariance = hdd, 0.0, 0.0
+            else:
+                hddDelta = hdd - self.hddMean
+                self.hddMean += weight * hddDelta
+                self.hddVariance = (1 - weight) * (self.hddVariance + weight * hddDelta ** 2)
+                self.covariance = (1 - weight) * (self.covariance + weight * hddDelta * delta)
+        self.count += 1
+
+
+    # Return the statistics as stored in the database
+    def getRow(self):
+        return (self.count, self.mean, self.variance, self.hddMean, self.hddVariance, self.covariance)
+
+
+# Class Detector
+class Detector():
+
+    # Constructor
+    def __init__(self,threshold,alpha,hddBase):
+
+        self.threshold = threshold # score from which a day is an anomaly
+        self.alpha = alpha # weight of a new day in the statistics
+        self.hddBase = hddBase # °C, base temperature of the heating degree days
+
+
+    # Score the days of a PCE received since its last scored day, and return their scores
+    # as (date, energy, expected energy, score, kind of anomaly) tuples
+    # fromDate is the first day stored by the run : when it is already scored, the statistics are
+    # rebuilt from the first day and the scores from fromDate are returned
+    def run(self,db,pceId,fromDate=None):
+
+        lastScore = db.getLastAnomalyScore(pceId)[0]
+        lastDate = lastScore[0] if lastScore is not None else None
+        statList = {weekday: WeekdayStats(row) for weekday, row in db.getAnomalyStats(pceId).items()}
+        rescore = fromDate is not None and lastDate is not None and fromDate <= lastDate.date()
+        if rescore:
+            logging.debug("Anomaly detector : days stored from %s for PCE %s, statistics rebuilt", fromDate, pceId)
+            lastDate = None
+            statList = {}
+
+        scoreList = []
+        previousDay = None
+        for myDate, startIndex, endIndex, energy, temperature in db.getDailyMeasures(pceId, lastDate):
+            # The last scored day is only the reference of the index of the next day
+            if myDate != lastDate:
+                myStats = statList.setdefault(myDate.weekday(), WeekdayStats())
+                scoreList.append(self._score(myStats, myDate, startIndex, endIndex, energy, temperature, previousDay))
+            previousDay = (myDate, endIndex)
+
+        if scoreList:
+            db.setAnomalyStats(pceId, {weekday: myStats.getRow() for weekday, myStats in statList.items()}, scoreList)
+            logging.debug("Anomaly detector : %s day(s) scored for PCE %s from %s", len(scoreList), pceId, scoreList[0][0])
+        if rescore:
+            scoreList = [myScore for myScore in scoreList if myScore[0].date() >= fromDate]
+        return scoreList
+
+
+    # Score a day and add it to the statistics of its weekday
+    def _score(self,myStats,myDate,startIndex,endIndex,energy,temperature,previousDay):
+
+        hdd = max(self.hddBase - temperature, 0) if temperature is not None else None
+        expected = myStats.getExpected(hdd)
+        deviation = myStats.getDeviation()
+        score = None
+        if myStats.count >= WARMUP_COUNT:
+            score = round((energy - expected) / deviation, 2)
+
+        # An index going backwards makes the energy of the day meaningless, it is left out of the statistics
+        if endIndex < startIndex or (previousDay is not None and previousDay[0] == myDate - datetime.timedelta(days=1)
+                                     and startIndex < previousDay[1]):
+            return (myDate, energy, round(expected, 1), score, KIND_RESET)
+
+        kind = None
+        if score is not None:
+            if score >= self.threshold:
+                kind = KIND_HIGH
+            elif score <= -self.threshold and energy == 0:
+                kind = KIND_STUCK
+            # An anomaly is added clipped to the threshold, so a leak does not become the usual consumption at once
+            myStats.update(self.alpha, min(max(energy, expected - self.threshold * deviation), expected + self.threshold * deviation), hdd, expected)
+        else:
+            myStats.update(self.alpha, energy, hdd, expected)
+        return (myDate, energy, round(expected, 1), score, kind)
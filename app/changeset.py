@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+### Define the change set of a run. ###
+# The store step records the rows really inserted or changed in the database.
+# Downstream steps (calculation, prices, sinks) skip or limit their work to the
+# PCEs which changed, so a run bringing no new data ends quickly.
+
+import logging
+
+
+# Class ChangeSet
+class ChangeSet:
+
+    # Constructor, a full change set considers that everything has changed
+    def __init__(self,full=False):
+
+        self.full = full
+        self.pceList = set() # pce whose informations changed
+        self.measureList = set() # (pce, type, date) of the measures inserted or changed
+        self.thresholdList = set() # (pce, date) of the thresholds inserted or changed
+        self.pricesChanged = False # prices file or default prices changed
+        self.dayChanged = False # calculated measures are relative to the current day
+
+
+    # Record a PCE whose informations changed
+    def addPce(self,pceId):
+        self.pceList.add(pceId)
+
+
+    # Record a measure inserted or changed
+    def addMeasure(self,pceId,type,date):
+        self.measureList.add((pceId, type, date))
+
+
+    # Record a threshold inserted or changed
+    def addThreshold(self,pceId,date):
+        self.thresholdList.add((pceId, date))
+
+
+    # Return the number of measures inserted or changed, for a PCE when given
+    def countMeasures(self,pceId=None):
+        return sum(1 for myPceId, type, date in self.measureList if pceId is None or myPceId == pceId)
+
+
+    # Return the first date of the measures of a type inserted or changed for a PCE, None when there is none
+    def getFirstMeasureDate(self,pceId,type):
+        return min((date for myPceId, myType, date in self.measureList if myPceId == pceId and myType == type), default=None)
+
+
+    # Return True when the stored data of a PCE (or of any PCE) changed : informations, measures, thresholds or prices
+    def hasDataChanged(self,pceId=None):
+
+        if self.full or self.pricesChanged:
+            return True
+        if pceId is None:
+            return bool(self.pceList or self.measureList or self.thresholdList)
+        return pceId in self.pceList \
+            or any(myPceId == pceId for myPceId, type, date in self.measureList) \
+            or any(myPceId == pceId for myPceId, date in self.thresholdList)
+
+
+    # Return True when the values calculated for a PCE (or for any PCE) must be refreshed
+    def hasChanged(self,pceId=None):
+        return self.dayChanged or self.hasDataChanged(pceId)
+
+
+    # Return True when nothing changed
+    def isEmpty(self):
+        return not self.hasChanged()
+
+
+    # Write the change set into the log
+    def logSummary(self):
+
+        if self.full:
+            logging.info("Change set : full, all the data is processed.")
+        else:
+            logging.info("Change set : %s PCE(s), %s measure(s), %s threshold(s) inserted or changed, prices changed = %s, day changed = %s.",
+                         len(self.pceList), len(self.measureList), len(self.thresholdList), self.pricesChanged, self.dayChanged)
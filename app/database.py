@@ -4,6 +4,8 @@ import os
 import logging
 import datetime
 import json
+import threading
+import uuid
 from gazpar import TYPE_I,TYPE_P
 
 # Constants
@@ -11,16 +13,27 @@ DATABASE_NAME = "gazpar2mqtt.db"
 DATABASE_TIMEOUT = 10
 DATABASE_DATE_FORMAT = "%Y-%m-%d"
 DATABASE_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+RUNS_HISTORY = 1000 # number of run summaries kept
+ARRIVALS_HISTORY = 1000 # number of measure arrivals kept by PCE and type
 
 # Config constants
 G2M_KEY = "g2m"
 DB_KEY = "db"
 INFLUX_KEY = "influx"
 LAST_EXEC_KEY = "last_exec_datetime"
-
-# Convert datetime string to datetime
+HASS_DISCOVERY_KEY = "hass_discovery_hash"
+HASS_DISCOVERY_DATE_KEY = "hass_discovery_date" # last publication of all the discovery configs
+INFLUX_WATERMARK_KEY = "influx_watermark"
+RUN_STATUS_KEY = "last_run_status"
+LAST_RUN_KEY = "last_run_datetime" # start of the last run, the new measures found by a run arrived after it
+CALCULATION_DATE_KEY = "calculation_date"
+PRICES_SIGNATURE_KEY = "prices_signature"
+DATA_TOKEN_KEY = "data_token" # identifies the data of the database, it changes on each reinitialization
+
+# Convert datetime string to datetime, values already converted (binary snapshot) are kept
 def _convertDate(dateString):
     if dateString == None: return None
+    elif isinstance(dateString, datetime.datetime): return dateString
     else:
         myDateTime = datetime.datetime.strptime(dateString,DATABASE_DATE_FORMAT)
         return myDateTime
@@ -28,6 +41,8 @@ def _convertDate(dateString):
 def _convertDateTime(dateString):
   if dateString == None:
     return None
+  elif isinstance(dateString, datetime.datetime):
+    return dateString
   else:
     myDateTime = datetime.datetime.strptime(dateString, DATABASE_DATETIME_FORMAT)
     return myDateTime
@@ -36,7 +51,7 @@ def _convertDateTime(dateString):
 class Database:
   
   # Constructor
-  def __init__(self,path):
+  def __init__(self,path,dataVersions=False):
   
     self.con = None
     self.cur = None
@@ -46,6 +61,7 @@ class Database:
     self.influxVersion = None
     self.path = path
     self.pceList = []
+    self.dataVersions = dataVersions # versions of the data of each PCE are kept, for the snapshot file
   
   # Database initialization
   def init(self,g2mVersion,dbVersion,influxVersion):
@@ -86,7 +102,8 @@ class Database:
                         , energy INTEGER NOT NULL
                         , energyGrossConsumed REAL NOT NULL
                         , price REAL NOT NULL
-                        , conversion REAL)''')
+                        , conversion REAL
+                        , temperature REAL)''')
     self.cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_measures_measure
                     ON measures (pce,type,date)''')
 
@@ -100,6 +117,9 @@ class Database:
     self.cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_tresholds_threshold
                     ON thresholds (pce,date)''')
 
+    # Create tables which do not require a reinitialization
+    self.upgrade()
+
     # Commit
     self.commit()
 
@@ -113,6 +133,108 @@ class Database:
     # Commit
     self.commit()
 
+  # Create the tables added without change of database version (existing data is kept)
+  def upgrade(self):
+
+    # Create table for mqtt outbox
+    logging.debug("Creation of outbox table")
+    self.cur.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT
+                        , topic TEXT NOT NULL
+                        , payload TEXT
+                        , qos INTEGER NOT NULL
+                        , retain INTEGER NOT NULL
+                        , created TEXT NOT NULL)''')
+    self.cur.execute('''CREATE INDEX IF NOT EXISTS idx_outbox_topic
+                    ON outbox (topic)''')
+
+    # Create table for the summary of the runs
+    logging.debug("Creation of runs table")
+    self.cur.execute('''CREATE TABLE IF NOT EXISTS runs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT
+                        , start TEXT NOT NULL
+                        , duration REAL
+                        , status TEXT NOT NULL
+                        , summary TEXT NOT NULL)''')
+
+    # Create table for the arrival time of the measures
+    logging.debug("Creation of arrivals table")
+    self.cur.execute('''CREATE TABLE IF NOT EXISTS arrivals (
+                        pce TEXT NOT NULL
+                        , type TEXT NOT NULL
+                        , date TEXT NOT NULL
+                        , arrival TEXT NOT NULL)''')
+    self.cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_arrivals_arrival
+                    ON arrivals (pce,type,date)''')
+
+    # Add the temperature of the day to the measures of databases created before it
+    # A database of an older layout is left to the reinitialization done by the version check
+    hasMeasures = self.existsTable("measures")
+    self.cur.execute("SELECT count(*) FROM pragma_table_info('measures') WHERE name = 'temperature'")
+    if hasMeasures and not self.cur.fetchone()[0]:
+      logging.debug("Add temperature column to measures table")
+      self.cur.execute('''ALTER TABLE measures ADD COLUMN temperature REAL''')
+
+    # Create table for the gaps in the measures, with the backfill attempts made for each of them
+    logging.debug("Creation of gaps table")
+    self.cur.execute('''CREATE TABLE IF NOT EXISTS gaps (
+                        pce TEXT NOT NULL
+                        , type TEXT NOT NULL
+                        , start TEXT NOT NULL
+                        , end TEXT NOT NULL
+                        , attempts INTEGER NOT NULL
+                        , last_attempt TEXT NOT NULL
+                        , PRIMARY KEY (pce, type, start))''')
+
+    # Create tables for the anomaly detector : rolling statistics of the daily energy by weekday,
+    # and score of each day already scored (kind is null when the day is normal)
+    logging.debug("Creation of anomaly tables")
+    self.cur.execute('''CREATE TABLE IF NOT EXISTS anomaly_stats (
+                        pce TEXT NOT NULL
+                        , weekday INTEGER NOT NULL
+                        , count INTEGER NOT NULL
+                        , mean REAL NOT NULL
+                        , variance REAL NOT NULL
+                        , hdd_mean REAL
+                        , hdd_variance REAL
+                        , covariance REAL
+                        , PRIMARY KEY (pce, weekday))''')
+    self.cur.execute('''CREATE TABLE IF NOT EXISTS anomaly_scores (
+                        pce TEXT NOT NULL
+                        , date TEXT NOT NULL
+                        , energy REAL NOT NULL
+                        , expected REAL
+                        , score REAL
+                        , kind TEXT
+                        , PRIMARY KEY (pce, date))''')
+
+    # Create table for the version of the data of each PCE, increased by triggers on each change
+    # Readers of the binary snapshot compare it to know which PCEs must be loaded again
+    logging.debug("Creation of data versions table")
+    self.cur.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+                        pce TEXT PRIMARY KEY
+                        , version INTEGER NOT NULL)''')
+    # Tables of an older layout are missing until the version check reinitializes the database
+    for table in ("pces", "measures", "thresholds"):
+      if not self.existsTable(table):
+        continue
+      for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        if self.dataVersions:
+          self.cur.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()} AFTER {event} ON {table}
+                          BEGIN
+                            INSERT INTO data_versions (pce, version) VALUES ({row}.pce, 1)
+                            ON CONFLICT (pce) DO UPDATE SET version = version + 1;
+                          END''')
+        else:
+          self.cur.execute(f'''DROP TRIGGER IF EXISTS trg_{table}_{event.lower()}''')
+    if not self.dataVersions:
+      # Changes are not versioned anymore : the token is dropped, so that a snapshot file written before
+      # is never trusted again, and a new token is created when the versions are kept again
+      self.cur.execute("DELETE FROM data_versions")
+      self.cur.execute("DELETE FROM config WHERE key = ?", [DATA_TOKEN_KEY])
+    elif self.getConfig(DATA_TOKEN_KEY) is None:
+      self.updateVersion(DATA_TOKEN_KEY, uuid.uuid4().hex)
+
   # Check that table exists
   def existsTable(self,name):
 
@@ -159,6 +281,150 @@ class Database:
       return queryResult
 
 
+  # Get the last influxdb export of a PCE and a type
+  def getInfluxWatermark(self, pceId, type):
+
+    watermark = self.getConfig(f"{INFLUX_WATERMARK_KEY}_{pceId}_{type}")
+    if watermark is not None:
+      return json.loads(watermark)
+    else:
+      return None
+
+
+  # Update the last influxdb export of a PCE and a type
+  def setInfluxWatermark(self, pceId, type, watermark):
+
+    if watermark is not None:
+      self.updateVersion(f"{INFLUX_WATERMARK_KEY}_{pceId}_{type}", json.dumps(watermark))
+
+
+  # Store the summary of a run, only the last runs are kept
+  def addRun(self, start, duration, status, summary):
+
+    self.cur.execute("INSERT INTO runs (start, duration, status, summary) VALUES (?, ?, ?, ?)",
+                     [start, duration, status, json.dumps(summary)])
+    self.cur.execute("DELETE FROM runs WHERE id <= (SELECT max(id) FROM runs) - ?", [RUNS_HISTORY])
+
+
+  # Get the version of the data of each PCE
+  def getDataVersions(self):
+
+    self.cur.execute("SELECT pce, version FROM data_versions")
+    return dict(self.cur.fetchall())
+
+
+  # Get the date of the last measure of a PCE and a type
+  def getLastMeasureDate(self, pceId, type):
+
+    self.cur.execute("SELECT max(date) FROM measures WHERE pce = ? AND type = ?", [pceId, type])
+    queryResult = self.cur.fetchone()
+    if queryResult is not None and queryResult[0] is not None:
+      return _convertDate(queryResult[0])
+    else:
+      return None
+
+
+  # Get the gaps in the measures of a PCE and a type, after a date, as (start date, end date, day count) tuples
+  # Measures failing the quality checks are never stored, so they are gaps too
+  def getGapList(self, pceId, type, minDate):
+
+    if type == TYPE_I:
+      # Daily measures : days of the calendar between the first and the last measure without a measure,
+      # consecutive days are grouped in a single gap (a day minus its rank is constant along a gap)
+      query = """WITH RECURSIVE bounds AS (
+                   SELECT max(min(date), ?) AS first, max(date) AS last FROM measures WHERE pce = ? AND type = ?)
+                 , calendar (date, last) AS (
+                   SELECT first, last FROM bounds WHERE first IS NOT NULL
+                   UNION ALL
+                   SELECT date(date, '+1 day'), last FROM calendar WHERE date < last)
+                 , missing AS (
+                   SELECT calendar.date, julianday(calendar.date) - row_number() OVER (ORDER BY calendar.date) AS gap
+                   FROM calendar LEFT JOIN measures ON measures.pce = ? AND measures.type = ? AND measures.date = calendar.date
+                   WHERE measures.date IS NULL)
+                 SELECT min(date), max(date), count(*) FROM missing GROUP BY gap ORDER BY 1"""
+      self.cur.execute(query, [minDate.strftime(DATABASE_DATE_FORMAT), pceId, type, pceId, type])
+    else:
+      # Published measures cover periods of variable length : a gap lies between the end of a period
+      # and the start of the next one
+      query = """SELECT date(previousEnd), date(periodStart, '-1 day'), julianday(date(periodStart)) - julianday(date(previousEnd))
+                 FROM (SELECT periodStart, lag(periodEnd) OVER (ORDER BY periodStart) AS previousEnd
+                       FROM measures WHERE pce = ? AND type = ?)
+                 WHERE previousEnd < periodStart AND previousEnd >= ? ORDER BY 1"""
+      self.cur.execute(query, [pceId, type, minDate.strftime(DATABASE_DATE_FORMAT)])
+    return [(_convertDate(startDate), _convertDate(endDate), int(dayCount)) for startDate, endDate, dayCount in self.cur.fetchall()]
+
+
+  # Get the backfill attempts made for the gaps of a PCE and a type, by start date of the gap
+  def getGapAttempts(self, pceId, type):
+
+    self.cur.execute("SELECT start, attempts FROM gaps WHERE pce = ? AND type = ?", [pceId, type])
+    return {_convertDate(startDate): attempts for startDate, attempts in self.cur.fetchall()}
+
+
+  # Store the backfill attempts of the gaps of a PCE and a type, the gaps which are filled are forgotten
+  def setGapAttempts(self, pceId, type, gapList, attemptList):
+
+    self.cur.execute("DELETE FROM gaps WHERE pce = ? AND type = ?", [pceId, type])
+    now = datetime.datetime.now().strftime(DATABASE_DATETIME_FORMAT)
+    self.cur.executemany("INSERT INTO gaps (pce, type, start, end, attempts, last_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(pceId, type, startDate.strftime(DATABASE_DATE_FORMAT), endDate.strftime(DATABASE_DATE_FORMAT), attemptList.get(startDate, 0), now)
+                          for startDate, endDate, dayCount in gapList])
+
+
+  # Get the rolling statistics of the anomaly detector for a PCE, as rows by weekday
+  def getAnomalyStats(self, pceId):
+
+    self.cur.execute("SELECT weekday, count, mean, variance, hdd_mean, hdd_variance, covariance FROM anomaly_stats WHERE pce = ?", [pceId])
+    return {row[0]: row[1:] for row in self.cur.fetchall()}
+
+
+  # Store the rolling statistics and the new scores of the anomaly detector for a PCE
+  def setAnomalyStats(self, pceId, statList, scoreList):
+
+    self.cur.executemany("INSERT OR REPLACE INTO anomaly_stats (pce, weekday, count, mean, variance, hdd_mean, hdd_variance, covariance) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(pceId, weekday) + tuple(row) for weekday, row in statList.items()])
+    self.cur.executemany("INSERT OR REPLACE INTO anomaly_scores (pce, date, energy, expected, score, kind) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(pceId, myDate.strftime(DATABASE_DATE_FORMAT), energy, expected, score, kind)
+                          for myDate, energy, expected, score, kind in scoreList])
+
+
+  # Get the last score of the anomaly detector for a PCE, as (date, energy, expected, score, kind), and the date of its last anomaly
+  def getLastAnomalyScore(self, pceId):
+
+    self.cur.execute("SELECT date, energy, expected, score, kind FROM anomaly_scores WHERE pce = ? ORDER BY date DESC LIMIT 1", [pceId])
+    queryResult = self.cur.fetchone()
+    if queryResult is None:
+      return None, None
+    self.cur.execute("SELECT max(date) FROM anomaly_scores WHERE pce = ? AND kind IS NOT NULL", [pceId])
+    return (_convertDate(queryResult[0]),) + queryResult[1:], _convertDate(self.cur.fetchone()[0])
+
+
+  # Get the daily measures of a PCE from a date, as (date, start index, end index, energy, temperature) tuples
+  def getDailyMeasures(self, pceId, minDate):
+
+    self.cur.execute("SELECT date, start_index, end_index, energy, temperature FROM measures WHERE pce = ? AND type = ? AND date >= ? ORDER BY date",
+                     [pceId, TYPE_I, minDate.strftime(DATABASE_DATE_FORMAT) if minDate is not None else ""])
+    return [(_convertDate(row[0]),) + row[1:] for row in self.cur.fetchall()]
+
+
+  # Store the date time at which a new measure has been received, the first arrival is kept
+  # Only the last arrivals of each PCE and type are kept
+  def addArrival(self, pceId, type, date, arrival):
+
+    self.cur.execute("INSERT OR IGNORE INTO arrivals (pce, type, date, arrival) VALUES (?, ?, ?, ?)",
+                     [pceId, type, date.strftime(DATABASE_DATE_FORMAT), arrival.strftime(DATABASE_DATETIME_FORMAT)])
+    self.cur.execute("DELETE FROM arrivals WHERE pce = ? AND type = ? AND date < "
+                     "(SELECT date FROM arrivals WHERE pce = ? AND type = ? ORDER BY date DESC LIMIT 1 OFFSET ?)",
+                     [pceId, type, pceId, type, ARRIVALS_HISTORY])
+
+
+  # Get the last arrivals of the informative measures of a PCE as (measure date, arrival date time) tuples
+  def getArrivalList(self, pceId, limit):
+
+    self.cur.execute("SELECT date, arrival FROM arrivals WHERE pce = ? AND type = ? ORDER BY arrival DESC LIMIT ?", [pceId, TYPE_I, limit])
+    return [(_convertDate(myDate), _convertDateTime(myArrival)) for myDate, myArrival in self.cur.fetchall()]
+
+
   # Connexion to database
   def connect(self,g2mVersion,dbVersion,influxVersion):
     
@@ -177,6 +443,16 @@ class Database:
         logging.debug("Connexion to database")
         self.con = sqlite3.connect(self.path + "/" + DATABASE_NAME, timeout=DATABASE_TIMEOUT)
         self.cur = self.con.cursor()
+        self.upgrade()
+        self.commit()
+
+
+  # Open a connection on an existing database, used by the stages running in their own thread
+  def open(self):
+
+    logging.debug("Connexion to database")
+    self.con = sqlite3.connect(self.path + "/" + DATABASE_NAME, timeout=DATABASE_TIMEOUT)
+    self.cur = self.con.cursor()
 
 
   # Get measures statistics
@@ -214,6 +490,24 @@ class Database:
     self.cur.execute('''DROP TABLE IF EXISTS threshold''') # issue #59 on v0.7.0
     self.cur.execute('''DROP TABLE IF EXISTS thresholds''')
     
+    # The outbox is kept : its messages are still waiting for the broker
+
+    logging.debug("Drop runs table")
+    self.cur.execute('''DROP TABLE IF EXISTS runs''')
+
+    logging.debug("Drop arrivals table")
+    self.cur.execute('''DROP TABLE IF EXISTS arrivals''')
+
+    logging.debug("Drop gaps table")
+    self.cur.execute('''DROP TABLE IF EXISTS gaps''')
+
+    logging.debug("Drop anomaly tables")
+    self.cur.execute('''DROP TABLE IF EXISTS anomaly_stats''')
+    self.cur.execute('''DROP TABLE IF EXISTS anomaly_scores''')
+
+    logging.debug("Drop data versions table")
+    self.cur.execute('''DROP TABLE IF EXISTS data_versions''')
+    
     # Commit work
     self.commit()
     
@@ -236,31 +530,21 @@ class Database:
   def commit(self):
     self.con.commit()
 
-  # Load
+  # Load the PCEs with their measures and thresholds into pceList, loading again replaces them
   def load(self):
+    self.pceList = list(self.iterPce())
 
-    # Load PCEs
-    self._loadPce()
-
-    # Load measures
-    for myPce in self.pceList:
-      self._loadMeasures(myPce)
-
-    # Load thresholds
-    for myPce in self.pceList:
-      self._loadThresholds(myPce)
-
-  # Load PCEs
-  def _loadPce(self):
-
-    query = "SELECT * FROM pces"
-    self.cur.execute(query)
-    queryResult = self.cur.fetchall()
+  # Iterate on the PCEs, with their measures and thresholds when required
+  # Only one PCE is held in memory at a time, for consumers which do not need all of them together
+  def iterPce(self,withMeasures=True):
 
-    # Create object PCE
-    for result in queryResult:
+    self.cur.execute("SELECT * FROM pces")
+    for result in self.cur.fetchall():
       myPce = Pce(result)
-      self.pceList.append(myPce)
+      if withMeasures:
+        self._loadMeasures(myPce)
+        self._loadThresholds(myPce)
+      yield myPce
 
   # Load account info
   def _loadAccount(self):
@@ -272,8 +556,8 @@ class Database:
   # Load measures
   def _loadMeasures(self,pce):
 
-    query = f"SELECT * FROM measures WHERE pce = '{pce.pceId}'"
-    self.cur.execute(query)
+    query = "SELECT * FROM measures WHERE pce = ?"
+    self.cur.execute(query, [pce.pceId])
     queryResult = self.cur.fetchall()
 
     # Create object measure
@@ -284,8 +568,8 @@ class Database:
   # Load thresholds
   def _loadThresholds(self, pce):
 
-    query = f"SELECT * FROM thresholds WHERE pce = '{pce.pceId}'"
-    self.cur.execute(query)
+    query = "SELECT * FROM thresholds WHERE pce = ?"
+    self.cur.execute(query, [pce.pceId])
     queryResult = self.cur.fetchall()
 
     # Create object measure
@@ -294,6 +578,39 @@ class Database:
       pce.thresholdList.append(myThreshold)
 
 
+# Class Snapshot : PCEs, measures and thresholds of the database, loaded once and shared by the sinks of a run
+# The snapshot is read-only : the measures and thresholds of its PCEs are tuples
+class Snapshot():
+
+  def __init__(self,path):
+
+    self.path = path
+    self.lock = threading.Lock() # sinks run concurrently, the first one loads the snapshot
+    self.pceList = None
+
+  # Return the PCEs, loaded from the database on the first call
+  def getPceList(self):
+
+    with self.lock:
+      if self.pceList is None:
+        myDb = Database(self.path)
+        myDb.open()
+        try:
+          self.pceList = tuple(self._load(myDb))
+        finally:
+          myDb.close()
+        for myPce in self.pceList:
+          myPce.measureList = tuple(myPce.measureList)
+          myPce.thresholdList = tuple(myPce.thresholdList)
+        logging.debug("Snapshot of the database loaded : %s PCE(s), %s measure(s)", len(self.pceList),
+                      sum(len(myPce.measureList) for myPce in self.pceList))
+    return self.pceList
+
+  # Load the PCEs with their measures and thresholds
+  def _load(self,myDb):
+    return list(myDb.iterPce())
+
+
 # Class PCE
 class Pce():
 
@@ -327,6 +644,7 @@ class Measure():
     self.energyGross = result[10]
     self.price = result[11]
     self.conversionFactor = result[12]
+    self.temperature = result[13]
 
 # Class Measure
 class Threshold():
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+### Define the columnar export of the measures. ###
+# The daily measures, thresholds and prices of each PCE are written to Parquet or Arrow IPC
+# files, partitioned the Hive way (measures/pce=<id>/year=<yyyy>/part-0.parquet), so analytics
+# jobs read them with pyarrow or DuckDB instead of querying the live database. Arrow IPC files
+# can be memory-mapped and read without copy.
+# Export is incremental : the signature of each partition is kept in a manifest, and only the
+# partitions whose rows changed since the last export are written again.
+# pyarrow is an optional dependency, this module is only imported when the export is enabled.
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+
+import database
+import price
+
+# Constants
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"} # format : file extension
+MANIFEST_NAME = "manifest.json"
+PART_NAME = "part-0"
+
+# Columns of the datasets : name, arrow type, value of a row
+MEASURE_COLUMNS = (
+    ("type", pyarrow.string(), lambda myMeasure: myMeasure.type),
+    ("date", pyarrow.date32(), lambda myMeasure: myMeasure.date.date()),
+    ("period_start", pyarrow.timestamp("s"), lambda myMeasure: myMeasure.periodStart),
+    ("period_end", pyarrow.timestamp("s"), lambda myMeasure: myMeasure.periodEnd),
+    ("start_index", pyarrow.int64(), lambda myMeasure: myMeasure.startIndex),
+    ("end_index", pyarrow.int64(), lambda myMeasure: myMeasure.endIndex),
+    ("volume", pyarrow.int64(), lambda myMeasure: myMeasure.volume),
+    ("volume_gross", pyarrow.float64(), lambda myMeasure: myMeasure.volumeGross),
+    ("energy", pyarrow.int64(), lambda myMeasure: myMeasure.energy),
+    ("energy_gross", pyarrow.float64(), lambda myMeasure: myMeasure.energyGross),
+    ("price", pyarrow.float64(), lambda myMeasure: myMeasure.price),
+    ("conversion_factor", pyarrow.float64(), lambda myMeasure: myMeasure.conversionFactor),
+    ("temperature", pyarrow.float64(), lambda myMeasure: myMeasure.temperature),
+)
+THRESHOLD_COLUMNS = (
+    ("date", pyarrow.date32(), lambda myThreshold: myThreshold.date.date()),
+    ("energy", pyarrow.int64(), lambda myThreshold: myThreshold.energy),
+)
+PRICE_COLUMNS = (
+    ("start_date", pyarrow.date32(), lambda myPrice: myPrice.startDate),
+    ("end_date", pyarrow.date32(), lambda myPrice: myPrice.endDate),
+    ("kwh_price", pyarrow.float64(), lambda myPrice: myPrice.kwhPrice),
+    ("fix_price", pyarrow.float64(), lambda myPrice: myPrice.fixPrice),
+    ("is_default", pyarrow.bool_(), lambda myPrice: myPrice.pceId is None),
+)
+
+
+# Return the rows of objects, as tuples of the values of the columns
+def _getRowList(objectList,columnList):
+    return [tuple(getValue(myObject) for name, type, getValue in columnList) for myObject in objectList]
+
+
+# Return the signature of rows
+def _getSignature(rowList):
+    return hashlib.sha1(repr(rowList).encode('utf-8')).hexdigest()
+
+
+# Return the objects grouped by year of their date
+def _getYearList(objectList):
+
+    yearList = {}
+    for myObject in objectList:
+        yearList.setdefault(myObject.date.year, []).append(myObject)
+    return yearList
+
+
+# Class DefaultPrice : default prices of a PCE without prices in the prices file
+class DefaultPrice():
+
+    def __init__(self,kwhPrice,fixPrice):
+
+        self.pceId = None
+        self.startDate = None
+        self.endDate = None
+        self.kwhPrice = float(kwhPrice)
+        self.fixPrice = float(fixPrice)
+
+
+# Class Exporter
+class Exporter():
+
+    # Constructor
+    def __init__(self,path,format="parquet"):
+
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Export format {format} must be one of {', '.join(EXPORT_FORMATS)}.")
+        self.path = path
+        self.format = format
+        self.manifestPath = os.path.join(path, MANIFEST_NAME)
+        self.manifest = {}
+        self.writeCount = 0
+        self.skipCount = 0
+
+        # Partitions written in another format are removed and written again
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as file:
+                manifest = json.load(file)
+            if manifest.get("format") == format:
+                self.manifest = manifest.get("partitions", {})
+            elif manifest.get("format") in EXPORT_FORMATS:
+                logging.info("Export format changed from %s to %s, all the partitions are written again.", manifest["format"], format)
+                for key in manifest.get("partitions", {}):
+                    filePath = os.path.join(path, *key.split("/"), PART_NAME + EXPORT_FORMATS[manifest["format"]])
+                    if os.path.exists(filePath):
+                        os.remove(filePath)
+
+
+    # Write a partition when its rows changed since the last export
+    def writePartition(self,dataset,partition,columnList,rowList):
+
+        directory = os.path.join(self.path, dataset, *partition)
+        filePath = os.path.join(directory, PART_NAME + EXPORT_FORMATS[self.format])
+        key = "/".join((dataset,) + partition)
+        signature = _getSignature(rowList)
+        if self.manifest.get(key) == signature and os.path.exists(filePath):
+            self.skipCount += 1
+            return
+
+        schema = pyarrow.schema([(name, type) for name, type, getValue in columnList])
+        table = pyarrow.Table.from_arrays([pyarrow.array(values, type=type) for values, (name, type, getValue) in zip(zip(*rowList), columnList)],
+                                          schema=schema)
+
+        # The file is replaced at once, a reader never sees a partial file
+        os.makedirs(directory, exist_ok=True)
+        if self.format == "parquet":
+            pyarrow.parquet.write_table(table, filePath + ".tmp")
+        else:
+            with pyarrow.OSFile(filePath + ".tmp", "wb") as sink, pyarrow.ipc.new_file(sink, schema) as writer:
+                writer.write_table(table)
+        os.replace(filePath + ".tmp", filePath)
+        self.manifest[key] = signature
+        self.writeCount += 1
+
+
+    # Write the measures, thresholds and prices of a PCE
+    def writePce(self,myPce,myPrices):
+
+        pcePartition = (f"pce={myPce.pceId}",)
+        for year, measureList in sorted(_getYearList(myPce.measureList).items()):
+            self.writePartition("measures", pcePartition + (f"year={year}",), MEASURE_COLUMNS, _getRowList(measureList, MEASURE_COLUMNS))
+        for year, thresholdList in sorted(_getYearList(myPce.thresholdList).items()):
+            self.writePartition("thresholds", pcePartition + (f"year={year}",), THRESHOLD_COLUMNS, _getRowList(thresholdList, THRESHOLD_COLUMNS))
+
+        priceList = myPrices.getPricesByPce(myPce.pceId)
+        if not priceList:
+            priceList = [DefaultPrice(myPrices.defaultKwhPrice, myPrices.defaultFixPrice)]
+        self.writePartition("prices", pcePartition, PRICE_COLUMNS, _getRowList(priceList, PRICE_COLUMNS))
+
+
+    # Store the manifest, once the partitions are written
+    def save(self):
+
+        with open(self.manifestPath + ".tmp", "w") as file:
+            json.dump({"format": self.format, "partitions": self.manifest}, file)
+        os.replace(self.manifestPath + ".tmp", self.manifestPath)
+        logging.info("Export : %s partition(s) written, %s partition(s) unchanged.", self.writeCount, self.skipCount)
+
+
+# Export all the PCEs of a database
+def exportDatabase(dbPath,pricePath,outputPath,format,defaultKwhPrice,defaultFixPrice):
+
+    myPrices = price.Prices(pricePath, defaultKwhPrice, defaultFixPrice)
+    myExporter = Exporter(outputPath, format)
+    myDb = database.Database(dbPath)
+    myDb.open()
+    try:
+        for myPce in myDb.iterPce():
+            myExporter.writePce(myPce, myPrices)
+    finally:
+        myDb.close()
+    myExporter.save()
+    return myExporter
+
+
+# Export a database from the command line
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export the measures of a gazpar2mqtt database to Parquet or Arrow IPC files.")
+    parser.add_argument("--db", default="/data", help="Path of the database directory")
+    parser.add_argument("--prices", default=None, help="Path of the prices file directory, the database directory by default")
+    parser.add_argument("--output", required=True, help="Path of the export directory")
+    parser.add_argument("--format", default="parquet", choices=list(EXPORT_FORMATS), help="Format of the files")
+    parser.add_argument("--kwh-price", default=0.07, type=float, help="Default price in € per kWh")
+    parser.add_argument("--fix-price", default=0.9, type=float, help="Default fix price in € per day")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO)
+    exportDatabase(args.db, args.prices or args.db, args.output, args.format, args.kwh_price, args.fix_price)
+    sys.exit(0)
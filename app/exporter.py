@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+### Define the Prometheus exporter. ###
+# The metrics of each run are accumulated and exposed on /metrics in the Prometheus
+# text format, so the scheduled daemon can be scraped.
+
+import logging
+import threading
+import datetime
+import http.server
+
+# Constants
+PREFIX = "gazpar2mqtt_"
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+
+
+# Return a label value escaped for the text format
+def _escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Return a sample line of the text format
+def _getSample(name,labels,value):
+    if labels:
+        name += "{" + ",".join(f'{key}="{_escapeLabel(labelValue)}"' for key, labelValue in labels) + "}"
+    return f"{name} {value}"
+
+# Return a gauge value, dates are converted to timestamps
+def _getGaugeValue(value):
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value).timestamp()
+    return value
+
+
+# Class Exporter
+class Exporter:
+
+    # Constructor
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.server = None
+        self.counters = {} # (name, labels) : value accumulated over the runs
+        self.gauges = {} # (name, labels) : value of the last run
+        self.histograms = {} # (name, labels) : [bucket counts, sum, count]
+        self.types = {} # name : type of the metric
+
+
+    # Start the http server in a background thread
+    def start(self,port):
+
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != METRICS_PATH:
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Prometheus exporter : " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer(("", port), Handler)
+        myThread = threading.Thread(target=self.server.serve_forever, name="exporter", daemon=True)
+        myThread.start()
+        logging.info("Prometheus metrics available on port %s, path %s", port, METRICS_PATH)
+
+
+    # Stop the http server
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+    # Add the metrics of a run, the labels (e.g. the account) are added to all its samples
+    def update(self,metrics,labels=()):
+
+        with metrics.lock:
+            timers = {key: list(durations) for key, durations in metrics.timers.items()}
+            counters = dict(metrics.counters)
+            gauges = dict(metrics.gauges)
+            stages = {name: dict(myStage) for name, myStage in metrics.stages.items()}
+
+        status = metrics.getStatus()
+        endTime = datetime.datetime.now().timestamp()
+
+        with self.lock:
+
+            # Run
+            self._addCounter("runs_total", labels + (("status", status),), 1)
+            self._setGauge("run_duration_seconds", labels, metrics.duration)
+            self._setGauge("last_run_timestamp_seconds", labels, endTime)
+            if status == "ok":
+                self._setGauge("last_success_timestamp_seconds", labels, endTime)
+
+            # Stages
+            for name, myStage in stages.items():
+                stageLabels = labels + (("stage", name),)
+                if myStage["duration"] is not None:
+                    self._setGauge("stage_duration_seconds", stageLabels, myStage["duration"])
+                self._setGauge("stage_success", stageLabels, 1 if myStage["status"] == "ok" else 0)
+
+            # Timers, counters and gauges of the run
+            for (name, sampleLabels), durations in timers.items():
+                for duration in durations:
+                    self._observe(name + "_duration_seconds", labels + sampleLabels, duration)
+            for (name, sampleLabels), value in counters.items():
+                self._addCounter(name + "_total", labels + sampleLabels, value)
+            for (name, sampleLabels), value in gauges.items():
+                try:
+                    value = _getGaugeValue(value)
+                except ValueError:
+                    continue
+                if isinstance(gauges[(name, sampleLabels)], str):
+                    name += "_timestamp_seconds"
+                self._setGauge(name, labels + sampleLabels, value)
+
+
+    # Add a value to a counter
+    def _addCounter(self,name,labels,value):
+        self.types[name] = "counter"
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+
+    # Set a gauge
+    def _setGauge(self,name,labels,value):
+        if value is None:
+            return
+        self.types[name] = "gauge"
+        self.gauges[(name, labels)] = value
+
+
+    # Add an observation to a histogram
+    def _observe(self,name,labels,value):
+        self.types[name] = "histogram"
+        if (name, labels) not in self.histograms:
+            self.histograms[(name, labels)] = [[0] * len(DURATION_BUCKETS), 0.0, 0]
+        myHistogram = self.histograms[(name, labels)]
+        for i, bucket in enumerate(DURATION_BUCKETS):
+            if value <= bucket:
+                myHistogram[0][i] += 1
+        myHistogram[1] += value
+        myHistogram[2] += 1
+
+
+    # Return the metrics in the Prometheus text format
+    def render(self):
+
+        lineList = []
+        with self.lock:
+            for name in sorted(self.types):
+                lineList.append(f"# TYPE {PREFIX}{name} {self.types[name]}")
+                if self.types[name] == "histogram":
+                    for (sampleName, labels), (bucketCounts, total, count) in sorted(self.histograms.items()):
+                        if sampleName != name:
+                            continue
+                        for bucket, bucketCount in zip(DURATION_BUCKETS, bucketCounts):
+                            lineList.append(_getSample(PREFIX + name + "_bucket", labels + (("le", bucket),), bucketCount))
+                        lineList.append(_getSample(PREFIX + name + "_bucket", labels + (("le", "+Inf"),), count))
+                        lineList.append(_getSample(PREFIX + name + "_sum", labels, total))
+                        lineList.append(_getSample(PREFIX + name + "_count", labels, count))
+                else:
+                    samples = self.counters if self.types[name] == "counter" else self.gauges
+                    for (sampleName, labels), value in sorted(samples.items()):
+                        if sampleName == name:
+                            lineList.append(_getSample(PREFIX + name, labels, value))
+        return "\n".join(lineList) + "\n"
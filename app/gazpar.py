@@ -9,6 +9,7 @@ import sys
 import inspect
 import time
 from requests import Session
+from urllib.parse import urlparse
 import http.cookiejar
 
 # Constants
@@ -19,6 +20,12 @@ GRDF_API_WAIT_BTW_RETRIES = 20 # number of seconds between try 1 and try 2 (must
 GRDF_API_ERRONEOUS_COUNT = 1 # Erroneous number of results send by GRDF
 TYPE_I = 'informative' # type of measure Informative
 TYPE_P = 'published' # type of measure Published
+HDD_BASE_TEMPERATURE = 18.0 # °C, base temperature of the heating degree days
+
+# Columns compared to detect the changes of the stored rows
+PCE_COLUMNS = ('alias', 'activation_date', 'frequence_releve', 'state', 'owner_name', 'postal_code')
+MEASURE_COLUMNS = ('periodStart', 'periodEnd', 'start_index', 'end_index', 'volume', 'volumeGrossConsumed', 'energy', 'energyGrossConsumed', 'conversion', 'temperature')
+THRESHOLD_COLUMNS = ('energy',)
 
 
 
@@ -33,6 +40,11 @@ def _convertDate(dateString):
         myDate = datetime.datetime.strptime(dateString,GRDF_DATE_FORMAT).date()
         return myDate
     
+# Return the SET clause of an upsert : only the rows whose columns differ are updated
+def _getUpsertSet(columnList):
+    return ", ".join(f"{column} = excluded.{column}" for column in columnList) \
+        + " WHERE " + " OR ".join(f"{column} IS NOT excluded.{column}" for column in columnList)
+
 # Convert GRDF datetime string to datetime
 def _convertDateTime(dateTimeString):
     
@@ -67,9 +79,16 @@ class Grdf:
         self.whoiam = None
         self.isConnected = False
         self.account = None   
+        self.requestList = [] # endpoint, duration in seconds and status code of each request
         self.session = requests.Session()
+        self.session.hooks["response"].append(self._onResponse)
         logging.debug("After init")
 
+    # Hook called on each response, the PCE ids are removed from the endpoint
+    def _onResponse(self,response,*args,**kwargs):
+        endpoint = re.sub(r"/\d+", "/{pce}", urlparse(response.url).path)
+        self.requestList.append((endpoint, response.elapsed.total_seconds(), response.status_code))
+
     def login(self,username,password):
         SESSION_URL = "https://monespace.grdf.fr/"
         USER_SESSION_TOKEN_URL = "https://connexion.grdf.fr/idp/idx/identify"
@@ -85,6 +104,7 @@ class Grdf:
             "stateHandle": "{1}"
         }}"""
         self.session = Session()
+        self.session.hooks["response"].append(self._onResponse)
         self.session.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"})
         
         session_response = self.session.get(SESSION_URL)
@@ -294,19 +314,19 @@ class Grdf:
 
 
 
-    # Get thresold
-    def getPceThresold(self,pce):
+    # Get threshold
+    def getPceThreshold(self,pce):
         
         req = self.session.get('https://monespace.grdf.fr/api/e-conso/pce/'+ pce.pceId + '/seuils?frequence=Mensuel')
-        thresoldList = json.loads(req.text)
+        thresholdList = json.loads(req.text)
         
-        for thresold in thresoldList["seuils"]:
+        for threshold in thresholdList["seuils"]:
             
-            # Create the thresold
-            myThresold = Thresold(pce,thresold)
+            # Create the threshold
+            myThreshold = Threshold(pce,threshold)
             
-            # Append thresold to the PCE's thresold list
-            pce.addThresold(myThresold)
+            # Append threshold to the PCE's threshold list
+            pce.addThreshold(myThreshold)
     
     # for posting to url / websocket
     def open_url(self, host, uri, token, data=None):
@@ -410,6 +430,13 @@ class Pce:
         self.thresholdList = []
         self.dailyMeasureStart = None
         self.dailyMeasureEnd = None
+        self.isCalculated = False # calculated measures are set
+        self.anomalyWarn = None # anomaly state, set when the anomaly detector is enabled
+        self.anomalyDate = None
+        self.anomalyScore = None
+        self.anomalyExpected = None
+        self.anomalyKind = None
+        self.anomalyLastDate = None
         
         # Set attributes
         self.alias = pce["alias"]
@@ -422,14 +449,18 @@ class Pce:
         self.json = pce
         
         
-    # Store PCE into database
+    # Store PCE into database, return True when the PCE is new or has changed
     def store(self,db):
         
         if self.json is not None:
             logging.debug("Store PCE %s into database",self.pceId)
-            pce_query = f"INSERT OR REPLACE INTO pces VALUES (?, ?, ?, ?, ?, ?, ?)"
+            pce_query = ("INSERT INTO pces (pce, alias, activation_date, frequence_releve, state, owner_name, postal_code) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (pce) DO UPDATE SET "
+                         + _getUpsertSet(PCE_COLUMNS))
             db.cur.execute(pce_query, [self.pceId, self.alias, self.activationDate, self.frequenceReleve, self.state,
                                        self.ownerName, self.postalCode])
+            return db.cur.rowcount > 0
+        return False
                
     
     # Add a measure to the PCE    
@@ -486,11 +517,30 @@ class Pce:
         
         return measure
     
+    # Set the anomaly state from the last day scored by the anomaly detector
+    def setAnomaly(self,lastScore,lastAnomalyDate):
+
+        self.anomalyWarn = "OFF" # initial value
+        self.anomalyDate = self.anomalyScore = self.anomalyExpected = None
+        self.anomalyKind = "none"
+        self.anomalyLastDate = _convertGrdfDate(lastAnomalyDate) if lastAnomalyDate else None
+        if lastScore is not None:
+            myDate, energy, self.anomalyExpected, self.anomalyScore, kind = lastScore
+            self.anomalyDate = _convertGrdfDate(myDate)
+            if kind:
+                self.anomalyWarn = "ON"
+                self.anomalyKind = kind
+
     # Calculated measures from database
-    def calculateMeasures(self,db,thresholdPercentage,type):
+    def calculateMeasures(self,db,thresholdPercentage,type,hddBase=HDD_BASE_TEMPERATURE):
         
         # Get last valid measure as reference
         myMeasure = self.getLastMeasureOk(type)
+
+        # Degree days measures, they stay unknown without temperatures
+        self.hddR1Y = self.hddR2Y1Y = self.hddR1M = self.hddR1MY1 = None
+        self.energyHddR1Y = self.energyHddR2Y1Y = self.energyHddR1M = self.energyHddR1MY1 = None
+        self.energyNormR1Y = self.energyNormR1YPct = self.energyNormR1MPct = None
         
         # Get current date, week, month and year
         dateNow = datetime.date.today()
@@ -751,6 +801,25 @@ class Pce:
                         self.tshM1Warn = "ON"
                     else:
                         self.tshM1Warn = "OFF"
+
+
+            # Degree days measures
+
+            ## Degree days and energy by degree day of the rolling year and month, and of the same periods last year
+            self._getDegreeDays(db,dateNow,hddBase,type)
+            logging.debug("R1Y degree days : %s, %s kWh / degree day",self.hddR1Y,self.energyHddR1Y)
+            logging.debug("R2Y1Y degree days : %s, %s kWh / degree day",self.hddR2Y1Y,self.energyHddR2Y1Y)
+
+            ## Energy of the rolling year with the weather of last year, and evolutions at equal weather
+            if self.energyHddR1Y is not None and self.hddR2Y1Y:
+                self.energyNormR1Y = round(self.energyHddR1Y * self.hddR2Y1Y)
+            if self.energyHddR1Y is not None and self.energyHddR2Y1Y:
+                self.energyNormR1YPct = round((self.energyHddR1Y / self.energyHddR2Y1Y - 1) * 100)
+            if self.energyHddR1M is not None and self.energyHddR1MY1:
+                self.energyNormR1MPct = round((self.energyHddR1M / self.energyHddR1MY1 - 1) * 100)
+            logging.debug("R1Y normalised energy : %s kWh, evolution %s %%",self.energyNormR1Y,self.energyNormR1YPct)
+
+        self.isCalculated = True
                     
             
     
@@ -778,6 +847,30 @@ class Pce:
             logging.debug("Delta conso could not be calculated")
             return 0
                 
+    # Set the heating degree days and the energy by degree day of the rolling year and month, and of the same periods last year
+    # The days are summed by a single query over the 2 last years : days without temperature are left out of both sums
+    def _getDegreeDays(self,db,dateNow,hddBase,type):
+
+        periodList = (
+            ("R1Y", "date(:now,'-1 year')", "date(:now,'-1 day')"),
+            ("R2Y1Y", "date(:now,'-2 year')", "date(:now,'-1 year','-1 day')"),
+            ("R1M", "date(:now,'-1 month')", "date(:now,'-1 day')"),
+            ("R1MY1", "date(:now,'-1 month','-1 year')", "date(:now,'-1 year','-1 day')"),
+        )
+        sumList = []
+        for period, startStr, endStr in periodList:
+            sumList.append(f"sum(CASE WHEN date BETWEEN {startStr} AND {endStr} THEN max(:base - temperature, 0) END)")
+            sumList.append(f"sum(CASE WHEN date BETWEEN {startStr} AND {endStr} THEN energy END)")
+        query = f"SELECT {', '.join(sumList)} FROM measures WHERE pce = :pce AND type = :type AND temperature IS NOT NULL " \
+                "AND date BETWEEN date(:now,'-2 year') AND date(:now,'-1 day')"
+        db.cur.execute(query, {"now": str(dateNow), "base": hddBase, "pce": self.pceId, "type": type})
+        queryResult = db.cur.fetchone()
+
+        for i, (period, startStr, endStr) in enumerate(periodList):
+            hdd, energy = queryResult[2*i], queryResult[2*i+1]
+            setattr(self, "hdd" + period, round(hdd, 1) if hdd is not None else None)
+            setattr(self, "energyHdd" + period, round(energy / hdd, 2) if hdd and energy is not None else None)
+
     # Get measures
     def _getMeasuresRange(self,db,pce,startStr,endStr,type):
         logging.debug("Retrieve measures of conso between %s and %s",startStr,endStr)
@@ -941,7 +1034,8 @@ class Measure:
                 if self.conversionFactor:
                     self.energy = round(self.volume * self.conversionFactor)
 
-    # Store measure to database
+    # Store measure to database, return True when the measure is new or has changed
+    # The price is not replaced : it is calculated once the measures are stored
     def store(self,db):
 
         dbTable = None
@@ -952,8 +1046,12 @@ class Measure:
 
         if self.isOk() and dbTable:
             logging.debug("Store measure type %s, %s,%s,%s, %s, %s, %s m3, %s m3, %s kWh, %s kWh, %s EUR, %s kwh/m3",self.type,str(self.gasDate),str(self.startDateTime), str(self.endDateTime),str(self.startIndex),str(self.endIndex), str(self.volume), str(self.volumeGross), str(self.energy), str(self.energyGross), self.price, str(self.conversionFactor))
-            measure_query = f"INSERT OR REPLACE INTO measures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-            db.cur.execute(measure_query, [self.pce.pceId, self.type, self.gasDate, self.startDateTime, self.endDateTime, self.startIndex, self.endIndex, self.volume, self.volumeGross, self.energy, self.energyGross, self.price, self.conversionFactor])
+            measure_query = ("INSERT INTO measures (pce, type, date, periodStart, periodEnd, start_index, end_index, volume, volumeGrossConsumed, energy, energyGrossConsumed, price, conversion, temperature) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (pce, type, date) DO UPDATE SET "
+                             + _getUpsertSet(MEASURE_COLUMNS))
+            db.cur.execute(measure_query, [self.pce.pceId, self.type, self.gasDate, self.startDateTime, self.endDateTime, self.startIndex, self.endIndex, self.volume, self.volumeGross, self.energy, self.energyGross, self.price, self.conversionFactor, self.temperature])
+            return db.cur.rowcount > 0
+        return False
         
     
     # Return measure measure quality status
@@ -990,13 +1088,16 @@ class Threshold:
             self.date = datetime.date(self.year,self.month,1)
         self.pce = pce
         
-    # Store threshold to database
+    # Store threshold to database, return True when the threshold is new or has changed
     def store(self,db):
         
         if self.isOk():
             logging.debug("Store threshold %s, %s kWh",str(self.date), str(self.energy))
-            measure_query = f"INSERT OR REPLACE INTO thresholds VALUES (?, ?, ?)"
+            measure_query = ("INSERT INTO thresholds (pce, date, energy) VALUES (?, ?, ?) ON CONFLICT (pce, date) DO UPDATE SET "
+                             + _getUpsertSet(THRESHOLD_COLUMNS))
             db.cur.execute(measure_query, [self.pce.pceId, self.date, self.energy])
+            return db.cur.rowcount > 0
+        return False
         
     # Return threshold quality status
     def isOk(self):
@@ -1,10 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import sys
 import datetime
-import schedule
 import time
-from dateutil.relativedelta import relativedelta
 import logging
 import json
 
@@ -14,16 +11,44 @@ import standalone
 import hass
 import param
 import database
-import influxdb
 import price
+import outbox
+import stage
+import metrics
+import scheduler
+import changeset
+import accounts
+import shard
+import snapshot
+import anomaly
+import os
+import copy
+import threading
+import concurrent.futures
 import datetime as dt
-from hass_ws import HomeAssistantWs
+
+# The modules of the optional sinks (influxdb, hass_ws, export), the Prometheus exporter and the fixed scheduler
+# are imported on demand : their libraries are long to import and are not needed by every configuration.
 
 
 # gazpar2mqtt constants
 G2M_VERSION = '0.8.12'
 G2M_DB_VERSION = '0.4.0'
 G2M_INFLUXDB_VERSION = '0.1.0'
+THRESHOLD_KEY = 'threshold'
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+LOG_FORMAT_ACCOUNTS = '%(asctime)s %(levelname)s [%(threadName)s] %(message)s' # the account of each line is logged
+AGGREGATE_KEY = 'aggregate'
+
+# Home Assistant LTS sensors : suffix, unit, unit class, type of measure, attribute of measure
+LTS_SENSORS = [
+    ('_consumption_stat', 'm³', 'volume', gazpar.TYPE_I, 'volumeGross'),
+    ('_consumption_kwh_stat', 'kWh', 'energy', gazpar.TYPE_I, 'energyGross'),
+    ('_consumption_cost_stat', 'EUR', None, gazpar.TYPE_I, 'price'),
+    ('_consumption_pub_stat', 'm³', 'volume', gazpar.TYPE_P, 'volumeGross'),
+    ('_consumption_kwh_pub_stat', 'kWh', 'energy', gazpar.TYPE_P, 'energyGross'),
+    ('_consumption_pub_cost_stat', 'EUR', None, gazpar.TYPE_P, 'price'),
+]
 
 #######################################################################
 #### Functions
@@ -31,103 +56,120 @@ G2M_INFLUXDB_VERSION = '0.1.0'
 
 # Sub to get date with year offset
 def _getYearOfssetDate(day, number):
+    from dateutil.relativedelta import relativedelta
     return day - relativedelta(years=number)
 
 # Sub to return format wanted
 def _dateTimeToStr(datetime):
     return datetime.strftime("%d/%m/%Y - %H:%M:%S")
 
-# Sub to wait between 2 GRDF tries
-def _waitBeforeRetry(tryCount):
-    waitTime = round(gazpar._getRetryTimeSleep(tryCount))
-    if waitTime < 200:
-        logging.info("Wait %s seconds (%s min) before next try",waitTime,round(waitTime/60))
-    else:
-        logging.info("Wait %s minutes before next try",round(waitTime/60))
-    time.sleep(waitTime)
-
-########################################################################################################################
-#### Running program
-########################################################################################################################
-def run(myParams):
-
-    myMqtt = None
-    myGrdf = None
-
-    # Store time now
-    dtn = _dateTimeToStr(datetime.datetime.now())
-
-
-    # STEP 1 : Connect to database
-    ####################################################################################################################
-    logging.info("-----------------------------------------------------------")
-    logging.info("#        Connection to SQLite database                     #")
-    logging.info("-----------------------------------------------------------")
-
-    # Create/Update database
-    logging.info("Connection to SQLite database...")
-    myDb = database.Database(myParams.dbPath)
-
-
-    # Connect to database
-    myDb.connect(G2M_VERSION,G2M_DB_VERSION,G2M_INFLUXDB_VERSION)
-    if myDb.isConnected() :
-        logging.info("SQLite database connected !")
-    else:
-        logging.error("Unable to connect to SQLite database.")
+# Sub to get the Home Assistant LTS sensor name of a PCE
+def _getLtsSensorName(deviceName, pceAlias, suffix):
+    return 'gazpar:' + deviceName + '_' + pceAlias.lower().strip().replace(" ", "_") + suffix
+
+# Sub to build the LTS statistics of a measure list, cumulating the sum from a base value
+def _getLtsStats(measureList, attribute, baseSum):
+    stats = []
+    statSum = baseSum
+    for myMeasure in measureList:
+        value = getattr(myMeasure, attribute)
+        statSum = statSum + value
+        stats.append({
+            "start": myMeasure.date.replace(tzinfo=dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S%z"),  # formatted date
+            "state": value,
+            "sum": statSum,
+        })
+    return stats
+
+# Sub to record the requests sent to GRDF into the metrics
+def _recordGrdfRequests(myMetrics, myGrdf):
+    for endpoint, seconds, statusCode in myGrdf.requestList:
+        myMetrics.observe("grdf_request", seconds, endpoint=endpoint)
+        if statusCode >= 400:
+            myMetrics.count("grdf_request_errors", endpoint=endpoint)
+    myGrdf.requestList = []
+
+# Sub to calculate the measures of a PCE
+def _calculateMeasures(myParams, myDb, myPce, myMetrics):
+    startTime = time.monotonic()
+    try:
+        myPce.calculateMeasures(myDb,myParams.thresholdPercentage,gazpar.TYPE_I,myParams.hddBaseTemperature)
+    except:
+        logging.error("Unable to calculate informative measures")
+    myMetrics.observe("calculate_measures", time.monotonic() - startTime)
 
-    # Check program version
-    g2mVersion = myDb.getConfig(database.G2M_KEY)
-    g2mDate = myDb.getConfig(database.LAST_EXEC_KEY)
-    logging.info("Last execution date %s, program was in version %s.",g2mDate,g2mVersion)
-    if g2mVersion != G2M_VERSION:
-        logging.warning("gazpar2mqtt version (%s) has changed since last execution (%s)",G2M_VERSION,g2mVersion)
-        # Update program version
-        myDb.updateVersion(database.G2M_KEY,G2M_VERSION)
+# Sub to score the new daily measures of a PCE and set its anomaly state
+def _detectAnomalies(myParams, myDb, myPce, myChangeSet, myMetrics):
+    startTime = time.monotonic()
+    try:
+        myDetector = anomaly.Detector(myParams.anomalyThreshold,myParams.anomalyAlpha,myParams.hddBaseTemperature)
+        # Days backfilled or corrected before the last scored day are scored again
+        scoreList = myDetector.run(myDb,myPce.pceId,myChangeSet.getFirstMeasureDate(myPce.pceId,gazpar.TYPE_I))
         myDb.commit()
-
-
-    # Reinit database when required :
-    if myParams.dbInit:
-        logging.info("Reinitialization of the database...")
-        myDb.reInit(G2M_VERSION,G2M_DB_VERSION,G2M_INFLUXDB_VERSION)
-        logging.info("Database reinitialized to version %s",G2M_DB_VERSION)
-    else:
-        # Compare dabase version
-        logging.info("Checking database version...")
-        dbVersion = myDb.getConfig(database.DB_KEY)
-        if dbVersion == G2M_DB_VERSION:
-            logging.info("Your database is already up to date : version %s.",G2M_DB_VERSION)
-
-            # Display current database statistics
-            logging.info("Retrieve database statistics...")
-            dbStats = myDb.getMeasuresCount(gazpar.TYPE_I)
-            logging.info("%s informatives measures stored", dbStats["rows"])
-            logging.info("%s PCE(s)", dbStats["pce"])
-            logging.info("First measure : %s", dbStats["minDate"])
-            logging.info("Last measure : %s", dbStats["maxDate"])
+        for myDate, energy, expected, score, kind in scoreList:
+            if kind:
+                logging.info("Anomaly %s on %s : %s kWh consumed, %s kWh expected, score = %s", kind, myDate.date(), energy, expected, score)
+                myMetrics.count("anomalies", kind=kind)
+        myPce.setAnomaly(*myDb.getLastAnomalyScore(myPce.pceId))
+        logging.info("%s new day(s) scored, anomaly = %s (%s)", len(scoreList), myPce.anomalyWarn, myPce.anomalyKind)
+        if myPce.anomalyScore is not None:
+            myMetrics.gauge("anomaly_score", myPce.anomalyScore, pce=myPce.pceId)
+    except:
+        logging.error("Unable to detect anomalies")
+    myMetrics.observe("detect_anomalies", time.monotonic() - startTime)
+
+# Sub to write the price of the measures of the PCEs which changed
+def _writePrices(myParams, myDb, pceList, myPrices, myChangeSet):
+
+    cursor = myDb.isConnected()
+
+    # Loop on PCEs
+    for myPce in pceList:
+
+        # Prices are written again only when the prices or the measures of the PCE changed
+        if not (myChangeSet.full or myChangeSet.pricesChanged or myChangeSet.countMeasures(myPce.pceId)):
+            logging.info("No change for PCE %s, prices are up to date.",myPce.pceId)
+            continue
+
+        myPcePrices = myPrices.getPricesByPce(myPce.pceId)
+        if myPcePrices:
+            # Loop on prices of the PCE and write the current price
+            for myPrice in myPcePrices:
+                #informative / daily values
+                query = f"UPDATE measures SET price= ( energyGrossConsumed * {myPrice.kwhPrice} ) + {myPrice.fixPrice} where pce = '{myPce.pceId}' and type = '{gazpar.TYPE_I}' and date between '{myPrice.startDate}' and '{myPrice.endDate}'"
+                logging.debug("Query_I: %s", query )
+                cursor.execute(query) 
+
+                #published / periodic values
+                query = f"UPDATE measures SET price= ( energyGrossConsumed * {myPrice.kwhPrice} ) + ((JulianDay(periodEnd) - JulianDay(periodStart)) * {myPrice.fixPrice}) where pce = '{myPce.pceId}' and type = '{gazpar.TYPE_P}' and date between '{myPrice.startDate}' and '{myPrice.endDate}'"
+                logging.debug("Query_P: %s", query )
+                
+                cursor.execute(query) 
 
         else:
-            logging.warning("Your database (version %s) is not up to date.",dbVersion)
-            logging.info("Reinitialization of your database to version %s...",G2M_DB_VERSION)
-            myDb.reInit(G2M_VERSION,G2M_DB_VERSION,G2M_INFLUXDB_VERSION)
-            dbVersion = myDb.getConfig(database.DB_KEY)
-            logging.info("Database reinitialized to version %s !",dbVersion)
+            logging.warning("No prices file found, using the default price (%s €/kWh and %s €/day).", myParams.priceKwhDefault, myParams.priceFixDefault)
+            
+            # A single update of the measures of the PCE
+            try: 
+                cursor.execute("UPDATE measures SET price = ( energyGrossConsumed * ? ) + ? WHERE pce = ?",
+                               [float(myParams.priceKwhDefault), float(myParams.priceFixDefault), myPce.pceId])
+            except Exception as e:
+                logging.error("Writing Prices with default values, error: %s", e)  
 
+    # Commit once all prices are written
+    myDb.commit()
 
-    # STEP 2 : Log to MQTT broker
-    ####################################################################################################################
-    logging.info("-----------------------------------------------------------")
-    logging.info("#              Connection to Mqtt broker                   #")
-    logging.info("-----------------------------------------------------------")
+# Connect to the Mqtt broker, the client is returned even when the connection failed
+def _connectMqtt(myParams):
 
+    myMqtt = None
     try:
 
         logging.info("Connect to Mqtt broker...")
-        
-        # Create mqtt client      
-        myMqtt = mqtt.Mqtt(myParams.mqttClientId,myParams.mqttUsername,myParams.mqttPassword,myParams.mqttSsl,myParams.mqttQos,myParams.mqttRetain)   
-        
+
+        # Create mqtt client
+        myMqtt = mqtt.Mqtt(myParams.mqttClientId,myParams.mqttUsername,myParams.mqttPassword,myParams.mqttSsl,myParams.mqttQos,myParams.mqttRetain)
+
         # Connect mqtt broker
         myMqtt.connect(myParams.mqttHost,myParams.mqttPort)
 
@@ -137,236 +179,98 @@ def run(myParams):
         if myMqtt.isConnected:
             logging.info("Mqtt broker connected !")
 
+            # Listen to Home Assistant birth message to republish discovery configs on restart
+            if myParams.hassDiscovery:
+                myMqtt.subscribe(myParams.hassPrefix + hass.TOPIC_STATUS)
+
     except:
         logging.error("Unable to connect to Mqtt broker. Please check that broker is running, or check broker configuration.")
 
-    # STEP 3 : Get data from GRDF website
-    ####################################################################################################################
-    if myMqtt.isConnected:
-
-        logging.info("-----------------------------------------------------------")
-        logging.info("#            Get data from GRDF website                   #")
-        logging.info("-----------------------------------------------------------")
-
-        tryCount = 0
-        # Connection
-        while tryCount < gazpar.GRDF_API_MAX_RETRIES :
-            try:
-
-                tryCount += 1
-
-                # Create Grdf instance
-                logging.debug("Connection to GRDF, try %s/%s...",tryCount,gazpar.GRDF_API_MAX_RETRIES)
-                myGrdf = gazpar.Grdf()
-                logging.debug("After myGrdf")
-                # Connect to Grdf website
-
-                myGrdf.login(myParams.grdfUsername,myParams.grdfPassword)
-
-
-                # Check connection
-                if myGrdf.isConnected:
-                    logging.info("GRDF connected !")
-                    break
-                else:
-                    logging.info("Unable to login to GRDF website")
-                    _waitBeforeRetry(tryCount)
-
-            except:
-                myGrdf.isConnected = False
-                logging.info("Unable to login to GRDF website")
-                _waitBeforeRetry(tryCount)
-
-
-        # When GRDF is connected
-        if myGrdf.isConnected:
-
-            # Sub-step 3A : Get account info
-            try:
+    return myMqtt
 
-                # Get account informations and store it to db
-                logging.info("Retrieve account informations")
-                myAccount = myGrdf.getWhoami()
-                logging.info("MyAccount: %s", myAccount)
-                myAccount.store(myDb)
-                myDb.commit()
-
-            except:
-                logging.warning("Unable to get account information from GRDF website.")
+# Sub to wait between 2 GRDF tries
+def _waitBeforeRetry(tryCount):
+    waitTime = round(gazpar._getRetryTimeSleep(tryCount))
+    if waitTime < 200:
+        logging.info("Wait %s seconds (%s min) before next try",waitTime,round(waitTime/60))
+    else:
+        logging.info("Wait %s minutes before next try",round(waitTime/60))
+    time.sleep(waitTime)
 
+########################################################################################################################
+#### Stages
+########################################################################################################################
 
-            # Sub-step 3B : Get list of PCE
-            logging.info("Retrieve list of PCEs...")
+# Sub to open a database connection for a stage running in its own thread
+def _openStageDb(myParams):
+    myDb = database.Database(myParams.dbPath)
+    myDb.open()
+    return myDb
+
+# Request the gaps in the measures of a PCE again, on the windows of the gaps only
+# Each gap has a budget of attempts : GRDF may never provide some days
+def _backfillGaps(myParams,myDb,myGrdf,myPce,startDate,myChangeSet,myMetrics):
+
+    requestCount = 0
+    for type in (gazpar.TYPE_I, gazpar.TYPE_P):
+
+        gapList = myDb.getGapList(myPce.pceId, type, startDate)
+        attemptList = myDb.getGapAttempts(myPce.pceId, type)
+        myMetrics.gauge("measure_gap_days", sum(dayCount for gapStart, gapEnd, dayCount in gapList), pce=myPce.pceId, type=type)
+        if gapList:
+            logging.info("%s gap(s) found in %s measures, %s day(s) missing, %s gap(s) given up after %s attempt(s).", len(gapList), type,
+                         sum(dayCount for gapStart, gapEnd, dayCount in gapList),
+                         sum(1 for gapStart, gapEnd, dayCount in gapList if attemptList.get(gapStart, 0) >= myParams.gapRetryMax),
+                         myParams.gapRetryMax)
+
+        # Gaps tried the least first, then the most recent ones : GRDF is more likely to fill them
+        for gapStart, gapEnd, dayCount in sorted(gapList, key=lambda gap: (attemptList.get(gap[0], 0), -gap[0].toordinal())):
+
+            if attemptList.get(gapStart, 0) >= myParams.gapRetryMax:
+                continue
+            if requestCount >= myParams.gapMaxRequests:
+                logging.info("Maximum of %s backfill request(s) reached, next gaps are left to the next run.", myParams.gapMaxRequests)
+                break
+            requestCount += 1
+            attemptList[gapStart] = attemptList.get(gapStart, 0) + 1
+
+            # Only the measures of the gap are kept, the other ones are already stored
+            measureCount = len(myPce.measureList)
             try:
-                myGrdf.getPceList()
-                logging.info("%s PCE found !",myGrdf.countPce())
+                myGrdf.getPceMeasures(myPce, gapStart.date(), gapEnd.date() + datetime.timedelta(days=1), type)
             except:
-                myGrdf.isConnected = False
-                logging.info("Unable to get any PCE !")
-
-            # Loop on PCE
-            if myGrdf.pceList:
-                for myPce in myGrdf.pceList:
-
-                    # Store PCE in database
-                    myPce.store(myDb)
-                    myDb.commit()
-
-
-                    # Sub-step 3C : Get measures of the PCE
-
-                    # Get measures of the PCE
-                    logging.info("---------------------------------")
-                    logging.info("Get measures of PCE %s alias %s",myPce.pceId,myPce.alias)
-
-
-                    # Set date range
-                    if not myParams.grdfStartDate: myParams.grdfStartDate = '2020-01-01' # can be omitted if param.py back to default
-                    minDateTimeLimit = _getYearOfssetDate(datetime.datetime.now(), 3) # GRDF min date is 3 years ago
-                    minDateTime = datetime.datetime.strptime(myParams.grdfStartDate, "%Y-%m-%d")
-                    startDate = minDateTime.date()
-                    endDate = datetime.date.today()
-                    if minDateTime < minDateTimeLimit:
-                        startDate = minDateTimeLimit.date()
-                        logging.info("Range period : from %s (3 years ago) to %s (today) ...",startDate,endDate)
-                    
-                    logging.info("Range period : from %s (self defined) to %s (today) ...",startDate,endDate)
-                    
-
-                    # Get informative measures
-                    logging.info("---------------")
-                    logging.info("Retrieve informative measures...")
-                    try:
-                        myGrdf.getPceMeasures(myPce,startDate,endDate,gazpar.TYPE_I)
-                        logging.info("Informative measures found !")
-                    except:
-                        logging.error("Error during informative measures collection")
-
-
-                    # Analyse data
-                    measureCount = myPce.countMeasure(gazpar.TYPE_I)
-                    if measureCount > 0:
-                        logging.info("Analysis of informative measures provided by GRDF...")
-                        logging.info("%s informative measures provided by Grdf", measureCount)
-                        measureOkCount = myPce.countMeasureOk(gazpar.TYPE_I)
-                        logging.info("%s informative measures are ok", measureOkCount)
-                        accuracy = round((measureOkCount/measureCount)*100)
-                        logging.info("Accuracy is %s percent",accuracy)
-
-                        # Get last informative measure
-                        myMeasure = myPce.getLastMeasureOk(gazpar.TYPE_I)
-                        if myMeasure:
-                            logging.info("Last valid informative measure provided by GRDF : ")
-                            logging.info("Date = %s", myMeasure.gasDate)
-                            logging.info("Start index = %s, End index = %s", myMeasure.startIndex, myMeasure.endIndex)
-                            logging.info("Volume = %s m3, Energy = %s kWh, Factor = %s", myMeasure.volume, myMeasure.energy,
-                                         myMeasure.conversionFactor)
-                            if myMeasure.isDeltaIndex:
-                                logging.warning("Inconsistencies detected on the measure : ")
-                                logging.warning(
-                                    "Volume provided by Grdf (%s m3) has been replaced by the volume between start index and end index (%s m3)",
-                                    myMeasure.volumeInitial, myMeasure.volume)
-                        else:
-                            logging.warning("Unable to find the last informative measure.")
-
-
-                    # Get published measures
-                    logging.info("---------------")
-                    logging.info("Retrieve published measures...")
-                    try:
-                        myGrdf.getPceMeasures(myPce, startDate, endDate, gazpar.TYPE_P)
-                        logging.info("Published measures found !")
-                    except:
-                        logging.error("Error during published measures collection")
-
-                    # Analyse data
-                    measureCount = myPce.countMeasure(gazpar.TYPE_P)
-                    if measureCount > 0:
-                        logging.info("Analysis of published measures provided by GRDF...")
-                        logging.info("%s published measures provided by Grdf", measureCount)
-                        measureOkCount = myPce.countMeasureOk(gazpar.TYPE_P)
-                        logging.info("%s published measures are ok", measureOkCount)
-                        accuracy = round((measureOkCount / measureCount) * 100)
-                        logging.info("Accuracy is %s percent", accuracy)
-
-                        # Get last published measure
-                        myMeasure = myPce.getLastMeasureOk(gazpar.TYPE_P)
-                        if myMeasure:
-                            logging.info("Last valid published measure provided by GRDF : ")
-                            logging.info("Start date = %s, End date = %s", myMeasure.startDateTime, myMeasure.endDateTime)
-                            logging.info("Start index = %s, End index = %s", myMeasure.startIndex, myMeasure.endIndex)
-                            logging.info("Volume = %s m3, Energy = %s kWh, Factor = %s", myMeasure.volume, myMeasure.energy,
-                                         myMeasure.conversionFactor)
-                            if myMeasure.isDeltaIndex:
-                                logging.warning("Inconsistencies detected on the measure : ")
-                                logging.warning(
-                                    "Volume provided by Grdf (%s m3) has been replaced by the volume between start index and end index (%s m3)",
-                                    myMeasure.volumeInitial, myMeasure.volume)
-                        else:
-                            logging.warning("Unable to find the last published measure.")
-
-                    # Store to database
-                    logging.info("---------------")
-                    if myPce.measureList:
-                        logging.info("Update of database with retrieved measures...")
-                        for myMeasure in myPce.measureList:
-                            # Store measure into database
-                            myMeasure.store(myDb)
-
-                        # Commmit database
-                        myDb.commit()
-                        logging.info("Database updated !")
-
-                    else:
-                        logging.info("Unable to store any measure for PCE %s to database !",myPce.pceId)
-
+                logging.warning("Error during the request of the gap from %s to %s.", gapStart.date(), gapEnd.date())
+            fetchedList = myPce.measureList[measureCount:]
+            del myPce.measureList[measureCount:]
+            filledCount = 0
+            for myMeasure in fetchedList:
+                if myMeasure.gasDate is not None and gapStart.date() <= myMeasure.gasDate <= gapEnd.date() and myMeasure.store(myDb):
+                    myPce.measureList.append(myMeasure)
+                    myChangeSet.addMeasure(myPce.pceId, myMeasure.type, myMeasure.gasDate)
+                    filledCount += 1
+            logging.info("Gap from %s to %s : %s measure(s) filled, attempt %s of %s.", gapStart.date(), gapEnd.date(),
+                         filledCount, attemptList[gapStart], myParams.gapRetryMax)
+            myMetrics.count("grdf_gap_requests", type=type)
+            myMetrics.count("gap_measures_filled", filledCount, type=type)
+
+        # Gaps which have been filled are forgotten
+        myDb.setGapAttempts(myPce.pceId, type, gapList, attemptList)
+    myDb.commit()
+
+
+# Stage to publish values to Mqtt broker : standalone and Home Assistant discovery modes
+def _runMqttStage(myParams,myMqtt,myGrdf,dtn,myChangeSet,myMetrics):
+
+    myDb = _openStageDb(myParams)
+    myOutbox = outbox.Outbox(myDb,myMqtt,myParams.mqttQos,myParams.mqttRetain)
 
-                    # Sub-step 3D : Get thresholds of the PCE
-
-                    # Get threshold
-                    logging.info("---------------")
-                    logging.info("Retrieve PCE's thresholds from GRDF...")
-                    try:
-                        myGrdf.getPceThreshold(myPce)
-                        thresholdCount = myPce.countThreshold()
-                        logging.info("%s thresholds found !",thresholdCount)
-
-                    except:
-                        logging.warning("Error to get PCE's thresholds, verify if you have setup thresholds for your PCE/account")
-
-                    # Update database
-                    if myPce.thresholdList:
-                        # Store thresholds into database
-                        logging.info("Update of database with retrieved thresholds...")
-                        for myThreshold in myPce.thresholdList:
-                            myThreshold.store(myDb)
-                        # Commmit database
-                        myDb.commit()
-                        logging.info("Database updated !")
-
-
-                    # Sub-step 3E : Calculate measures of the PCE
-
-                    # Calculate informative measures
-                    try:
-                        myPce.calculateMeasures(myDb,myParams.thresholdPercentage,gazpar.TYPE_I)
-                    except:
-                        logging.error("Unable to calculate informative measures")
-
-
-            else:
-                logging.info("No PCE retrieved.")
-
-
-                                                                                                                                                                                                                     
-                     
     ####################################################################################################################     
     # STEP 5A : Standalone mode
     ####################################################################################################################
-    if myMqtt.isConnected \
-        and myParams.standalone \
+    if myParams.standalone \
         and myGrdf.isConnected:
 
+        startTime = time.monotonic()
         try:
 
             logging.info("-----------------------------------------------------------")
@@ -376,6 +280,8 @@ def run(myParams):
             # Loop on PCEs
             for myPce in myGrdf.pceList:
 
+                if stage.isStopped():
+                    break
                 logging.info("Publishing values of PCE %s alias %s...",myPce.pceId,myPce.alias)
                 logging.info("---------------------------------")
 
@@ -388,13 +294,20 @@ def run(myParams):
                 # Instantiate Standalone class by PCE
                 mySa = standalone.Standalone(prefix)
 
+                # Retained values are published again only when they changed
+                if myParams.mqttRetain and not myChangeSet.hasChanged(myPce.pceId):
+                    logging.info("No change for PCE %s, only the status date is published.",myPce.pceId)
+                    myOutbox.publish(mySa.statusTopic+"date", dtn)
+                    del mySa
+                    continue
+
                 # Set values
                 if not myPce.isOk(): # PCE is not correct
 
                     ## Publish status values
                     logging.info("Publishing to Mqtt status values...")
-                    myMqtt.publish(mySa.statusTopic+"date", dtn)
-                    myMqtt.publish(mySa.statusTopic+"connectivity", "OFF")
+                    myOutbox.publish(mySa.statusTopic+"date", dtn)
+                    myOutbox.publish(mySa.statusTopic+"connectivity", "OFF")
                     logging.info("Status values published !")
 
 
@@ -409,11 +322,11 @@ def run(myParams):
                     myMeasure = myPce.getLastMeasureOk(gazpar.TYPE_I)
                     if myMeasure:
                         logging.debug("Creation of last informative measures")
-                        myMqtt.publish(mySa.lastTopic+"date", myMeasure.gasDate)
-                        myMqtt.publish(mySa.lastTopic+"energy", myMeasure.energy)
-                        myMqtt.publish(mySa.lastTopic+"gas", myMeasure.volume)
-                        myMqtt.publish(mySa.lastTopic+"index", myMeasure.endIndex)
-                        myMqtt.publish(mySa.lastTopic+"conversion_Factor", myMeasure.conversionFactor)
+                        myOutbox.publish(mySa.lastTopic+"date", myMeasure.gasDate)
+                        myOutbox.publish(mySa.lastTopic+"energy", myMeasure.energy)
+                        myOutbox.publish(mySa.lastTopic+"gas", myMeasure.volume)
+                        myOutbox.publish(mySa.lastTopic+"index", myMeasure.endIndex)
+                        myOutbox.publish(mySa.lastTopic+"conversion_Factor", myMeasure.conversionFactor)
                     else:
                         logging.warning("Unable to publish last measure infos.")
 
@@ -421,12 +334,12 @@ def run(myParams):
                     myMeasure = myPce.getLastMeasureOk(gazpar.TYPE_P)
                     if myMeasure:
                         logging.debug("Creation of last published measures")
-                        myMqtt.publish(mySa.publishedTopic + "start_date", myMeasure.startDateTime)
-                        myMqtt.publish(mySa.publishedTopic + "end_date", myMeasure.endDateTime)
-                        myMqtt.publish(mySa.publishedTopic + "energy", myMeasure.energy)
-                        myMqtt.publish(mySa.publishedTopic + "gas", myMeasure.volume)
-                        myMqtt.publish(mySa.publishedTopic + "index", myMeasure.endIndex)
-                        myMqtt.publish(mySa.publishedTopic + "conversion_Factor", myMeasure.conversionFactor)
+                        myOutbox.publish(mySa.publishedTopic + "start_date", myMeasure.startDateTime)
+                        myOutbox.publish(mySa.publishedTopic + "end_date", myMeasure.endDateTime)
+                        myOutbox.publish(mySa.publishedTopic + "energy", myMeasure.energy)
+                        myOutbox.publish(mySa.publishedTopic + "gas", myMeasure.volume)
+                        myOutbox.publish(mySa.publishedTopic + "index", myMeasure.endIndex)
+                        myOutbox.publish(mySa.publishedTopic + "conversion_Factor", myMeasure.conversionFactor)
                     else:
                         logging.warning("Unable to publish last measure infos.")
 
@@ -434,62 +347,84 @@ def run(myParams):
                     logging.debug("Creation of calendar measures")
 
                     ### Year
-                    myMqtt.publish(mySa.histoTopic+"current_year_gas", myPce.gasY0)
-                    myMqtt.publish(mySa.histoTopic+"previous_year_gas", myPce.gasY1)
+                    myOutbox.publish(mySa.histoTopic+"current_year_gas", myPce.gasY0)
+                    myOutbox.publish(mySa.histoTopic+"previous_year_gas", myPce.gasY1)
 
                     ### Month
-                    myMqtt.publish(mySa.histoTopic+"current_month_gas", myPce.gasM0Y0)
-                    myMqtt.publish(mySa.histoTopic+"previous_month_gas", myPce.gasM1Y0)
-                    myMqtt.publish(mySa.histoTopic+"current_month_previous_year_gas", myPce.gasM0Y1)
+                    myOutbox.publish(mySa.histoTopic+"current_month_gas", myPce.gasM0Y0)
+                    myOutbox.publish(mySa.histoTopic+"previous_month_gas", myPce.gasM1Y0)
+                    myOutbox.publish(mySa.histoTopic+"current_month_previous_year_gas", myPce.gasM0Y1)
 
                     ### Week
-                    myMqtt.publish(mySa.histoTopic+"current_week_gas", myPce.gasW0Y0)
-                    myMqtt.publish(mySa.histoTopic+"previous_week_gas", myPce.gasW1Y0)
-                    myMqtt.publish(mySa.histoTopic+"current_week_previous_year-gas", myPce.gasW0Y1)
+                    myOutbox.publish(mySa.histoTopic+"current_week_gas", myPce.gasW0Y0)
+                    myOutbox.publish(mySa.histoTopic+"previous_week_gas", myPce.gasW1Y0)
+                    myOutbox.publish(mySa.histoTopic+"current_week_previous_year-gas", myPce.gasW0Y1)
 
                     ### Day
-                    myMqtt.publish(mySa.histoTopic+"day-1_gas", myPce.gasD1)
-                    myMqtt.publish(mySa.histoTopic+"day-2_gas", myPce.gasD2)
-                    myMqtt.publish(mySa.histoTopic+"day-3_gas", myPce.gasD3)
-                    myMqtt.publish(mySa.histoTopic+"day-4_gas", myPce.gasD4)
-                    myMqtt.publish(mySa.histoTopic+"day-5_gas", myPce.gasD5)
-                    myMqtt.publish(mySa.histoTopic+"day-6_gas", myPce.gasD6)
-                    myMqtt.publish(mySa.histoTopic+"day-7_gas", myPce.gasD7)
+                    myOutbox.publish(mySa.histoTopic+"day-1_gas", myPce.gasD1)
+                    myOutbox.publish(mySa.histoTopic+"day-2_gas", myPce.gasD2)
+                    myOutbox.publish(mySa.histoTopic+"day-3_gas", myPce.gasD3)
+                    myOutbox.publish(mySa.histoTopic+"day-4_gas", myPce.gasD4)
+                    myOutbox.publish(mySa.histoTopic+"day-5_gas", myPce.gasD5)
+                    myOutbox.publish(mySa.histoTopic+"day-6_gas", myPce.gasD6)
+                    myOutbox.publish(mySa.histoTopic+"day-7_gas", myPce.gasD7)
 
                     ## Calculated rolling measures
                     logging.debug("Creation of rolling measures")
 
                     ### Rolling year
-                    myMqtt.publish(mySa.histoTopic+"rolling_year_gas", myPce.gasR1Y)
-                    myMqtt.publish(mySa.histoTopic+"rolling_year_last_year_gas", myPce.gasR2Y1Y)
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_gas", myPce.gasR1Y)
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_last_year_gas", myPce.gasR2Y1Y)
 
                     ### Rolling month
-                    myMqtt.publish(mySa.histoTopic+"rolling_month_gas", myPce.gasR1M)
-                    myMqtt.publish(mySa.histoTopic+"rolling_month_last_month_gas", myPce.gasR2M1M)
-                    myMqtt.publish(mySa.histoTopic+"rolling_month_last_year_gas", myPce.gasR1MY1)
-                    myMqtt.publish(mySa.histoTopic+"rolling_month_last_2_year_gas", myPce.gasR1MY2)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_gas", myPce.gasR1M)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_last_month_gas", myPce.gasR2M1M)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_last_year_gas", myPce.gasR1MY1)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_last_2_year_gas", myPce.gasR1MY2)
 
                     ### Rolling week
-                    myMqtt.publish(mySa.histoTopic+"rolling_week_gas", myPce.gasR1W)
-                    myMqtt.publish(mySa.histoTopic+"rolling_week_last_week_gas", myPce.gasR2W1W)
-                    myMqtt.publish(mySa.histoTopic+"rolling_week_last_year_gas", myPce.gasR1WY1)
-                    myMqtt.publish(mySa.histoTopic+"rolling_week_last_2_year_gas", myPce.gasR1WY2)
+                    myOutbox.publish(mySa.histoTopic+"rolling_week_gas", myPce.gasR1W)
+                    myOutbox.publish(mySa.histoTopic+"rolling_week_last_week_gas", myPce.gasR2W1W)
+                    myOutbox.publish(mySa.histoTopic+"rolling_week_last_year_gas", myPce.gasR1WY1)
+                    myOutbox.publish(mySa.histoTopic+"rolling_week_last_2_year_gas", myPce.gasR1WY2)
+
+                    ### Degree days
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_degree_days", myPce.hddR1Y)
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_last_year_degree_days", myPce.hddR2Y1Y)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_degree_days", myPce.hddR1M)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_last_year_degree_days", myPce.hddR1MY1)
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_energy_per_degree_day", myPce.energyHddR1Y)
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_last_year_energy_per_degree_day", myPce.energyHddR2Y1Y)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_energy_per_degree_day", myPce.energyHddR1M)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_last_year_energy_per_degree_day", myPce.energyHddR1MY1)
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_normalised_energy", myPce.energyNormR1Y)
+                    myOutbox.publish(mySa.histoTopic+"rolling_year_normalised_evolution", myPce.energyNormR1YPct)
+                    myOutbox.publish(mySa.histoTopic+"rolling_month_normalised_evolution", myPce.energyNormR1MPct)
 
                     ### Thresholds, only if existing
                     if myPce.tshM0:
-                        myMqtt.publish(mySa.thresholdTopic+"current_month_threshold", myPce.tshM0)
-                        myMqtt.publish(mySa.thresholdTopic+"current_month_threshold_percentage", myPce.tshM0Pct)
-                        myMqtt.publish(mySa.thresholdTopic+"current_month_threshold_warning", myPce.tshM0Warn)
-                        myMqtt.publish(mySa.thresholdTopic+"previous_month_threshold", myPce.tshM1)
-                        myMqtt.publish(mySa.thresholdTopic+"previous_month_threshold_percentage", myPce.tshM1Pct)
-                        myMqtt.publish(mySa.thresholdTopic+"previous_month_threshold_warning", myPce.tshM1Warn)
+                        myOutbox.publish(mySa.thresholdTopic+"current_month_threshold", myPce.tshM0)
+                        myOutbox.publish(mySa.thresholdTopic+"current_month_threshold_percentage", myPce.tshM0Pct)
+                        myOutbox.publish(mySa.thresholdTopic+"current_month_threshold_warning", myPce.tshM0Warn)
+                        myOutbox.publish(mySa.thresholdTopic+"previous_month_threshold", myPce.tshM1)
+                        myOutbox.publish(mySa.thresholdTopic+"previous_month_threshold_percentage", myPce.tshM1Pct)
+                        myOutbox.publish(mySa.thresholdTopic+"previous_month_threshold_warning", myPce.tshM1Warn)
+
+                    ### Anomaly, only if detected
+                    if myPce.anomalyWarn is not None:
+                        myOutbox.publish(mySa.anomalyTopic+"warning", myPce.anomalyWarn)
+                        myOutbox.publish(mySa.anomalyTopic+"kind", myPce.anomalyKind)
+                        myOutbox.publish(mySa.anomalyTopic+"score", myPce.anomalyScore)
+                        myOutbox.publish(mySa.anomalyTopic+"expected_energy", myPce.anomalyExpected)
+                        myOutbox.publish(mySa.anomalyTopic+"date", myPce.anomalyDate)
+                        myOutbox.publish(mySa.anomalyTopic+"last_anomaly_date", myPce.anomalyLastDate)
 
                     logging.info("All measures published !")
 
                     ## Publish status values
                     logging.info("Publishing to Mqtt status values...")
-                    myMqtt.publish(mySa.statusTopic+"date", dtn)
-                    myMqtt.publish(mySa.statusTopic+"connectivity", "ON")
+                    myOutbox.publish(mySa.statusTopic+"date", dtn)
+                    myOutbox.publish(mySa.statusTopic+"connectivity", "ON")
                     logging.info("Status values published !")
 
                 # Release memory
@@ -497,15 +432,16 @@ def run(myParams):
 
         except:
             logging.error("Standalone mode : unable to publish value to mqtt broker")
+        myMetrics.observe("mqtt_publish", time.monotonic() - startTime, mode="standalone")
 
     ####################################################################################################################
     # STEP 5B : Home Assistant discovery mode
     ####################################################################################################################
-    if myMqtt.isConnected \
-        and myParams.hassDiscovery \
+    if myParams.hassDiscovery \
         and myGrdf.isConnected \
         and myDb.isConnected():
 
+        startTime = time.monotonic()
         try:
 
             logging.info("-----------------------------------------------------------")
@@ -515,9 +451,37 @@ def run(myParams):
             # Create hass instance
             myHass = hass.Hass(myParams.hassPrefix)
 
+            # Load hash of the discovery configs already published
+            configHashList = {}
+            configHashJson = myDb.getConfig(database.HASS_DISCOVERY_KEY)
+            if configHashJson:
+                configHashList = json.loads(configHashJson)
+
+            # Configs are published again when HA restarted or when they are not retained by the broker
+            configForce = not myParams.mqttRetain
+            if myMqtt is not None and myMqtt.getMessage(myParams.hassPrefix + hass.TOPIC_STATUS) == hass.STATUS_ONLINE:
+                logging.info("Home Assistant restart detected, all discovery configs will be published.")
+                configForce = True
+
+            # They are also published again after a while : the broker may have lost its retained messages,
+            # or Home Assistant may have restarted between two runs, its birth message is then missed
+            configDate = myDb.getConfig(database.HASS_DISCOVERY_DATE_KEY)
+            if not configForce and (configDate is None or datetime.datetime.now() - datetime.datetime.strptime(configDate, database.DATABASE_DATETIME_FORMAT)
+                                    > datetime.timedelta(hours=hass.CONFIG_REFRESH_HOURS)):
+                logging.info("Discovery configs not published since %s, all discovery configs will be published.", configDate)
+                configForce = True
+
             # Loop on PCEs
             for myPce in myGrdf.pceList:
 
+                if stage.isStopped():
+                    break
+
+                # Retained values are published again only when they changed, or when Home Assistant restarted
+                if not configForce and not myChangeSet.hasChanged(myPce.pceId):
+                    logging.info("No change for PCE %s, nothing to publish.",myPce.pceId)
+                    continue
+
                 logging.info("Publishing values of PCE %s alias %s...",myPce.pceId,myPce.alias)
                 logging.info("---------------------------------")
 
@@ -589,7 +553,7 @@ def run(myParams):
                     ## List of informative measures
                     attributes = {}
                     logging.debug("Creation of period informative measures entities")
-                    startDate = (datetime.datetime.now() - relativedelta(days=100)).strftime("%Y-%m-%d")
+                    startDate = (datetime.datetime.now() - datetime.timedelta(days=100)).strftime("%Y-%m-%d")
                     endDate = datetime.datetime.now().strftime("%Y-%m-%d")
                     logging.debug("Start %s and End %s",startDate,endDate)     
                     myMeasures = myPce._getMeasuresRange(myDb,myPce,startDate,endDate,gazpar.TYPE_I)
@@ -673,6 +637,19 @@ def run(myParams):
                     myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_week_last_year_gas','rolling week of last year',hass.GAS_TYPE,hass.ST_TT,'m³').setValue(myPce.gasR1WY1)
                     myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_week_last_2_year_gas','rolling week of last 2 years',hass.GAS_TYPE,hass.ST_TT,'m³').setValue(myPce.gasR1WY2)
 
+                    ### Degree days
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_year_degree_days','rolling year degree days',hass.NONE_TYPE,hass.ST_MEAS,'°C.d').setValue(myPce.hddR1Y)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_year_last_year_degree_days','rolling year of last year degree days',hass.NONE_TYPE,hass.ST_MEAS,'°C.d').setValue(myPce.hddR2Y1Y)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_month_degree_days','rolling month degree days',hass.NONE_TYPE,hass.ST_MEAS,'°C.d').setValue(myPce.hddR1M)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_month_last_year_degree_days','rolling month of last year degree days',hass.NONE_TYPE,hass.ST_MEAS,'°C.d').setValue(myPce.hddR1MY1)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_year_energy_per_degree_day','rolling year energy per degree day',hass.NONE_TYPE,hass.ST_MEAS,'kWh/°C.d').setValue(myPce.energyHddR1Y)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_year_last_year_energy_per_degree_day','rolling year of last year energy per degree day',hass.NONE_TYPE,hass.ST_MEAS,'kWh/°C.d').setValue(myPce.energyHddR2Y1Y)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_month_energy_per_degree_day','rolling month energy per degree day',hass.NONE_TYPE,hass.ST_MEAS,'kWh/°C.d').setValue(myPce.energyHddR1M)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_month_last_year_energy_per_degree_day','rolling month of last year energy per degree day',hass.NONE_TYPE,hass.ST_MEAS,'kWh/°C.d').setValue(myPce.energyHddR1MY1)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_year_normalised_energy','rolling year energy at last year weather',hass.ENERGY_TYPE,hass.ST_TT,'kWh').setValue(myPce.energyNormR1Y)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_year_normalised_evolution','rolling year evolution at equal weather',hass.NONE_TYPE,hass.ST_MEAS,'%').setValue(myPce.energyNormR1YPct)
+                    myEntity = hass.Entity(myDevice,hass.SENSOR,'rolling_month_normalised_evolution','rolling month evolution at equal weather',hass.NONE_TYPE,hass.ST_MEAS,'%').setValue(myPce.energyNormR1MPct)
+
                     ### Threshold
                     myEntity = hass.Entity(myDevice,hass.SENSOR,'current_month_threshold','threshold of current month',hass.ENERGY_TYPE,hass.ST_TT,'kWh').setValue(myPce.tshM0)
                     myEntity = hass.Entity(myDevice,hass.SENSOR,'current_month_threshold_percentage','threshold of current month percentage',hass.NONE_TYPE,hass.ST_TT,'%').setValue(myPce.tshM0Pct)
@@ -681,17 +658,36 @@ def run(myParams):
                     myEntity = hass.Entity(myDevice,hass.SENSOR,'previous_month_threshold_percentage','threshold of previous month percentage',hass.NONE_TYPE,hass.ST_MEAS,'%').setValue(myPce.tshM1Pct)
                     myEntity = hass.Entity(myDevice,hass.BINARY,'previous_month_threshold_problem','threshld of previous month problem',hass.PROBLEM_TYPE,None,None).setValue(myPce.tshM1Warn)
 
+                    ### Anomaly
+                    if myPce.anomalyWarn is not None:
+                        myEntity = hass.Entity(myDevice,hass.BINARY,'consumption_anomaly_problem','consumption anomaly problem',hass.PROBLEM_TYPE,None,None).setValue(myPce.anomalyWarn)
+                        myEntity = hass.Entity(myDevice,hass.SENSOR,'consumption_anomaly_kind','consumption anomaly kind',hass.NONE_TYPE,None,None).setValue(myPce.anomalyKind)
+                        myEntity = hass.Entity(myDevice,hass.SENSOR,'consumption_anomaly_score','consumption anomaly score',hass.NONE_TYPE,hass.ST_MEAS,None).setValue(myPce.anomalyScore)
+                        myEntity = hass.Entity(myDevice,hass.SENSOR,'consumption_expected_energy','expected energy of last day',hass.NONE_TYPE,hass.ST_MEAS,'kWh').setValue(myPce.anomalyExpected)
+                        myEntity = hass.Entity(myDevice,hass.SENSOR,'consumption_anomaly_date','consumption anomaly scored day',hass.NONE_TYPE,None,None).setValue(myPce.anomalyDate)
+                        myEntity = hass.Entity(myDevice,hass.SENSOR,'last_consumption_anomaly_date','last consumption anomaly date',hass.NONE_TYPE,None,None).setValue(myPce.anomalyLastDate)
+
                     ## Other
                     logging.debug("Creation of other entities")
                     myEntity = hass.Entity(myDevice,hass.BINARY,'connectivity','connectivity',hass.CONNECTIVITY_TYPE,None,None).setValue('ON')                                      
                                                
-                # Publish config, state (when value not none), attributes (when not none)
+                # Publish config (when changed), state (when value not none), attributes (when not none)
                 logging.info("Publishing devices...")
                 logging.info("You can retrieve published values subscribing topic %s",myDevice.hass.prefix + "/+/" + myDevice.id + "/#")
+                configPayload = myDevice.getConfigPayload(configHashList,configForce)
+                logging.info("%s discovery config(s) changed on %s entities.",len(configPayload),len(myDevice.entityList))
+                for topic,payload in configPayload.items():
+                    myOutbox.publish(topic,payload)
                 for topic,payload in myDevice.getStatePayload().items():
-                    myMqtt.publish(topic,payload)
+                    myOutbox.publish(topic,payload)
                 logging.info("Devices published !")
 
+            # Store hash of the published discovery configs
+            myDb.updateVersion(database.HASS_DISCOVERY_KEY,json.dumps(configHashList))
+            if configForce:
+                myDb.updateVersion(database.HASS_DISCOVERY_DATE_KEY,datetime.datetime.now().strftime(database.DATABASE_DATETIME_FORMAT))
+            myDb.commit()
+
             # Release memory
             del myHass
 
@@ -699,424 +695,901 @@ def run(myParams):
             logging.error("Home Assistant discovery mode : unable to publish value to mqtt broker")
             logging.error("Reason: %s", e)
             logging.debug("Full traceback:", exc_info=True)
+        myMetrics.observe("mqtt_publish", time.monotonic() - startTime, mode="hass_discovery")
             
-    ####################################################################################################################
-    # STEP 4a : Prices
-    ####################################################################################################################
+    # Publish messages stored in outbox during this run
+    if myOutbox.pendingCount and not stage.isStopped():
+        publishedCount = myOutbox.drain()
+        logging.info("%s message(s) of outbox published.",publishedCount)
+        if myOutbox.pendingCount:
+            logging.warning("%s message(s) kept in outbox, they will be published on next run.",myOutbox.pendingCount)
+    myOutbox.commit()
+    myMetrics.gauge("mqtt_outbox_pending", myOutbox.pendingCount)
 
-    logging.info("-----------------------------------------------------------")
-    logging.info("#                    Load prices                          #")
-    logging.info("-----------------------------------------------------------")
+    myDb.close()
+    stage.checkStop()
 
-    # Load data from prices file
-    logging.info("Loading prices from file %s of directory %s", price.FILE_NAME, myParams.pricePath)
-    myPrices = price.Prices(myParams.pricePath, myParams.priceKwhDefault, myParams.priceFixDefault)
-    if len(myPrices.pricesList):
-        logging.info("%s range(s) of prices found !", len(myPrices.pricesList))
-        
-    ####################################################################################################################
-    # STEP 4b : Prices
-    ####################################################################################################################
 
-    logging.info("-----------------------------------------------------------")
-    logging.info("#                    Write prices                         #")
-    logging.info("-----------------------------------------------------------")
-    if myGrdf.isConnected \
-        and myDb.isConnected() :
+# Stage to import measures into Home Assistant Long Term Statistics
+def _runLtsStage(myParams,myGrdf,myChangeSet,mySnapshot,myMetrics):
 
-        try:
+    from hass_ws import HomeAssistantWs
 
-            cursor = myDb.isConnected()
+    rejectedCount = 0
+    try: 
+        logging.info("-----------------------------------------------------------")
+        logging.info("#   Home assistant Long Term Statistics (WebService)      #")
+        logging.info("-----------------------------------------------------------")
 
-            # Loop on PCEs
-            for myPce in myGrdf.pceList:   
-        
-                myPcePrices = myPrices.getPricesByPce(myPce.pceId)
-                if myPcePrices:
-                    # Loop on prices of the PCE and write the current price
-                    for myPrice in myPcePrices:
-                        #informative / daily values
-                        query = f"UPDATE measures SET price= ( energyGrossConsumed * {myPrice.kwhPrice} ) + {myPrice.fixPrice} where pce = '{myPce.pceId}' and type = '{gazpar.TYPE_I}' and date between '{myPrice.startDate}' and '{myPrice.endDate}'"
-                        logging.debug("Query_I: %s", query )
-                        cursor.execute(query) 
-                        myDb.commit()
-
-                        #published / periodic values
-                        query = f"UPDATE measures SET price= ( energyGrossConsumed * {myPrice.kwhPrice} ) + ((JulianDay(periodEnd) - JulianDay(periodStart)) * {myPrice.fixPrice}) where pce = '{myPce.pceId}' and type = '{gazpar.TYPE_P}' and date between '{myPrice.startDate}' and '{myPrice.endDate}'"
-                        logging.debug("Query_P: %s", query )
-                        
-                        cursor.execute(query) 
-
-                        myDb.commit()
+        ssl_data= {
+                "gateway": myParams.hassSslGateway,
+                "certfile": myParams.hassSslCertfile,
+                "keyfile": myParams.hassSslKeyfile
+                }    
 
-                else:
-                    logging.warning("No prices file found, using the default price (%s €/kWh and %s €/day).", myParams.priceKwhDefault, myParams.priceFixDefault)
-                    
-                    cursor.execute(f"SELECT pce, type, date, energy, price FROM measures")
-                    data = cursor.fetchall()
-                    
-                    for x in data:
-                        try: 
-                            cursor.execute(f"UPDATE measures SET price= ( energyGrossConsumed * {myParams.priceKwhDefault} ) + {myParams.priceFixDefault}") 
-                            myDb.commit()
-                        except Exception as e:
-                            logging.error("Writing Prices with default values, error: %s", e)  
-                    
-                        
-        except Exception as e:
-            logging.error("Home Assistant Prices error: %s", e)
-            
-            
-    ####################################################################################################################
-    # STEP 5C : Home Assistant Long Term statistics
-    ####################################################################################################################
-    if myParams.hassLts \
-        and myGrdf.isConnected \
-        and not myParams.hassLtsDelete :
-        
-        try: 
+        # Open a single Home Assistant session for all the imports
+        myWs = HomeAssistantWs(myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken,
+                               myParams.hassLtsChunkSize, myParams.hassLtsPipeline)
+        if not myWs.connected:
+            raise RuntimeError("Connection to Websocket Home Assistant failed")
+
+        # Loop on PCEs
+        for myPce in mySnapshot.getPceList():
+
+            if stage.isStopped():
+                break
+
+            # Statistics are imported again only when the measures or the prices of the PCE changed
+            if not myChangeSet.hasDataChanged(myPce.pceId):
+                logging.info("No change for PCE %s, statistics are up to date.", myPce.pceId)
+                continue
+            logging.info("Writing webservice information of PCE %s alias %s...", myPce.pceId, myPce.alias)
+
+            for suffix, unit, unitClass, measureType, attribute in LTS_SENSORS:
+
+                sensorName = _getLtsSensorName(myParams.hassDeviceName, myPce.alias, suffix)
+                measureList = sorted([myMeasure for myMeasure in myPce.measureList if myMeasure.type == measureType], key=lambda myMeasure: myMeasure.date)
+                if not measureList:
+                    continue
+
+                # Resume from the last statistic known by Home Assistant before the correction window
+                baseSum = 0
+                if myParams.hassLtsIncremental:
+                    firstDate = measureList[0].date.replace(tzinfo=dt.timezone.utc)
+                    cutoffDate = (measureList[-1].date - datetime.timedelta(days=myParams.hassLtsCorrectionDays)).replace(tzinfo=dt.timezone.utc)
+                    lastStat = myWs.get_last_statistic(sensorName.lower(), firstDate, cutoffDate)
+                    if lastStat is not None:
+                        lastDate, baseSum = lastStat
+                        measureList = [myMeasure for myMeasure in measureList if myMeasure.date.replace(tzinfo=dt.timezone.utc) > lastDate]
+                        logging.debug("Statistic %s known by Home Assistant until %s with sum %s", sensorName, lastDate, baseSum)
+
+                logging.debug(f"Writing Websocket Home Assistant LTS for PCE: {myPce.pceId}, sensor name: {sensorName}, {len(measureList)} statistic(s)")
+                if measureList:
+                    myWs.import_data(myPce.pceId, sensorName, unit, unitClass, _getLtsStats(measureList, attribute, baseSum))
+                    myMetrics.count("hass_lts_statistics", len(measureList))
+
+            # Send the imports of the PCE, a rejected import fails the stage so that the next run imports it again
+            rejectedCount += sum(1 for output in myWs.flush() if not output.get("success", True))
+
+        # Close Home Assistant session
+        myWs.close()
+       
+    except Exception as e:
+        logging.error("Home Assistant Long Term Statistics : unable to publish LTS to Webservice HA with error: %s", e)
+        logging.error("Retrying with API") 
+                
+        try:
             logging.info("-----------------------------------------------------------")
-            logging.info("#   Home assistant Long Term Statistics (WebService)      #")
+            logging.info("#      Home assistant Long Term Statistics (API)          #")
             logging.info("-----------------------------------------------------------")
 
-            # Load database in cache
-            myDb.load()
-
             data = {}
             data_pub = {}
-            ssl_data= {
-                    "gateway": myParams.hassSslGateway,
-                    "certfile": myParams.hassSslCertfile,
-                    "keyfile": myParams.hassSslKeyfile
-                    }    
             # Loop on PCEs
-            for myPce in myDb.pceList:
-                logging.info("Writing webservice information of PCE %s alias %s...", myPce.pceId, myPce.alias)
-
+            for myPce in mySnapshot.getPceList():
+                logging.info("Writing api information of PCE %s alias %s...", myPce.pceId, myPce.alias)
+                sensor_name = _getLtsSensorName(myParams.hassDeviceName, myPce.alias, '_consumption_stat')
+                sensor_name_pub = _getLtsSensorName(myParams.hassDeviceName, myPce.alias, '_consumption_pub_stat')
                 stats_array = []
-                stats_array_kwh = []
-                stats_array_cost = []
                 stats_array_pub = []
-                stats_array_kwh_pub = []
-                stats_array_pub_cost = []
-                prev_stat_sum = 0
-                prev_stat_kwh_sum = 0
-                prev_stat_pub_sum = 0
-                prev_stat_kwh_pub_sum = 0
-                prev_price_sum = 0
-                prev_price_pub_sum = 0
                 for myMeasure in myPce.measureList:
                     date_with_timezone = myMeasure.date.replace(tzinfo=dt.timezone.utc)
                     date_formatted = date_with_timezone.strftime(
                         "%Y-%m-%dT%H:%M:%S%z"
                     )
-                    if myMeasure.type == gazpar.TYPE_I :
-                        stat = {
-                            "start": date_formatted,  # formatted date
-                            "state": myMeasure.volumeGross,
-                            "sum": prev_stat_sum + myMeasure.volumeGross,
-                        }
-                        stat_kwh = {
-                            "start": date_formatted,  # formatted date
-                            "state": myMeasure.energyGross,
-                            "sum": prev_stat_kwh_sum + myMeasure.energyGross,
-                        }                        
-                        stat_cost = {
-                            "start": date_formatted,  # formatted date
-                            "state": myMeasure.price,
-                            "sum": prev_price_sum + myMeasure.price,
-                        }
+                    stat = {
+                        "start": date_formatted,  # formatted date
+                        "state": myMeasure.volumeGross,
+                        "sum": myMeasure.endIndex,
+                    }
+                    # Add the stat to the array
+                    if myMeasure.type == 'informative':
                         stats_array.append(stat)
-                        stats_array_kwh.append(stat_kwh)                    
-                        stats_array_cost.append(stat_cost)
-                        prev_stat_sum = prev_stat_sum + myMeasure.volumeGross
-                        prev_stat_kwh_sum = prev_stat_kwh_sum + myMeasure.energyGross
-                        prev_price_sum =  prev_price_sum + myMeasure.price                
                     else:
-                        stat_pub = {
-                            "start": date_formatted,  # formatted date
-                            "state": myMeasure.volumeGross,
-                            "sum": prev_stat_pub_sum + myMeasure.volumeGross,
-                        }   
-                        stat_kwh_pub = {
-                            "start": date_formatted,  # formatted date
-                            "state": myMeasure.energyGross,
-                            "sum": prev_stat_kwh_pub_sum + myMeasure.energyGross,
-                        }                       
-                        stat_cost_pub = {
-                            "start": date_formatted,  # formatted date
-                            "state": myMeasure.price,
-                            "sum": prev_price_pub_sum + myMeasure.price,
-                        }
-                        stats_array_pub.append(stat_pub)
-                        stats_array_kwh_pub.append(stat_kwh_pub)                    
-                        stats_array_pub_cost.append(stat_cost_pub)
-                        prev_stat_pub_sum = prev_stat_pub_sum + myMeasure.volumeGross
-                        prev_stat_kwh_pub_sum = prev_stat_kwh_pub_sum + myMeasure.energyGross
-                        prev_price_pub_sum = prev_price_pub_sum + myMeasure.price
-                    
-                
-                sensor_name = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_stat'
-                sensor_name_kwh = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_kwh_stat'
-                sensor_name_pub = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_pub_stat'
-                sensor_name_kwh_pub = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_kwh_pub_stat'
-                sensor_name_cost = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_cost_stat'
-                sensor_name_cost_pub = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_pub_cost_stat'                
+                        stats_array_pub.append(stat)
                 
-                logging.debug(f"Writing Websocket Home Assistant LTS for PCE: {myPce.pceId}, sensor name: {sensor_name}")
-                HomeAssistantWs("import", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name, 'm³', 'volume', stats_array)
-                HomeAssistantWs("import", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_kwh, 'kWh', 'energy', stats_array_kwh)
-                HomeAssistantWs("import", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_cost, 'EUR', None, stats_array_cost)
+                data = {
+                    "has_mean": False,
+                    "has_sum": True,
+                    "statistic_id": (
+                        sensor_name
+                            ),
+                    "unit_of_measurement": "m³",
+                    "source": "recorder",
+                    "stats": stats_array,
+                }
+                data_pub = {
+                    "has_mean": False,
+                    "has_sum": True,
+                    "statistic_id": (
+                        sensor_name_pub
+                            ),
+                    "unit_of_measurement": "m³",
+                    "source": "recorder",
+                    "stats": stats_array_pub,
+                }
                 
-                logging.debug(f"Writing Websocket Home Assistant Published LTS for PCE: {myPce.pceId}, sensor name: {sensor_name_pub}")
-                HomeAssistantWs("import", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_pub, 'm³', 'volume', stats_array_pub)
-                HomeAssistantWs("import", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_kwh_pub, 'kWh', 'energy', stats_array_kwh_pub)
-                HomeAssistantWs("import", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_cost_pub, 'EUR', None, stats_array_pub_cost)                
-           
-        except Exception as e:
-            logging.error("Home Assistant Long Term Statistics : unable to publish LTS to Webservice HA with error: %s", e)
-            logging.error("Retrying with API") 
-                    
-            try:
-                logging.info("-----------------------------------------------------------")
-                logging.info("#      Home assistant Long Term Statistics (API)          #")
-                logging.info("-----------------------------------------------------------")
-
-                # Load database in cache
-                myDb.load()
-                data = {}
-                data_pub = {}
-                # Loop on PCEs
-                for myPce in myDb.pceList:
-                    logging.info("Writing api information of PCE %s alias %s...", myPce.pceId, myPce.alias)
-                    sensor_name = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_stat'
-                    sensor_name_pub = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_pub_stat'
-                    stats_array = []
-                    stats_array_pub = []
-                    for myMeasure in myPce.measureList:
-                        date_with_timezone = myMeasure.date.replace(tzinfo=dt.timezone.utc)
-                        date_formatted = date_with_timezone.strftime(
-                            "%Y-%m-%dT%H:%M:%S%z"
-                        )
-                        stat = {
-                            "start": date_formatted,  # formatted date
-                            "state": myMeasure.volumeGross,
-                            "sum": myMeasure.endIndex,
-                        }
-                        # Add the stat to the array
-                        if myMeasure.type == 'informative':
-                            stats_array.append(stat)
-                        else:
-                            stats_array_pub.append(stat)
-                    
-                    data = {
-                        "has_mean": False,
-                        "has_sum": True,
-                        "statistic_id": (
-                            sensor_name
-                                ),
-                        "unit_of_measurement": "m³",
-                        "source": "recorder",
-                        "stats": stats_array,
-                    }
-                    data_pub = {
-                        "has_mean": False,
-                        "has_sum": True,
-                        "statistic_id": (
-                            sensor_name_pub
-                                ),
-                        "unit_of_measurement": "m³",
-                        "source": "recorder",
-                        "stats": stats_array_pub,
-                    }
-                    
-                logging.debug(f"Writing HA LTS for PCE: {myPce.pceId}, sensor name: {sensor_name}, data: {data}")
-                myGrdf.open_url(myParams.hassHost, myParams.hassStatisticsUri, myParams.hassToken, data)
-                logging.debug(f"Writing HA LTS Published for PCE: {myPce.pceId}, sensor name: {sensor_name_pub}, data: {data_pub}")
-                myGrdf.open_url(myParams.hassHost, myParams.hassStatisticsUri, myParams.hassToken, data_pub)
-            
-            except Exception as e:
-                logging.error("Home Assistant Long Term Statistics : unable to publish LTS to HA with error: %s", e)            
+            logging.debug(f"Writing HA LTS for PCE: {myPce.pceId}, sensor name: {sensor_name}, data: {data}")
+            myGrdf.open_url(myParams.hassHost, myParams.hassStatisticsUri, myParams.hassToken, data)
+            logging.debug(f"Writing HA LTS Published for PCE: {myPce.pceId}, sensor name: {sensor_name_pub}, data: {data_pub}")
+            myGrdf.open_url(myParams.hassHost, myParams.hassStatisticsUri, myParams.hassToken, data_pub)
         
+        except Exception as e:
+            logging.error("Home Assistant Long Term Statistics : unable to publish LTS to HA with error: %s", e)            
+            raise
 
-    ####################################################################################################################
-    # STEP 5D : Delete Home Assistant Long Term statistics
-    ####################################################################################################################
-    if myParams.hassLtsDelete :
-        
-        try: 
-            logging.info("------------------------------------------------------------------")
-            logging.info("#   Delete Home assistant Long Term Statistics (WebService)      #")
-            logging.info("------------------------------------------------------------------")
-            
-            # Load database in cache
-            myDb.load()
-            
-            ssl_data= {
-                    "gateway": myParams.hassSslGateway,
-                    "certfile": myParams.hassSslCertfile,
-                    "keyfile": myParams.hassSslKeyfile
-                    }  
-            # Loop on PCEs
-            for myPce in myDb.pceList:
-                sensor_name = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_stat'
-                sensor_name_kwh = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_kwh_stat'
-                sensor_name_pub = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_pub_stat'
-                sensor_name_kwh_pub = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_kwh_pub_stat'
-                sensor_name_cost = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_cost_stat'
-                sensor_name_cost_pub = 'gazpar:' + myParams.hassDeviceName + '_' + myPce.alias.lower().strip().replace(" ", "_") + '_consumption_pub_cost_stat'                  
-                logging.debug(f"Deleting Home Assistant LTS for PCE: {myPce.pceId}, sensor name: {sensor_name}")
-                HomeAssistantWs("delete", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name, None, None, None)
-                HomeAssistantWs("delete", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_kwh, None, None, None)
-                HomeAssistantWs("delete", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_cost, None, None, None)      
-                logging.debug(f"Deleting Home Assistant Published LTS for PCE: {myPce.pceId}, sensor name: {sensor_name_pub}")
-                HomeAssistantWs("delete", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_pub, None, None, None) 
-                HomeAssistantWs("delete", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_kwh_pub, None, None, None)
-                HomeAssistantWs("delete", myPce.pceId, myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken, sensor_name_cost_pub, None, None, None)                  
+    stage.checkStop()
+    if rejectedCount:
+        raise RuntimeError(f"{rejectedCount} statistics import(s) rejected by Home Assistant")
 
-            
-        except Exception as e:
-                logging.error("Home Assistant Long Term Statistics : unable to delete LTS with error: %s", e)               
-                
 
-    ####################################################################################################################
-    # STEP 6 : Disconnect mqtt broker
-    ####################################################################################################################
-    if myMqtt.isConnected:
+# Stage to delete Home Assistant Long Term Statistics
+def _runLtsDeleteStage(myParams):
 
-        logging.info("-----------------------------------------------------------")
-        logging.info("#               Disconnection from MQTT                    #")
-        logging.info("-----------------------------------------------------------")
+    from hass_ws import HomeAssistantWs
+    myDb = _openStageDb(myParams)
+    
+    try: 
+        logging.info("------------------------------------------------------------------")
+        logging.info("#   Delete Home assistant Long Term Statistics (WebService)      #")
+        logging.info("------------------------------------------------------------------")
+        
+        ssl_data= {
+                "gateway": myParams.hassSslGateway,
+                "certfile": myParams.hassSslCertfile,
+                "keyfile": myParams.hassSslKeyfile
+                }  
+        # Open a single Home Assistant session for all the deletions
+        myWs = HomeAssistantWs(myParams.hassHost.split('//')[1], myParams.hassSsl, ssl_data, myParams.hassToken)
+        if not myWs.connected:
+            raise RuntimeError("Connection to Websocket Home Assistant failed")
 
-        try:
-            myMqtt.disconnect()
-            logging.info("Mqtt broker disconnected")
-        except:
-            logging.error("Unable to disconnect mqtt broker")
-            sys.exit(1)
+        # Loop on PCEs
+        statisticIdList = []
+        for myPce in myDb.iterPce(False):
+            logging.debug(f"Deleting Home Assistant LTS for PCE: {myPce.pceId}")
+            for suffix, unit, unitClass, measureType, attribute in LTS_SENSORS:
+                statisticIdList.append(_getLtsSensorName(myParams.hassDeviceName, myPce.alias, suffix).lower())
 
-    # Release memory
-    del myMqtt
-    del myGrdf
+        # Delete the statistics existing in Home Assistant
+        currentStatisticIdList = myWs.list_data(statisticIdList)
+        logging.debug("Deleting current statistics: %s", currentStatisticIdList)
+        if currentStatisticIdList:
+            myWs.clear_data(currentStatisticIdList)
 
+        # Close Home Assistant session
+        myWs.close()
 
-    ####################################################################################################################
-    # STEP 7 : Influxdb
-    ####################################################################################################################
-    if myParams.influxEnable:
+        
+    except Exception as e:
+            logging.error("Home Assistant Long Term Statistics : unable to delete LTS with error: %s", e)               
 
-        logging.info("-----------------------------------------------------------")
-        logging.info("#            Write to Influxdb v2                         #")
-        logging.info("-----------------------------------------------------------")
+    myDb.close()
 
-        # Check Influxdb version
-        influxDbVersion = myDb.getConfig(database.INFLUX_KEY)
-        if influxDbVersion == G2M_INFLUXDB_VERSION:
-            logging.info("Your influxdb version is up to date %s",G2M_INFLUXDB_VERSION)
-        else:
-            logging.warning("Influxdb version (%s) is not up to date %s", influxDbVersion, G2M_INFLUXDB_VERSION)
-            logging.warning("Inconsistencies data could be performed. You should recreate the bucket to delete old data.")
-            # Update version
-            myDb.updateVersion(database.INFLUX_KEY,G2M_INFLUXDB_VERSION)
-            myDb.commit()
 
-        myInflux = influxdb.InfluxDb('v2')
-        myInflux.connect(myParams.influxHost, myParams.influxPort, myParams.influxOrg, myParams.influxBucket, myParams.influxToken )
+# Stage to write measures to Influxdb
+def _runInfluxStage(myParams,myGrdf,myPrices,mySnapshot,myMetrics):
 
-        logging.info("Bucket %s.",myParams.influxBucket)
+    import influxdb
+    myDb = _openStageDb(myParams)
 
-        # Load database in cache
-        myDb.load()
+    logging.info("-----------------------------------------------------------")
+    logging.info("#            Write to Influxdb v2                         #")
+    logging.info("-----------------------------------------------------------")
 
-        # Loop on PCEs
-        for myPce in myDb.pceList:
+    # Check Influxdb version
+    influxDbVersion = myDb.getConfig(database.INFLUX_KEY)
+    if influxDbVersion == G2M_INFLUXDB_VERSION:
+        logging.info("Your influxdb version is up to date %s",G2M_INFLUXDB_VERSION)
+    else:
+        logging.warning("Influxdb version (%s) is not up to date %s", influxDbVersion, G2M_INFLUXDB_VERSION)
+        logging.warning("Inconsistencies data could be performed. You should recreate the bucket to delete old data.")
+        # Update version
+        myDb.updateVersion(database.INFLUX_KEY,G2M_INFLUXDB_VERSION)
+        myDb.commit()
 
-            # Sub-step A : Write PCE informations
-            logging.info("Writing informations of PCE %s alias %s...", myPce.pceId, myPce.alias)
-            point = myInflux.setPcePoint(myPce)
-            if not myInflux.write(point):
-                logging.warning("Unable to write informations of the PCE.")
-            else:
-                logging.info("Informations of PCE written successfully !")
-
-            # Sub-step B : Write current price of the PCE
-            logging.info("Writing prices of PCE %s alias %s...", myPce.pceId, myPce.alias)
-            myPcePrices = myPrices.getPricesByPce(myPce.pceId)
-            if myPcePrices:
-                # Loop on prices of the PCE and write the current price
-                errorCount = 0
-                writeCount = 0
-                for myPrice in myPcePrices:
-                    myDate = datetime.date.today()
-                    if myDate >= myPrice.startDate and myDate <= myPrice.endDate:
-                        # Set point
-                        point = myInflux.setPricePoint(myPce,myPrice,False,None,None)
-                        # Write
-                        if not myInflux.write(point):
-                            logging.error("Unable to write price !")
-                        else:
-                            writeCount += 1
-                logging.info("%s price(s) written successfully !",writeCount)
-            else:
-                logging.warning("No prices found, use of the default price (%s €/kWh and %s €/day).", myParams.priceKwhDefault, myParams.priceFixDefault)
-                point = myInflux.setPricePoint(myPce, None, True, myPrices.defaultKwhPrice,myPrices.defaultFixPrice)
-                if not myInflux.write(point):
-                    logging.error("Unable to write price !")
-                else:
-                    logging.info("Default price written successfully !")
+    myInflux = influxdb.InfluxDb('v2')
+    myInflux.connect(myParams.influxHost, myParams.influxPort, myParams.influxOrg, myParams.influxBucket, myParams.influxToken,
+                     myParams.influxBatchSize, myParams.influxFlushInterval, myParams.influxGzip,
+                     myParams.influxMaxRetries, myParams.influxRetryInterval, myParams.influxJitterInterval,
+                     myParams.influxMaxError)
 
+    logging.info("Bucket %s.",myParams.influxBucket)
 
-            # Sub-step B : Write measures of the PCE
-            logging.info("Writing measures of PCE %s alias %s...", myPce.pceId, myPce.alias)
-            errorCount = 0
-            writeCount = 0
-            for myMeasure in myPce.measureList:
-                if myMeasure.type == gazpar.TYPE_I:
+    # Set the oldest date exported
+    horizonDate = None
+    if myParams.influxHorizon:
+        horizonDate = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=myParams.influxHorizon), datetime.time())
+        logging.info("Export limited to the last %s days (from %s).", myParams.influxHorizon, horizonDate.date())
 
-                    # Set point
-                    point = myInflux.setMeasurePoint(myMeasure,myPrices)
+    # Watermarks are stored once all points are written
+    watermarkList = []
+
+    # KPIs are calculated on the PCEs retrieved from GRDF, before the stages start
+    kpiPceList = {}
+    if myGrdf is not None and myGrdf.isConnected:
+        kpiPceList = {myPce.pceId: myPce for myPce in myGrdf.pceList if myPce.isCalculated}
+
+    # Loop on PCEs
+    for myPce in mySnapshot.getPceList():
 
+        # A stopped stage keeps the watermarks of the PCEs already written
+        if stage.isStopped():
+            break
+
+        # Sub-step A : Write PCE informations
+        logging.info("Writing informations of PCE %s alias %s...", myPce.pceId, myPce.alias)
+        point = myInflux.setPcePoint(myPce)
+        if not myInflux.write(point):
+            logging.warning("Unable to write informations of the PCE.")
+        else:
+            logging.info("Informations of PCE sent to influxdb !")
+
+        # Sub-step B : Write current price of the PCE
+        logging.info("Writing prices of PCE %s alias %s...", myPce.pceId, myPce.alias)
+        myPcePrices = myPrices.getPricesByPce(myPce.pceId)
+        if myPcePrices:
+            # Loop on prices of the PCE and write the current price
+            writeCount = 0
+            for myPrice in myPcePrices:
+                myDate = datetime.date.today()
+                if myDate >= myPrice.startDate and myDate <= myPrice.endDate:
+                    # Set point
+                    point = myInflux.setPricePoint(myPce,myPrice,False,None,None)
                     # Write
                     if not myInflux.write(point):
-                        errorCount += 1
+                        logging.error("Unable to write price !")
                     else:
                         writeCount += 1
+            logging.info("%s price(s) sent to influxdb !",writeCount)
+        else:
+            logging.warning("No prices found, use of the default price (%s €/kWh and %s €/day).", myParams.priceKwhDefault, myParams.priceFixDefault)
+            point = myInflux.setPricePoint(myPce, None, True, myPrices.defaultKwhPrice,myPrices.defaultFixPrice)
+            if not myInflux.write(point):
+                logging.error("Unable to write price !")
+            else:
+                logging.info("Default price sent to influxdb !")
+
+
+        # Sub-step B : Write measures of the PCE
+        logging.info("Writing measures of PCE %s alias %s...", myPce.pceId, myPce.alias)
+        measureList = [myMeasure for myMeasure in myPce.measureList if myMeasure.type == gazpar.TYPE_I]
+        exportList, watermark = influxdb.getExportList(measureList,
+                                                       lambda myMeasure: myInflux.getMeasureValues(myMeasure,myPrices),
+                                                       myDb.getInfluxWatermark(myPce.pceId, gazpar.TYPE_I),
+                                                       horizonDate)
+        watermarkList.append((myPce.pceId, gazpar.TYPE_I, watermark))
+        logging.info("%s new or changed measure(s) since last export.", len(exportList))
+        pointList = [myInflux.setMeasurePoint(myMeasure,myPrices) for myMeasure in exportList]
+        if not myInflux.write(pointList):
+            logging.warning("Unable to write measures of the PCE.")
+        else:
+            logging.info("%s measure(s) of PCE sent to influxdb !",len(pointList))
+
+
+        # Sub-step C : Write thresholds of the PCE
+        logging.info("Writing thresholds of PCE %s alias %s...", myPce.pceId, myPce.alias)
+        exportList, watermark = influxdb.getExportList(myPce.thresholdList,
+                                                       myInflux.getThresholdValues,
+                                                       myDb.getInfluxWatermark(myPce.pceId, THRESHOLD_KEY),
+                                                       horizonDate)
+        watermarkList.append((myPce.pceId, THRESHOLD_KEY, watermark))
+        pointList = [myInflux.setThresholdPoint(myThreshold) for myThreshold in exportList]
+        if not myInflux.write(pointList):
+            logging.warning("Unable to write thresholds of the PCE.")
+        else:
+            logging.info("%s threshold(s) of PCE sent to influxdb !",len(pointList))
+
+
+        # Sub-step D : Write measures aggregated by day, week, month and year
+        logging.info("Writing aggregated measures of PCE %s alias %s...", myPce.pceId, myPce.alias)
+        aggregateList = myInflux.getAggregateList(measureList,myPrices)
+        pointList = []
+        for period in influxdb.AGGREGATE_PERIODS:
+            watermarkKey = f"{AGGREGATE_KEY}_{period}"
+            # The horizon applies to the period containing it, so current periods are always updated
+            periodHorizonDate = influxdb.getPeriodStart(horizonDate,period) if horizonDate else None
+            exportList, watermark = influxdb.getExportList(aggregateList[period],
+                                                           myInflux.getAggregateValues,
+                                                           myDb.getInfluxWatermark(myPce.pceId, watermarkKey),
+                                                           periodHorizonDate)
+            watermarkList.append((myPce.pceId, watermarkKey, watermark))
+            pointList.extend(myInflux.setAggregatePoint(myAggregate) for myAggregate in exportList)
+        if not myInflux.write(pointList):
+            logging.warning("Unable to write aggregated measures of the PCE.")
+        else:
+            logging.info("%s aggregated measure(s) of PCE sent to influxdb !",len(pointList))
 
-                    # Check number of error
-                    if errorCount > influxdb.WRITE_MAX_ERROR:
-                        logging.warning("Writing stopped because of too many errors.")
-                        break
-            logging.info("%s measure(s) of PCE written successfully !",writeCount)
 
+        # Sub-step E : Write KPIs calculated for the PCE
+        if myPce.pceId in kpiPceList:
+            point = myInflux.setKpiPoint(myPce,kpiPceList[myPce.pceId])
+            if point is None:
+                logging.info("No KPI calculated for the PCE.")
+            elif not myInflux.write(point):
+                logging.warning("Unable to write KPIs of the PCE.")
+            else:
+                logging.info("KPIs of PCE sent to influxdb !")
+
+    # Disconnect
+    logging.info("Disconnection of influxdb...")
+    myInflux.close()
+    logging.info("Influxdb disconnected.")
+    myMetrics.count("influx_points_written", myInflux.writeCount)
+    myMetrics.count("influx_points_error", myInflux.errorCount)
+    myMetrics.count("influx_retries", myInflux.retryCount)
+
+    # Store watermarks when everything has been written
+    errorCount = myInflux.errorCount
+    if errorCount == 0:
+        for pceId, type, watermark in watermarkList:
+            myDb.setInfluxWatermark(pceId, type, watermark)
+        myDb.commit()
+    else:
+        logging.warning("Some points were not written, they will be exported again on next run.")
 
-            # Sub-step C : Write thresholds of the PCE
-            logging.info("Writing thresholds of PCE %s alias %s...", myPce.pceId, myPce.alias)
-            errorCount = 0
-            writeCount = 0
-            for myThreshold in myPce.thresholdList:
+    # Release memory
+    del myInflux
+
+    myDb.close()
+    stage.checkStop()
+    if errorCount:
+        raise RuntimeError(f"{errorCount} point(s) not written to InfluxDB")
+
+
+# Stage to export measures, thresholds and prices to Parquet or Arrow IPC files
+def _runExportStage(myParams,myChangeSet,myPrices,mySnapshot,myMetrics):
+
+    import export
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#            Export to columnar files                     #")
+    logging.info("-----------------------------------------------------------")
+
+    exportPath = myParams.exportPath or os.path.join(myParams.dbPath, "export")
+    logging.info("Export directory %s.", exportPath)
+    myExporter = export.Exporter(exportPath, myParams.exportFormat)
+
+    # The first export writes the whole history, the next ones the partitions which changed
+    if myExporter.manifest and not myChangeSet.hasDataChanged():
+        logging.info("No new data, columnar export skipped.")
+        return
+    for myPce in mySnapshot.getPceList():
+        if stage.isStopped():
+            break
+        myExporter.writePce(myPce, myPrices)
+    myExporter.save()
+    myMetrics.count("export_partitions_written", myExporter.writeCount)
+    stage.checkStop()
+
+
+########################################################################################################################
+#### Running program
+########################################################################################################################
+def run(myParams,myExporter=None,mySharedMqtt=None):
+
+    myMqtt = None
+    myGrdf = None
+
+    # Store time now
+    dtn = _dateTimeToStr(datetime.datetime.now())
+
+    # Instrumentation of the run
+    myMetrics = metrics.Metrics(myParams.metricsEnable or myExporter is not None, myParams.metricsProfile, myParams.metricsTraceMemory)
+    myMetrics.startStage("database")
+
+
+    # STEP 1 : Connect to database
+    ####################################################################################################################
+    logging.info("-----------------------------------------------------------")
+    logging.info("#        Connection to SQLite database                     #")
+    logging.info("-----------------------------------------------------------")
+
+    # Create/Update database
+    logging.info("Connection to SQLite database...")
+    myDb = database.Database(myParams.dbPath, myParams.snapshotEnable)
+
+
+    # Connect to database
+    myDb.connect(G2M_VERSION,G2M_DB_VERSION,G2M_INFLUXDB_VERSION)
+    if myDb.isConnected() :
+        logging.info("SQLite database connected !")
+    else:
+        logging.error("Unable to connect to SQLite database.")
+
+    # Check program version
+    g2mVersion = myDb.getConfig(database.G2M_KEY)
+    g2mDate = myDb.getConfig(database.LAST_EXEC_KEY)
+    logging.info("Last execution date %s, program was in version %s.",g2mDate,g2mVersion)
+    if g2mVersion != G2M_VERSION:
+        logging.warning("gazpar2mqtt version (%s) has changed since last execution (%s)",G2M_VERSION,g2mVersion)
+        # Update program version
+        myDb.updateVersion(database.G2M_KEY,G2M_VERSION)
+        myDb.commit()
+
+
+    # Reinit database when required :
+    if myParams.dbInit:
+        logging.info("Reinitialization of the database...")
+        myDb.reInit(G2M_VERSION,G2M_DB_VERSION,G2M_INFLUXDB_VERSION)
+        logging.info("Database reinitialized to version %s",G2M_DB_VERSION)
+    else:
+        # Compare dabase version
+        logging.info("Checking database version...")
+        dbVersion = myDb.getConfig(database.DB_KEY)
+        if dbVersion == G2M_DB_VERSION:
+            logging.info("Your database is already up to date : version %s.",G2M_DB_VERSION)
+
+            # Display current database statistics
+            logging.info("Retrieve database statistics...")
+            dbStats = myDb.getMeasuresCount(gazpar.TYPE_I)
+            logging.info("%s informatives measures stored", dbStats["rows"])
+            logging.info("%s PCE(s)", dbStats["pce"])
+            logging.info("First measure : %s", dbStats["minDate"])
+            logging.info("Last measure : %s", dbStats["maxDate"])
+
+        else:
+            logging.warning("Your database (version %s) is not up to date.",dbVersion)
+            logging.info("Reinitialization of your database to version %s...",G2M_DB_VERSION)
+            myDb.reInit(G2M_VERSION,G2M_DB_VERSION,G2M_INFLUXDB_VERSION)
+            dbVersion = myDb.getConfig(database.DB_KEY)
+            logging.info("Database reinitialized to version %s !",dbVersion)
+
+    # Change set of the run : everything is processed again after a reinitialization or a run which did not succeed
+    myChangeSet = changeset.ChangeSet(myDb.getConfig(database.RUN_STATUS_KEY) != stage.STATUS_OK)
+    myChangeSet.dayChanged = myDb.getConfig(database.CALCULATION_DATE_KEY) != datetime.date.today().isoformat()
+    myDb.updateVersion(database.RUN_STATUS_KEY, stage.STATUS_PENDING)
+    previousRun = myDb.getConfig(database.LAST_RUN_KEY)
+    previousRun = datetime.datetime.fromisoformat(previousRun) if previousRun else None
+    myDb.updateVersion(database.LAST_RUN_KEY, datetime.datetime.now().isoformat(" "))
+    myDb.commit()
+    myMetrics.endStage("database")
+
+
+    # STEP 2 : Log to MQTT broker
+    ####################################################################################################################
+    logging.info("-----------------------------------------------------------")
+    logging.info("#              Connection to Mqtt broker                   #")
+    logging.info("-----------------------------------------------------------")
+    myMetrics.startStage("mqtt_connect")
+
+    if mySharedMqtt is None:
+        myMqtt = _connectMqtt(myParams)
+    else:
+        myMqtt = mySharedMqtt
+        logging.info("Mqtt broker connection shared by the accounts.")
+
+    # Publish messages kept in outbox during previous broker outages
+    myOutbox = outbox.Outbox(myDb,myMqtt,myParams.mqttQos,myParams.mqttRetain)
+    if myOutbox.pendingCount:
+        logging.info("%s message(s) waiting in outbox since a previous run.",myOutbox.pendingCount)
+        publishedCount = myOutbox.drain()
+        logging.info("%s message(s) of outbox published.",publishedCount)
+    myMetrics.endStage("mqtt_connect")
+
+    # STEP 3 : Get data from GRDF website
+    ####################################################################################################################
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#            Get data from GRDF website                   #")
+    logging.info("-----------------------------------------------------------")
+    myMetrics.startStage("grdf")
+
+    tryCount = 0
+    # Connection
+    while tryCount < gazpar.GRDF_API_MAX_RETRIES :
+        try:
+
+            tryCount += 1
+            myMetrics.count("grdf_login_tries")
+
+            # Record the requests of the previous try
+            if myGrdf is not None:
+                _recordGrdfRequests(myMetrics, myGrdf)
+
+            # Create Grdf instance
+            logging.debug("Connection to GRDF, try %s/%s...",tryCount,gazpar.GRDF_API_MAX_RETRIES)
+            myGrdf = gazpar.Grdf()
+            logging.debug("After myGrdf")
+            # Connect to Grdf website
+
+            myGrdf.login(myParams.grdfUsername,myParams.grdfPassword)
+
+
+            # Check connection
+            if myGrdf.isConnected:
+                logging.info("GRDF connected !")
+                break
+            else:
+                logging.info("Unable to login to GRDF website")
+                _waitBeforeRetry(tryCount)
+
+        except:
+            myGrdf.isConnected = False
+            logging.info("Unable to login to GRDF website")
+            _waitBeforeRetry(tryCount)
+
+
+    # When GRDF is connected
+    if myGrdf.isConnected:
+
+        # Sub-step 3A : Get account info
+        try:
+
+            # Get account informations and store it to db
+            logging.info("Retrieve account informations")
+            myAccount = myGrdf.getWhoami()
+            logging.info("MyAccount: %s", myAccount)
+            myAccount.store(myDb)
+            myDb.commit()
+
+        except:
+            logging.warning("Unable to get account information from GRDF website.")
+
+
+        # Sub-step 3B : Get list of PCE
+        logging.info("Retrieve list of PCEs...")
+        try:
+            myGrdf.getPceList()
+            logging.info("%s PCE found !",myGrdf.countPce())
+        except:
+            myGrdf.isConnected = False
+            logging.info("Unable to get any PCE !")
+
+        # Loop on PCE
+        if myGrdf.pceList:
+            for myPce in myGrdf.pceList:
 
-                # Set point
-                point = myInflux.setThresholdPoint(myThreshold)
+                # Store PCE in database
+                if myPce.store(myDb):
+                    myChangeSet.addPce(myPce.pceId)
+                myDb.commit()
+
+
+                # Sub-step 3C : Get measures of the PCE
+
+                # Get measures of the PCE
+                logging.info("---------------------------------")
+                logging.info("Get measures of PCE %s alias %s",myPce.pceId,myPce.alias)
+
+
+                # Set date range
+                if not myParams.grdfStartDate: myParams.grdfStartDate = '2020-01-01' # can be omitted if param.py back to default
+                minDateTimeLimit = _getYearOfssetDate(datetime.datetime.now(), 3) # GRDF min date is 3 years ago
+                minDateTime = datetime.datetime.strptime(myParams.grdfStartDate, "%Y-%m-%d")
+                startDate = minDateTime.date()
+                endDate = datetime.date.today()
+                if minDateTime < minDateTimeLimit:
+                    startDate = minDateTimeLimit.date()
+                    logging.info("Range period : from %s (3 years ago) to %s (today) ...",startDate,endDate)
+
+                logging.info("Range period : from %s (self defined) to %s (today) ...",startDate,endDate)
+
+
+                # Get informative measures
+                logging.info("---------------")
+                logging.info("Retrieve informative measures...")
+                try:
+                    myGrdf.getPceMeasures(myPce,startDate,endDate,gazpar.TYPE_I)
+                    logging.info("Informative measures found !")
+                except:
+                    logging.error("Error during informative measures collection")
+
+
+                # Analyse data
+                measureCount = myPce.countMeasure(gazpar.TYPE_I)
+                myMetrics.count("grdf_measures", measureCount, type=gazpar.TYPE_I)
+                if measureCount > 0:
+                    logging.info("Analysis of informative measures provided by GRDF...")
+                    logging.info("%s informative measures provided by Grdf", measureCount)
+                    measureOkCount = myPce.countMeasureOk(gazpar.TYPE_I)
+                    logging.info("%s informative measures are ok", measureOkCount)
+                    accuracy = round((measureOkCount/measureCount)*100)
+                    logging.info("Accuracy is %s percent",accuracy)
+
+                    # Get last informative measure
+                    myMeasure = myPce.getLastMeasureOk(gazpar.TYPE_I)
+                    if myMeasure:
+                        logging.info("Last valid informative measure provided by GRDF : ")
+                        logging.info("Date = %s", myMeasure.gasDate)
+                        logging.info("Start index = %s, End index = %s", myMeasure.startIndex, myMeasure.endIndex)
+                        logging.info("Volume = %s m3, Energy = %s kWh, Factor = %s", myMeasure.volume, myMeasure.energy,
+                                     myMeasure.conversionFactor)
+                        if myMeasure.isDeltaIndex:
+                            logging.warning("Inconsistencies detected on the measure : ")
+                            logging.warning(
+                                "Volume provided by Grdf (%s m3) has been replaced by the volume between start index and end index (%s m3)",
+                                myMeasure.volumeInitial, myMeasure.volume)
+                    else:
+                        logging.warning("Unable to find the last informative measure.")
+
+
+                # Get published measures
+                logging.info("---------------")
+                logging.info("Retrieve published measures...")
+                try:
+                    myGrdf.getPceMeasures(myPce, startDate, endDate, gazpar.TYPE_P)
+                    logging.info("Published measures found !")
+                except:
+                    logging.error("Error during published measures collection")
+
+                # Analyse data
+                measureCount = myPce.countMeasure(gazpar.TYPE_P)
+                myMetrics.count("grdf_measures", measureCount, type=gazpar.TYPE_P)
+                if measureCount > 0:
+                    logging.info("Analysis of published measures provided by GRDF...")
+                    logging.info("%s published measures provided by Grdf", measureCount)
+                    measureOkCount = myPce.countMeasureOk(gazpar.TYPE_P)
+                    logging.info("%s published measures are ok", measureOkCount)
+                    accuracy = round((measureOkCount / measureCount) * 100)
+                    logging.info("Accuracy is %s percent", accuracy)
+
+                    # Get last published measure
+                    myMeasure = myPce.getLastMeasureOk(gazpar.TYPE_P)
+                    if myMeasure:
+                        logging.info("Last valid published measure provided by GRDF : ")
+                        logging.info("Start date = %s, End date = %s", myMeasure.startDateTime, myMeasure.endDateTime)
+                        logging.info("Start index = %s, End index = %s", myMeasure.startIndex, myMeasure.endIndex)
+                        logging.info("Volume = %s m3, Energy = %s kWh, Factor = %s", myMeasure.volume, myMeasure.energy,
+                                     myMeasure.conversionFactor)
+                        if myMeasure.isDeltaIndex:
+                            logging.warning("Inconsistencies detected on the measure : ")
+                            logging.warning(
+                                "Volume provided by Grdf (%s m3) has been replaced by the volume between start index and end index (%s m3)",
+                                myMeasure.volumeInitial, myMeasure.volume)
+                    else:
+                        logging.warning("Unable to find the last published measure.")
+
+                # Store to database
+                logging.info("---------------")
+                if myPce.measureList:
+                    logging.info("Update of database with retrieved measures...")
+                    lastDate = myDb.getLastMeasureDate(myPce.pceId, gazpar.TYPE_I)
+                    startTime = time.monotonic()
+                    for myMeasure in myPce.measureList:
+                        # Store measure into database, and record it when new or changed
+                        if myMeasure.store(myDb):
+                            myChangeSet.addMeasure(myPce.pceId, myMeasure.type, myMeasure.gasDate)
+
+                    # Commmit database
+                    myDb.commit()
+                    myMetrics.observe("db_store", time.monotonic() - startTime)
+                    myMetrics.count("db_rows_stored", len(myPce.measureList))
+                    myMetrics.count("db_rows_changed", myChangeSet.countMeasures(myPce.pceId))
+                    logging.info("Database updated, %s measure(s) inserted or changed !", myChangeSet.countMeasures(myPce.pceId))
+
+                    # Date of the last valid measure, to detect collections stuck in the past
+                    myMeasure = myPce.getLastMeasureOk(gazpar.TYPE_I)
+                    if myMeasure:
+                        myMetrics.gauge("last_measure_date", myMeasure.gasDate.isoformat(), pce=myPce.pceId)
+
+                        # Time of arrival of a new measure, used by the adaptive scheduler
+                        if lastDate is not None and myMeasure.gasDate > lastDate.date():
+                            myDb.addArrival(myPce.pceId, gazpar.TYPE_I, myMeasure.gasDate,
+                                            scheduler.getArrival(previousRun, datetime.datetime.now(), myParams.scheduleRetryMax))
+                            myDb.commit()
 
-                # Write
-                if not myInflux.write(point):
-                    errorCount += 1
                 else:
-                    writeCount += 1
+                    logging.info("Unable to store any measure for PCE %s to database !",myPce.pceId)
+
+                # Request the days missing in the database again
+                if myPce.measureList and myParams.gapRetryMax:
+                    _backfillGaps(myParams,myDb,myGrdf,myPce,startDate,myChangeSet,myMetrics)
+
+
+                # Sub-step 3D : Get thresholds of the PCE
+
+                # Get threshold
+                logging.info("---------------")
+                logging.info("Retrieve PCE's thresholds from GRDF...")
+                try:
+                    myGrdf.getPceThreshold(myPce)
+                    thresholdCount = myPce.countThreshold()
+                    logging.info("%s thresholds found !",thresholdCount)
+
+                except:
+                    logging.warning("Error to get PCE's thresholds, verify if you have setup thresholds for your PCE/account")
+
+                # Update database
+                if myPce.thresholdList:
+                    # Store thresholds into database
+                    logging.info("Update of database with retrieved thresholds...")
+                    for myThreshold in myPce.thresholdList:
+                        if myThreshold.store(myDb):
+                            myChangeSet.addThreshold(myPce.pceId, myThreshold.date)
+                    # Commmit database
+                    myDb.commit()
+                    myMetrics.count("db_rows_stored", len(myPce.thresholdList))
+                    logging.info("Database updated !")
 
-                # Check number of error
-                if errorCount > influxdb.WRITE_MAX_ERROR:
-                    logging.warning("Writing stopped because of too many errors.")
-                    break
-            logging.info("%s threshold(s) of PCE written successfully !",writeCount)
 
-        # Disconnect
-        logging.info("Disconnection of influxdb...")
-        myInflux.close()
-        logging.info("Influxdb disconnected.")
+                # Sub-step 3E : Score the new days of the PCE
+
+                if myParams.anomalyEnable:
+                    logging.info("---------------")
+                    logging.info("Detection of anomalies in the daily measures...")
+                    _detectAnomalies(myParams,myDb,myPce,myChangeSet,myMetrics)
+
+
+        else:
+            logging.info("No PCE retrieved.")
+
+    # Record the requests of the last try
+    if myGrdf is not None:
+        _recordGrdfRequests(myMetrics, myGrdf)
+    myMetrics.endStage("grdf", metrics.STATUS_OK if myGrdf is not None and myGrdf.isConnected else metrics.STATUS_ERROR)
+
+
+
+    ####################################################################################################################
+    # STEP 4a : Prices
+    ####################################################################################################################
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#                    Load prices                          #")
+    logging.info("-----------------------------------------------------------")
+
+    myMetrics.startStage("prices")
+
+    # Load data from prices file
+    logging.info("Loading prices from file %s of directory %s", price.FILE_NAME, myParams.pricePath)
+    myPrices = price.Prices(myParams.pricePath, myParams.priceKwhDefault, myParams.priceFixDefault)
+    if len(myPrices.pricesList):
+        logging.info("%s range(s) of prices found !", len(myPrices.pricesList))
+    pricesSignature = myPrices.getSignature()
+    if pricesSignature != myDb.getConfig(database.PRICES_SIGNATURE_KEY):
+        logging.info("Prices changed since last run.")
+        myChangeSet.pricesChanged = True
+        
+    ####################################################################################################################
+    # STEP 4b : Prices
+    ####################################################################################################################
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#                    Write prices                         #")
+    logging.info("-----------------------------------------------------------")
+    if myGrdf.isConnected \
+        and myDb.isConnected() :
+
+        try:
+            _writePrices(myParams, myDb, myGrdf.pceList, myPrices, myChangeSet)
+
+            # Prices are up to date
+            myDb.updateVersion(database.PRICES_SIGNATURE_KEY, pricesSignature)
+            myDb.commit()
+
+        except Exception as e:
+            logging.error("Home Assistant Prices error: %s", e)
+    myMetrics.endStage("prices")
+
+
+    ####################################################################################################################
+    # STEP 4c : Calculate measures
+    ####################################################################################################################
+
+    # Measures are calculated once prices are written, before the sinks start : the stages run concurrently
+    # and only read the PCEs
+    if myGrdf is not None:
+        for myPce in myGrdf.pceList:
+            _calculateMeasures(myParams,myDb,myPce,myMetrics)
+            
+            
+    ####################################################################################################################
+    # STEP 5 : Publish to sinks
+    ####################################################################################################################
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#                  Publish to sinks                       #")
+    logging.info("-----------------------------------------------------------")
+
+    # Sinks only process what changed since the last run
+    myChangeSet.logSummary()
+
+    # Sinks reading the whole database share a single snapshot, loaded by the first of them
+    if myParams.snapshotEnable:
+        mySnapshot = snapshot.FileSnapshot(myParams.dbPath)
+    else:
+        mySnapshot = database.Snapshot(myParams.dbPath)
+
+    # Sinks only read the stored data, so they run concurrently when parallel stages are enabled
+    myStageList = [stage.Stage("mqtt", _runMqttStage, myParams, myMqtt, myGrdf, dtn, myChangeSet, myMetrics)]
+    if myParams.hassLts \
+        and myGrdf.isConnected \
+        and not myParams.hassLtsDelete:
+        if myChangeSet.hasDataChanged():
+            myStageList.append(stage.Stage("hass_lts", _runLtsStage, myParams, myGrdf, myChangeSet, mySnapshot, myMetrics))
+        else:
+            logging.info("No new data, Home Assistant Long Term Statistics skipped.")
+    if myParams.hassLtsDelete:
+        myStageList.append(stage.Stage("hass_lts_delete", _runLtsDeleteStage, myParams))
+    if myParams.influxEnable:
+        if myChangeSet.hasChanged():
+            myStageList.append(stage.Stage("influxdb", _runInfluxStage, myParams, myGrdf, myPrices, mySnapshot, myMetrics))
+        else:
+            logging.info("No new data, Influxdb export skipped.")
+    if myParams.exportEnable:
+        myStageList.append(stage.Stage("export", _runExportStage, myParams, myChangeSet, myPrices, mySnapshot, myMetrics))
+    stage.runStages(myStageList, myParams.parallelStages, myParams.stageTimeout, myMetrics)
+
+    # The snapshot file speeds up the next run, it is only a cache : a failure does not fail the run
+    if myParams.snapshotEnable:
+        try:
+            mySnapshot.save()
+        except Exception as e:
+            logging.warning("Unable to write snapshot file : %s", e)
+
+    # Status of the run : the next run processes everything again when a step failed
+    runStatus = stage.STATUS_OK
+    if myGrdf is None or not myGrdf.isConnected:
+        runStatus = stage.STATUS_ERROR
+    for myStage in myStageList:
+        if myStage.status != stage.STATUS_OK:
+            runStatus = myStage.status
+    myDb.updateVersion(database.RUN_STATUS_KEY, runStatus)
+    myDb.updateVersion(database.CALCULATION_DATE_KEY, datetime.date.today().isoformat())
+    myDb.commit()
+
+    ####################################################################################################################
+    # STEP 6 : Summary of the run and disconnection from mqtt broker
+    ####################################################################################################################
+    # A shared connection counts the messages of all the accounts, they are logged at the end of the multi-account run
+    if myMqtt is not None and mySharedMqtt is None:
+        myMetrics.count("mqtt_messages_published", myMqtt.publishCount)
+        myMetrics.count("mqtt_bytes_published", myMqtt.publishBytes)
+    myMetrics.gauge("db_size_bytes", os.path.getsize(os.path.join(myParams.dbPath, database.DATABASE_NAME)))
+    myMetrics.stop()
+    if myExporter is not None:
+        myExporter.update(myMetrics, (("account", myParams.accountName),) if myParams.accountName else ())
+
+    if myParams.metricsEnable:
+
+        logging.info("-----------------------------------------------------------")
+        logging.info("#                  Summary of the run                     #")
+        logging.info("-----------------------------------------------------------")
+
+        myMetrics.logSummary()
+        summary = myMetrics.getSummary()
+        myDb.addRun(summary["start"], summary["duration"], summary["status"], summary)
+        myDb.commit()
+        if myMqtt is not None and myMqtt.isConnected:
+            myMqtt.publish(myParams.mqttTopic + standalone.TOPIC_DIAGNOSTIC, json.dumps(summary))
+
+    if myMqtt is not None and myMqtt.isConnected and mySharedMqtt is None:
 
-        # Release memory
-        del myInflux
+        logging.info("-----------------------------------------------------------")
+        logging.info("#               Disconnection from MQTT                    #")
+        logging.info("-----------------------------------------------------------")
+
+        try:
+            myMqtt.disconnect()
+            logging.info("Mqtt broker disconnected")
+        except:
+            logging.error("Unable to disconnect mqtt broker")
+
+    # Release memory
+    del myOutbox
+    del myMqtt
+    del myGrdf
 
     ####################################################################################################################
     # STEP 7 : Disconnect from database
@@ -1136,7 +1609,9 @@ def run(myParams):
     logging.info("-----------------------------------------------------------")
     logging.info("#                Next run                                 #")
     logging.info("-----------------------------------------------------------")
-    if myParams.scheduleTime is not None:
+    if myParams.scheduleMode == 'adaptive':
+        logging.info("gazpar2mqtt next run scheduled by the adaptive scheduler")
+    elif myParams.scheduleTime is not None:
         logging.info("gazpar2mqtt next run scheduled at %s",myParams.scheduleTime)
     else:
         logging.info("No schedule defined.")
@@ -1147,6 +1622,114 @@ def run(myParams):
     logging.info("-----------------------------------------------------------")
 
 
+########################################################################################################################
+#### Multi-account
+########################################################################################################################
+def runAccounts(myParams,accountList,myExporter=None):
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#                Multi-account run                        #")
+    logging.info("-----------------------------------------------------------")
+    logging.info("%s account(s) run by %s worker(s)", len(accountList), min(myParams.accountsWorkers, len(accountList)))
+
+    # One Mqtt connection for all the accounts, each account publishes under its own topic
+    myMqtt = _connectMqtt(myParams)
+
+    # Errors of an account do not stop the others
+    def runAccount(myAccount):
+        threading.current_thread().name = myAccount.name
+        try:
+            run(myAccount.params, myExporter, myMqtt)
+            return True
+        except Exception as e:
+            logging.error("Run of account %s failed : %s", myAccount.name, e)
+            logging.debug("Full traceback:", exc_info=True)
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=myParams.accountsWorkers, thread_name_prefix="account") as executor:
+        resultList = list(executor.map(runAccount, accountList))
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#                End of multi-account run                 #")
+    logging.info("-----------------------------------------------------------")
+    logging.info("%s/%s account(s) run without error.", sum(resultList), len(accountList))
+    if myMqtt is not None:
+        logging.info("%s message(s) published to Mqtt broker (%s bytes).", myMqtt.publishCount, myMqtt.publishBytes)
+        if myMqtt.isConnected:
+            try:
+                myMqtt.disconnect()
+                logging.info("Mqtt broker disconnected")
+            except:
+                logging.error("Unable to disconnect mqtt broker")
+
+
+# Run the accounts of a shard in a worker process, return the metrics of their runs
+def _runShard(myParams,accountList,logLevel,collectMetrics):
+
+    logging.basicConfig(format=LOG_FORMAT_ACCOUNTS, level=logLevel)
+    myCollector = shard.MetricsCollector() if collectMetrics else None
+    # The trace of the main process does not cover the worker processes
+    traced = metrics.startTrace(myParams.metricsTraceMemory and (myParams.metricsEnable or collectMetrics))
+    try:
+        runAccounts(myParams,accountList,myCollector)
+    finally:
+        if traced:
+            metrics.stopTrace()
+    return myCollector.updateList if myCollector is not None else []
+
+
+# Run the accounts spread over worker processes by a consistent hash of their name
+def runShards(myParams,accountList,myExporter=None):
+
+    import multiprocessing # only loaded when the accounts are sharded
+
+    logging.info("-----------------------------------------------------------")
+    logging.info("#               Sharded multi-account run                 #")
+    logging.info("-----------------------------------------------------------")
+    shardList = shard.getShardList(accountList, myParams.accountsProcesses)
+    logging.info("%s account(s) spread over %s process(es)", len(accountList), len(shardList))
+
+    # Processes are spawned : they do not inherit the threads (Mqtt, Prometheus exporter) of the main process
+    futureList = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(shardList), mp_context=multiprocessing.get_context("spawn")) as executor:
+        for processNo, (shardNo, shardAccountList) in enumerate(shardList):
+            logging.info("Process %s runs shard %s : %s", processNo, shardNo, ", ".join(myAccount.name for myAccount in shardAccountList))
+
+            # Each process has its own Mqtt connection, whose client id must be unique
+            myShardParams = copy.copy(myParams)
+            myShardParams.mqttClientId = f"{myParams.mqttClientId}-{processNo}"
+            futureList.append(executor.submit(_runShard, myShardParams, shardAccountList,
+                                              logging.getLogger().level, myExporter is not None))
+
+        # Metrics of the runs are gathered by the main process, which holds the Prometheus exporter
+        for processNo, myFuture in enumerate(futureList):
+            try:
+                for myMetrics, labels in myFuture.result():
+                    myExporter.update(myMetrics, labels)
+            except Exception as e:
+                logging.error("Process %s (shard %s) failed : %s", processNo, shardList[processNo][0], e)
+                logging.debug("Full traceback:", exc_info=True)
+
+
+# Run the single account of the parameters, or all the accounts of the multi-account mode
+def runAll(myParams,accountList=None,myExporter=None):
+
+    # Memory is traced once for the accounts run together, their runs share the trace of the process
+    traced = False
+    if not (accountList and myParams.accountsProcesses > 1):
+        traced = metrics.startTrace(myParams.metricsTraceMemory and (myParams.metricsEnable or myExporter is not None))
+    try:
+        if accountList and myParams.accountsProcesses > 1:
+            runShards(myParams,accountList,myExporter)
+        elif accountList:
+            runAccounts(myParams,accountList,myExporter)
+        else:
+            run(myParams,myExporter)
+    finally:
+        if traced:
+            metrics.stopTrace()
+
+
 ########################################################################################################################
 #### Main
 ########################################################################################################################
@@ -1156,12 +1739,15 @@ if __name__ == "__main__":
     myParams = param.Params()
         
     # Set logging
+    myFormat = LOG_FORMAT
+    if myParams.accountsFile is not None:
+        myFormat = LOG_FORMAT_ACCOUNTS
     if myParams.debug:
         myLevel = logging.DEBUG
-        logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=myLevel)
+        logging.basicConfig(format=myFormat, level=myLevel)
     else:
         myLevel = logging.INFO
-    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=myLevel)
+    logging.basicConfig(format=myFormat, level=myLevel)
     
     
     # Say welcome and be nice
@@ -1188,15 +1774,53 @@ if __name__ == "__main__":
         logging.error("Error on parameters. End of program.")
         quit()
 
+    # Load the accounts of the multi-account mode
+    accountList = None
+    if myParams.accountsFile is not None:
+        try:
+            accountList = accounts.loadAccounts(myParams.accountsFile, myParams)
+        except Exception as e:
+            logging.error("Error on accounts file %s : %s. End of program.", myParams.accountsFile, e)
+            quit()
+        for myAccount in accountList:
+            logging.info("Account %s : topic = %s, device name = %s, database path = %s", myAccount.name,
+                         myAccount.params.mqttTopic, myAccount.params.hassDeviceName, myAccount.params.dbPath)
+
     
+    # Start Prometheus endpoint
+    myExporter = None
+    if myParams.metricsPort is not None:
+        import exporter
+        myExporter = exporter.Exporter()
+        myExporter.start(myParams.metricsPort)
+
     # Run
-    if myParams.scheduleTime is not None:
+    if myParams.scheduleMode == 'adaptive':
+
+        # Run when GRDF usually publishes, retry until the measures of the day land
+        # In multi-account mode, the next run is the earliest one of the accounts
+        dbPathList = [myAccount.params.dbPath for myAccount in accountList] if accountList else [myParams.dbPath]
+        mySchedulerList = [scheduler.Scheduler(dbPath, myParams.scheduleTime or scheduler.DEFAULT_TIME,
+                                               myParams.scheduleRetryMin, myParams.scheduleRetryMax, myParams.scheduleMargin)
+                           for dbPath in dbPathList]
+        while True:
+            runAll(myParams,accountList,myExporter)
+            try:
+                nextRun = min(myScheduler.getNextRun(datetime.datetime.now()) for myScheduler in mySchedulerList)
+            except Exception as e:
+                nextRun = datetime.datetime.now() + datetime.timedelta(minutes=myParams.scheduleRetryMax)
+                logging.error("Unable to compute the next run : %s",e)
+            logging.info("gazpar2mqtt next run at %s",nextRun)
+            time.sleep(max(0, (nextRun - datetime.datetime.now()).total_seconds()))
+
+    elif myParams.scheduleTime is not None:
         
         # Run once at lauch
-        run(myParams)
+        runAll(myParams,accountList,myExporter)
 
         # Then run at scheduled time
-        schedule.every().day.at(myParams.scheduleTime).do(run,myParams)
+        import schedule
+        schedule.every().day.at(myParams.scheduleTime).do(runAll,myParams,accountList,myExporter)
         while True:
             schedule.run_pending()
             time.sleep(1)
@@ -1204,5 +1828,5 @@ if __name__ == "__main__":
     else:
         
         # Run once
-        run(myParams)
+        runAll(myParams,accountList,myExporter)
         logging.info("End of gazpar2mqtt. See u...")
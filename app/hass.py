@@ -4,6 +4,7 @@
 
 import json
 import logging
+import hashlib
 
 # Constants
 SENSOR = "sensor"
@@ -24,6 +25,9 @@ ST_TTI = 'total_increasing'
 
 # Hass Others
 MANUFACTURER = "GRDF"
+TOPIC_STATUS = "/status" # birth and last will topic of Home Assistant
+STATUS_ONLINE = "online"
+CONFIG_REFRESH_HOURS = 24 # discovery configs are published again after this delay, in case the broker lost them
 
 
 
@@ -68,6 +72,22 @@ class Device:
     def addEntity(self,entity):
         self.entityList.append(entity)
     
+    # Return the config payload of the entities whose config changed since last publication
+    def getConfigPayload(self,hashList,force=False):
+        
+        # Init payload
+        payload = {}
+        
+        # Keep only configs whose hash differs from the one already published
+        for myEntity in self.entityList:
+            myHash = myEntity.getConfigHash()
+            if force or hashList.get(myEntity.configTopic) != myHash:
+                payload[myEntity.configTopic] = myEntity.getConfigPayloadJson()
+                hashList[myEntity.configTopic] = myHash
+        
+        # Return json formatted
+        return payload
+    
     # Return the state payload of all entities of the device
     def getStatePayload(self):
         
@@ -76,7 +96,6 @@ class Device:
         
         # Append value to list in the corresponding state topic
         for myEntity in self.entityList:
-            payload[myEntity.configTopic] = myEntity.getConfigPayloadJson()
             if myEntity.value is not None:
                 payload[myEntity.stateTopic]  = myEntity.value
             if myEntity.attributes:
@@ -105,6 +124,7 @@ class Entity:
         self.stateClass = stateClass
         self.unit = unit
         self.statePayload = None
+        self.configPayloadJson = None
         self.value = None
         self.attributes = {}
         
@@ -136,7 +156,13 @@ class Entity:
     
     # Return config payload in Json format
     def getConfigPayloadJson(self):
-        return json.dumps(self.configPayload)
+        if self.configPayloadJson is None:
+            self.configPayloadJson = json.dumps(self.configPayload, sort_keys=True)
+        return self.configPayloadJson
+    
+    # Return the hash of the config payload
+    def getConfigHash(self):
+        return hashlib.sha1(self.getConfigPayloadJson().encode('utf-8')).hexdigest()
     
     # Set state value
     def setValue(self,value):
@@ -1,41 +1,27 @@
 import json
 import logging
 import ssl
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 import websocket
 
 class HomeAssistantWs:
-    def __init__(self, action, pce, url, ssl, ssl_data, token, sensor, unit, unit_class, data):
+    def __init__(self, url, ssl, ssl_data, token, chunk_size=500, pipeline=4):
         self.ws = None
-        self.pce = pce
         self.url = url
         self.ssl = ssl    
         self.ssl_data = ssl_data
         self.token = token
-        self.sensor_name = sensor.lower()
-        self.unit = unit
-        self.unit_class = unit_class
-        self.data = data
-        self.action = action
         self.domain = "gazpar"
         self.id = 1
-        self.current_stats = []
+        self.chunk_size = max(1, chunk_size)
+        self.pipeline = max(1, pipeline)
+        self.commands = []
+        self.connected = False
         if self.load_config():
-            if self.connect() and self.action == "import":
-                                  
-                                   
-                self.import_data()
-            elif self.connect() and self.action == "delete":
-                self.list_data()
-                logging.debug("Deleting current statistics: %s", self.current_stats)
-                self.clear_data()
-            else:
-                logging.critical("The configuration of the Websocket Home Assistant WebSocket is erroneous")
-        else:
+            self.connected = self.connect()
+        if not self.connected:
             logging.critical("The configuration of the Websocket Home Assistant WebSocket is erroneous")
-        if self.ws.connected:
-            self.ws.close()
 
     def load_config(self):
         if self.ssl:
@@ -70,10 +56,12 @@ class HomeAssistantWs:
                 f" => WARNING, the WebSocket will be banned after multiple unsuccesful login attempts."
             )
             logging.warning(f" => ex: 403: Forbidden")
+            return False
 
     def authentificate(self):
         data = {"type": "auth", "access_token": self.token}
-        auth_output = self.send(data)
+        self.ws.send(json.dumps(data))
+        auth_output = json.loads(self.ws.recv())
         if auth_output["type"] == "auth_ok":
             logging.info(" => OK")
             return True
@@ -81,73 +69,127 @@ class HomeAssistantWs:
             logging.error(" => Authentication impossible, please verify url & token.")
             return False
 
+    def close(self):
+        if self.ws is not None and self.ws.connected:
+            self.ws.close()
+        self.connected = False
+
     def send(self, data):
-        self.ws.send(json.dumps(data))
-        self.id = self.id + 1
-        output = json.loads(self.ws.recv())
-        if "type" in output and output["type"] == "result":
-            if not output["success"]:
-                logging.error(f"Error when sending : {data}")
-                logging.error(output)
-        return output
-
-    def list_data(self):
+        return self.send_many([data])[0]
+
+    def send_many(self, commands):
+        # Up to `pipeline` commands are in flight, results are matched to commands by id
+        outputs = {}
+        pending = {}
+        queue = list(commands)
+        while queue or pending:
+            while queue and len(pending) < self.pipeline:
+                data = queue.pop(0)
+                data["id"] = self.id
+                self.id = self.id + 1
+                self.ws.send(json.dumps(data))
+                pending[data["id"]] = data
+            output = json.loads(self.ws.recv())
+            data = pending.pop(output.get("id"), None)
+            if data is None:
+                continue
+            if "type" in output and output["type"] == "result":
+                if not output["success"]:
+                    logging.error(f"Error when sending : {data['type']} (id {data['id']})")
+                    logging.error(output)
+            outputs[data["id"]] = output
+        return [outputs[data["id"]] for data in commands]
+
+    def flush(self):
+        # Send the queued commands
+        commands = self.commands
+        self.commands = []
+        if commands:
+            logging.debug(f"Sending {len(commands)} command(s) to Home Assistant")
+            return self.send_many(commands)
+        return []
+
+    def list_data(self, statistic_ids):
         logging.info("Collecting LTS data already in Home Assistant.")
         import_statistics = {
-            "id": self.id,
             "type": "recorder/list_statistic_ids",
             "statistic_type": "sum",
         }
+        current_stats = []
         current_lts = self.send(import_statistics)
         for stats in current_lts["result"]:
-            if stats["statistic_id"] == self.sensor_name:
-                self.current_stats.append(stats["statistic_id"])
-        return self.current_stats
+            if stats["statistic_id"] in statistic_ids:
+                current_stats.append(stats["statistic_id"])
+        return current_stats
 
-    def clear_data(self):
+    def clear_data(self, statistic_ids):
         logging.info("Deleting Long Terms Statistics for gazpar.")
         clear_statistics = {
-            "id": self.id,
             "type": "recorder/clear_statistics",
-            "statistic_ids": self.current_stats,
+            "statistic_ids": statistic_ids,
         }
         logging.info("Cleaning :")
-        for data in self.current_stats:
+        for data in statistic_ids:
             logging.info(f" - {data}")
         clear_stat = self.send(clear_statistics)
         return clear_stat
 
-    def get_data(self, statistic_ids, begin, end):
+    def get_data(self, statistic_ids, begin, end, period="hour"):
         statistics_during_period = {
-            "id": self.id,
             "type": "recorder/statistics_during_period",
             "start_time": begin.isoformat(),
             "end_time": end.isoformat(),
             "statistic_ids": [statistic_ids],
-            "period": "hour",
+            "period": period,
+            "types": ["sum"],
         }
         stat_period = self.send(statistics_during_period)
         return stat_period
 
-    def import_data(self):
-        logging.info(f"Exporting to HA Long Term Statistics : {self.pce}")
+    def get_last_statistic(self, statistic_id, begin, end):
+        # Find the last month holding statistics, then the last hour within this month
+        rows = self._get_rows(statistic_id, begin, end, "month")
+        if not rows:
+            return None
+        month_start = self._to_datetime(rows[-1]["start"])
+        rows = self._get_rows(statistic_id, max(month_start, begin), end, "hour")
+        if not rows or rows[-1].get("sum") is None:
+            return None
+        return self._to_datetime(rows[-1]["start"]), rows[-1]["sum"]
+
+    def _get_rows(self, statistic_id, begin, end, period):
+        if begin >= end:
+            return []
+        output = self.get_data(statistic_id, begin, end, period)
+        if not output.get("success") or not output.get("result"):
+            return []
+        return output["result"].get(statistic_id, [])
+
+    def _to_datetime(self, value):
+        # Recent Home Assistant versions return timestamps in milliseconds
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value / 1000, timezone.utc)
+        return datetime.fromisoformat(value)
+
+    def import_data(self, pce, sensor, unit, unit_class, data):
+        # Statistics are split in chunks and queued, they are sent by flush()
+        logging.info(f"Exporting to HA Long Term Statistics : {pce}")
+        sensor_name = sensor.lower()
         metadata = {
             "mean_type": 0,
             "has_sum": True,
-            "name": self.sensor_name,
+            "name": sensor_name,
             "statistic_id": (
-                self.sensor_name
+                sensor_name
                     ),
-            "unit_of_measurement": self.unit,
-            "unit_class": self.unit_class,
+            "unit_of_measurement": unit,
+            "unit_class": unit_class,
             "source": self.domain,
             }
-        statistics = {
-                "id": self.id,
-                "type": "recorder/import_statistics",
-                "metadata": metadata,
-                "stats": self.data,
-            } 
-
-        self.send(statistics)
-            
+        for i in range(0, len(data), self.chunk_size):
+            statistics = {
+                    "type": "recorder/import_statistics",
+                    "metadata": metadata,
+                    "stats": data[i:i + self.chunk_size],
+                } 
+            self.commands.append(statistics)
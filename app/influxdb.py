@@ -3,15 +3,188 @@
 import logging
 import time
 import json
+import threading
+import hashlib
+import calendar
 from database import Pce, Measure
-from datetime import datetime, timedelta
-from influxdb_client import Point,InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
+from datetime import datetime, timedelta, timezone
 import price
 
 # Constants
-WRITE_MAX_ERROR = 20 # maximum number of write errors accepted before abort
-WRITE_SLEEP = 0.005 # time to sleep between two write
+WRITE_MAX_ERROR = 20 # default maximum number of points in error accepted before abort
+WRITE_SLEEP = 0.005 # time to sleep between two synchronous write
+
+# Periods of the aggregated measures
+AGGREGATE_PERIODS = ("day", "week", "month", "year")
+
+# KPI fields calculated by Pce.calculateMeasures and their attribute
+KPI_FIELDS = (
+    ("current_year_gas", "gasY0"),
+    ("previous_year_gas", "gasY1"),
+    ("previous_2_year_gas", "gasY2"),
+    ("current_month_gas", "gasM0Y0"),
+    ("previous_month_gas", "gasM1Y0"),
+    ("current_month_previous_year_gas", "gasM0Y1"),
+    ("current_week_gas", "gasW0Y0"),
+    ("previous_week_gas", "gasW1Y0"),
+    ("current_week_previous_year_gas", "gasW0Y1"),
+    ("rolling_year_gas", "gasR1Y"),
+    ("rolling_year_last_year_gas", "gasR2Y1Y"),
+    ("rolling_month_gas", "gasR1M"),
+    ("rolling_month_last_month_gas", "gasR2M1M"),
+    ("rolling_month_last_year_gas", "gasR1MY1"),
+    ("rolling_month_last_2_year_gas", "gasR1MY2"),
+    ("rolling_week_gas", "gasR1W"),
+    ("rolling_week_last_week_gas", "gasR2W1W"),
+    ("rolling_week_last_year_gas", "gasR1WY1"),
+    ("rolling_week_last_2_year_gas", "gasR1WY2"),
+    ("current_month_threshold", "tshM0"),
+    ("current_month_threshold_percentage", "tshM0Pct"),
+    ("previous_month_threshold", "tshM1"),
+    ("previous_month_threshold_percentage", "tshM1Pct"),
+    ("rolling_year_degree_days", "hddR1Y"),
+    ("rolling_year_last_year_degree_days", "hddR2Y1Y"),
+    ("rolling_month_degree_days", "hddR1M"),
+    ("rolling_month_last_year_degree_days", "hddR1MY1"),
+    ("rolling_year_energy_per_degree_day", "energyHddR1Y"),
+    ("rolling_year_last_year_energy_per_degree_day", "energyHddR2Y1Y"),
+    ("rolling_month_energy_per_degree_day", "energyHddR1M"),
+    ("rolling_month_last_year_energy_per_degree_day", "energyHddR1MY1"),
+    ("rolling_year_normalised_energy", "energyNormR1Y"),
+    ("rolling_year_normalised_evolution", "energyNormR1YPct"),
+    ("rolling_month_normalised_evolution", "energyNormR1MPct"),
+    ("consumption_anomaly_score", "anomalyScore"),
+    ("consumption_expected_energy", "anomalyExpected"),
+)
+
+# KPI warnings ("ON"/"OFF") written as booleans
+KPI_WARNING_FIELDS = (
+    ("current_month_threshold_warning", "tshM0Warn"),
+    ("previous_month_threshold_warning", "tshM1Warn"),
+    ("consumption_anomaly_warning", "anomalyWarn"),
+)
+
+# Line protocol escaping
+TAG_ESCAPE = str.maketrans({'\\': '\\\\', ',': '\\,', '=': '\\=', ' ': '\\ ', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+
+# Escape a tag key or value
+def _escapeTag(value):
+    return str(value).translate(TAG_ESCAPE)
+
+# Return the tag set in line protocol, sorted by key, empty tags are ignored
+def _getTags(tags):
+    return ",".join(f"{_escapeTag(key)}={_escapeTag(value)}" for key, value in sorted(tags.items())
+                    if value is not None and str(value) != "")
+
+# Return the field set in line protocol, integers are suffixed by i
+def _getFields(fields):
+    fieldList = []
+    for key, value in fields.items():
+        if value is None:
+            continue
+        elif isinstance(value, bool):
+            value = "true" if value else "false"
+        elif isinstance(value, int):
+            value = f"{value}i"
+        elif isinstance(value, float):
+            value = repr(value)
+            if value.endswith(".0"):
+                value = value[:-2]
+        else:
+            value = '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+        fieldList.append(f"{_escapeTag(key)}={value}")
+    return ",".join(fieldList)
+
+# Return the timestamp in nanoseconds of a date, naive dates are UTC
+def _getTimestamp(myDate):
+    if myDate.tzinfo is not None:
+        myDate = myDate.astimezone(timezone.utc)
+    return (calendar.timegm(myDate.timetuple()) * 1000000 + myDate.microsecond) * 1000
+
+# Return the hash of the values of each month
+def _getMonthHashList(itemList,getValues):
+
+    monthHashList = {}
+    for myItem in itemList:
+        month = myItem.date.strftime("%Y-%m")
+        if month not in monthHashList:
+            monthHashList[month] = hashlib.sha1()
+        monthHashList[month].update(repr(getValues(myItem)).encode('utf-8'))
+    return {month: myHash.hexdigest() for month, myHash in monthHashList.items()}
+
+# Return the items to export and the new watermark
+# Items are exported when they are after the watermark date or when the hash of their month changed,
+# and when they are not older than the horizon date
+def getExportList(itemList,getValues,watermark,horizonDate=None):
+
+    monthHashList = _getMonthHashList(itemList,getValues)
+
+    if watermark:
+        watermarkDate = watermark["date"]
+        watermarkHashList = watermark["months"]
+        exportList = [myItem for myItem in itemList
+                      if myItem.date.strftime("%Y-%m-%d") > watermarkDate
+                      or watermarkHashList.get(myItem.date.strftime("%Y-%m")) != monthHashList[myItem.date.strftime("%Y-%m")]]
+    else:
+        exportList = list(itemList)
+
+    if horizonDate is not None:
+        exportList = [myItem for myItem in exportList if myItem.date >= horizonDate]
+
+    newWatermark = None
+    if itemList:
+        newWatermark = {
+            "date": max(myItem.date for myItem in itemList).strftime("%Y-%m-%d"),
+            "months": monthHashList
+        }
+    return exportList, newWatermark
+
+
+# Return the first date of the period containing a date
+def getPeriodStart(myDate,period):
+    if period == "week":
+        return myDate - timedelta(days=myDate.weekday())
+    elif period == "month":
+        return myDate.replace(day=1)
+    elif period == "year":
+        return myDate.replace(month=1, day=1)
+    return myDate
+
+
+# Class of measures aggregated over a period
+class Aggregate():
+
+    def __init__(self,pce,period,date):
+
+        self.pce = pce
+        self.period = period
+        self.date = date
+        self.startIndex = None
+        self.endIndex = None
+        self.volume = 0
+        self.volumeGross = 0.0
+        self.energy = 0
+        self.cost = 0.0
+        self.dayCount = 0
+
+    # Add a measure to the aggregate, measures are added by date
+    def add(self,measure,cost):
+
+        if self.startIndex is None:
+            self.startIndex = measure.startIndex
+        self.endIndex = measure.endIndex
+        self.volume += measure.volume or 0
+        self.volumeGross += measure.volumeGross or 0
+        self.energy += measure.energy or 0
+        self.cost += cost
+        self.dayCount += 1
+
+    # Return the average conversion factor of the period
+    def getConversionFactor(self):
+        if self.volume:
+            return self.energy / self.volume
+        return None
+
 
 # Class influx DB
 class InfluxDb:
@@ -26,27 +199,84 @@ class InfluxDb:
         self.org = None
         self.client = None
         self.writeApi = None
-
-    # Connexion
-    def connect(self,host,port, org, bucket, token):
+        self.isBatch = False
+        self.maxError = WRITE_MAX_ERROR
+        self.writeCount = 0
+        self.errorCount = 0
+        self.retryCount = 0
+        self.lock = threading.Lock()
+        self.pceTagsCache = {}
+        self.dateTagsCache = {}
+
+    # Connexion, points are written by batch when batchSize is greater than 0
+    def connect(self,host,port, org, bucket, token, batchSize=0, flushInterval=1000, gzip=False,
+                maxRetries=5, retryInterval=5000, jitterInterval=0, maxError=WRITE_MAX_ERROR):
 
         self.host = host
         self.port = port
         self.org = org
         self.bucket = bucket
         self.token = token
+        self.isBatch = batchSize > 0
+        self.maxError = maxError
 
         url = "http://" + host + ":" + str(port)
 
+        # The client library is long to import, it is only loaded when Influxdb is enabled
+        from influxdb_client import InfluxDBClient
+        from influxdb_client.client.write_api import SYNCHRONOUS, WriteOptions, WriteType
+
         try:
-            self.client = InfluxDBClient(url=url, token=token, org=org)
-            self.writeApi = self.client.write_api(write_options=SYNCHRONOUS)
+            self.client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=gzip)
+            if self.isBatch:
+                writeOptions = WriteOptions(write_type=WriteType.batching,
+                                            batch_size=batchSize,
+                                            flush_interval=flushInterval,
+                                            jitter_interval=jitterInterval,
+                                            retry_interval=retryInterval,
+                                            max_retries=maxRetries)
+                self.writeApi = self.client.write_api(write_options=writeOptions,
+                                                      success_callback=self._onSuccess,
+                                                      error_callback=self._onError,
+                                                      retry_callback=self._onRetry)
+                logging.debug("Influxdb batch mode : batch size %s, flush interval %s ms", batchSize, flushInterval)
+            else:
+                self.writeApi = self.client.write_api(write_options=SYNCHRONOUS)
 
         except Exception as e:
             print(e)
 
-    # Set measure point
-    def setMeasurePoint(self,measure,prices):
+    # Return the number of points of a batch
+    def _countPoints(self,data):
+        if isinstance(data, bytes):
+            return data.count(b'\n') + 1
+        elif isinstance(data, str):
+            return data.count('\n') + 1
+        return 1
+
+    # Callback of batch written
+    def _onSuccess(self,conf,data):
+        with self.lock:
+            self.writeCount += self._countPoints(data)
+
+    # Callback of batch in error after all retries
+    def _onError(self,conf,data,exception):
+        with self.lock:
+            self.errorCount += self._countPoints(data)
+        logging.error("Unable to write batch of points : %s", exception)
+
+    # Callback of batch retried
+    def _onRetry(self,conf,data,exception):
+        with self.lock:
+            self.retryCount += 1
+        logging.warning("Retry of batch of points : %s", exception)
+
+    # Return True when the number of points in error exceeds the maximum accepted
+    def tooManyErrors(self):
+        return self.errorCount > self.maxError
+
+    # Return the cost in Eur of a measure
+    def getMeasureCost(self,measure,prices):
 
         myDate = measure.date
 
@@ -60,87 +290,156 @@ class InfluxDb:
                 myFixPrice = myPrice.fixPrice
 
         # Calculate the cost in Eur
-        myCost = ( myKwhPrice * measure.energy ) + myFixPrice
-
-        point = [{
-            "measurement": "gazpar_informative_measure", # container of tags
-            "tags": {
-                "pce": measure.pce.pceId,
-                "pce_alias": measure.pce.alias,
-                "type": measure.type,
-                "year": myDate.strftime("%Y"),
-                "month": int(myDate.strftime("%m")),
-                "month_name": myDate.strftime("%b"),
-                "weekday_name": myDate.strftime("%A"),
-                "weekday_no": myDate.weekday()
-            },
-            "fields": {
-                "start_index": measure.startIndex,
-                "end_index" : measure.endIndex,
-                "gas_mcube": float(measure.volume),
-                "gas_mcube_gross": float(measure.volumeGross),
-                "energy_kWh" : float(measure.energy),
-                "conversion_factor": float(measure.conversionFactor),
-                "cost_eur" : float(myCost)
-            },
-            "time": myDate
-        }]
-
-        logging.debug("Point : %s",point)
-        return point
+        return ( myKwhPrice * measure.energy ) + myFixPrice
 
-    # Set PCE point
-    def setPcePoint(self,pce):
+    # Return the values of a measure point, used to detect changes
+    def getMeasureValues(self,measure,prices):
+        return (measure.startIndex, measure.endIndex, measure.volume, measure.volumeGross,
+                measure.energy, measure.conversionFactor, self.getMeasureCost(measure,prices), measure.temperature)
 
-        myDate = datetime.today()
+    # Return the values of a threshold point, used to detect changes
+    def getThresholdValues(self,threshold):
+        return (threshold.energy,)
+
+    # Return the values of an aggregate point, used to detect changes
+    def getAggregateValues(self,aggregate):
+        return (aggregate.startIndex, aggregate.endIndex, aggregate.volume, aggregate.volumeGross,
+                aggregate.energy, round(aggregate.cost, 6), aggregate.dayCount)
+
+    # Return the measures aggregated by period : {period: [aggregates sorted by date]}
+    def getAggregateList(self,measureList,prices):
+
+        aggregateList = {period: {} for period in AGGREGATE_PERIODS}
+        for myMeasure in sorted(measureList, key=lambda myMeasure: myMeasure.date):
+            myCost = self.getMeasureCost(myMeasure,prices)
+            for period in AGGREGATE_PERIODS:
+                myDate = getPeriodStart(myMeasure.date,period)
+                if myDate not in aggregateList[period]:
+                    aggregateList[period][myDate] = Aggregate(myMeasure.pce,period,myDate)
+                aggregateList[period][myDate].add(myMeasure,myCost)
+
+        return {period: list(aggregates.values()) for period, aggregates in aggregateList.items()}
+
+    # Return the tags of a PCE in line protocol
+    def _getPceTags(self,pce):
+
+        if pce.pceId not in self.pceTagsCache:
+            self.pceTagsCache[pce.pceId] = _getTags({"pce": pce.pceId, "pce_alias": pce.alias})
+        return self.pceTagsCache[pce.pceId]
+
+    # Return the calendar tags and timestamp of a date in line protocol
+    def _getDateTags(self,myDate):
 
-        point = [{
-            "measurement": "gazpar_pce_measure",  # container of tags
-            "tags": {
-                "pce": pce.pceId,
-                "type": "pce",
-                "pce_alias": pce.alias,
+        if myDate not in self.dateTagsCache:
+            tags = _getTags({
                 "year": myDate.strftime("%Y"),
-                "month": myDate.strftime("%m"),
+                "month": myDate.month,
                 "month_name": myDate.strftime("%b"),
-                "owner_name": pce.ownerName,
-                "postal_code": pce.postalCode,
-                "activation_date": pce.activationDate,
-                "frequence_releve": pce.frequenceReleve,
-                "state": pce.state,
-            },
-            "fields": {
-                "pce_count": 1,
-            },
-            "time": myDate
-        }]
-
-        logging.debug("Point : %s", point)
-        return point
+                "weekday_name": myDate.strftime("%A"),
+                "weekday_no": myDate.weekday()
+            })
+            self.dateTagsCache[myDate] = (tags, _getTimestamp(myDate))
+        return self.dateTagsCache[myDate]
 
     # Set measure point
-    def setThresoldPoint(self, thresold):
+    def setMeasurePoint(self,measure,prices):
 
-        myDate = thresold.date
+        myDate = measure.date
 
-        point = [{
-            "measurement": "gazpar_thresold_measure",  # container of tags
-            "tags": {
-                "pce": thresold.pce.pceId,
-                "type": "thresold",
-                "pce_alias": thresold.pce.alias,
-                "year": myDate.strftime("%Y"),
-                "month": myDate.strftime("%m"),
-                "month_name": myDate.strftime("%b"),
-            },
-            "fields": {
-                "energy_kWh": float(thresold.energy),
-            },
-            "time": myDate
-        }]
+        # Calculate the cost in Eur
+        myCost = self.getMeasureCost(measure,prices)
+
+        dateTags, timestamp = self._getDateTags(myDate)
+        fields = _getFields({
+            "start_index": measure.startIndex,
+            "end_index" : measure.endIndex,
+            "gas_mcube": float(measure.volume),
+            "gas_mcube_gross": float(measure.volumeGross),
+            "energy_kWh" : float(measure.energy),
+            "conversion_factor": float(measure.conversionFactor),
+            "cost_eur" : float(myCost),
+            "temperature_degC": measure.temperature
+        })
+
+        return f"gazpar_informative_measure,{self._getPceTags(measure.pce)},type={_escapeTag(measure.type)},{dateTags} {fields} {timestamp}"
+
+    # Set aggregate point
+    def setAggregatePoint(self,aggregate):
+
+        dateTags, timestamp = self._getDateTags(aggregate.date)
+        conversionFactor = aggregate.getConversionFactor()
+        fields = _getFields({
+            "start_index": aggregate.startIndex,
+            "end_index" : aggregate.endIndex,
+            "gas_mcube": float(aggregate.volume),
+            "gas_mcube_gross": float(aggregate.volumeGross),
+            "energy_kWh" : float(aggregate.energy),
+            "conversion_factor": float(conversionFactor) if conversionFactor is not None else None,
+            "cost_eur" : float(aggregate.cost),
+            "day_count": aggregate.dayCount
+        })
+
+        return f"gazpar_aggregate_measure,{self._getPceTags(aggregate.pce)},period={aggregate.period},type=informative,{dateTags} {fields} {timestamp}"
+
+    # Set KPI point of the day, return None when the KPIs have not been calculated
+    def setKpiPoint(self,pce,pceKpi):
+
+        values = {}
+        for field, attribute in KPI_FIELDS:
+            value = getattr(pceKpi, attribute, None)
+            if value is not None:
+                values[field] = float(value)
+        for field, attribute in KPI_WARNING_FIELDS:
+            value = getattr(pceKpi, attribute, None)
+            if value is not None:
+                values[field] = value == "ON"
+        if not values:
+            return None
+
+        myDate = datetime.combine(datetime.today().date(), datetime.min.time())
+        dateTags, timestamp = self._getDateTags(myDate)
+
+        return f"gazpar_kpi_measure,{self._getPceTags(pce)},type=informative,{dateTags} {_getFields(values)} {timestamp}"
+
+    # Set PCE point
+    def setPcePoint(self,pce):
 
-        logging.debug("Point : %s", point)
-        return point
+        myDate = datetime.today()
+
+        tags = _getTags({
+            "pce": pce.pceId,
+            "type": "pce",
+            "pce_alias": pce.alias,
+            "year": myDate.strftime("%Y"),
+            "month": myDate.strftime("%m"),
+            "month_name": myDate.strftime("%b"),
+            "owner_name": pce.ownerName,
+            "postal_code": pce.postalCode,
+            "activation_date": pce.activationDate,
+            "frequence_releve": pce.frequenceReleve,
+            "state": pce.state,
+        })
+        fields = _getFields({
+            "pce_count": 1,
+        })
+
+        return f"gazpar_pce_measure,{tags} {fields} {_getTimestamp(myDate)}"
+
+    # Set threshold point
+    def setThresholdPoint(self, threshold):
+
+        myDate = threshold.date
+
+        tags = _getTags({
+            "year": myDate.strftime("%Y"),
+            "month": myDate.strftime("%m"),
+            "month_name": myDate.strftime("%b"),
+        })
+        fields = _getFields({
+            "energy_kWh": float(threshold.energy),
+        })
+
+        return f"gazpar_thresold_measure,{self._getPceTags(threshold.pce)},type=thresold,{tags} {fields} {_getTimestamp(myDate)}"
 
     # Set price point
     def setPricePoint(self, pce, price,isDefault,defaultKwh,defaultFix):
@@ -154,46 +453,59 @@ class InfluxDb:
             myKwh = price.kwhPrice
             myFix = price.fixPrice
 
-        point = [{
-            "measurement": "gazpar_price_measure",  # container of tags
-            "tags": {
-                "pce": pce.pceId,
-                "pce_alias": pce.alias,
-                "type": "price",
-                "year": myDate.strftime("%Y"),
-                "month": int(myDate.strftime("%m")),
-                "month_name": myDate.strftime("%b"),
-                "weekday_name": myDate.strftime("%A"),
-                "weekday_no": myDate.weekday()
-            },
-            "fields": {
-                "price_kwh_eur": float(myKwh),
-                "price_fix_eur": float(myFix)
-            },
-            "time": myDate
-        }]
-
-        logging.debug("Point : %s", point)
-        return point
-
-    # Write
+        tags = _getTags({
+            "pce": pce.pceId,
+            "pce_alias": pce.alias,
+            "type": "price",
+            "year": myDate.strftime("%Y"),
+            "month": myDate.month,
+            "month_name": myDate.strftime("%b"),
+            "weekday_name": myDate.strftime("%A"),
+            "weekday_no": myDate.weekday()
+        })
+        fields = _getFields({
+            "price_kwh_eur": float(myKwh),
+            "price_fix_eur": float(myFix)
+        })
+
+        return f"gazpar_price_measure,{tags} {fields} {_getTimestamp(myDate)}"
+
+    # Write a point or a list of points in line protocol
+    # In batch mode, points are queued and the result is counted by callbacks
     def write(self,point):
 
+        if self.tooManyErrors():
+            return False
+
+        if isinstance(point, str):
+            point = [point]
+        if not point:
+            return True
+
         try:
             self.writeApi.write(bucket=self.bucket, org=self.org, record=point)
-            time.sleep(WRITE_SLEEP)
-            logging.debug("Point written successfully: %s",point)
+            if not self.isBatch:
+                time.sleep(WRITE_SLEEP)
+                with self.lock:
+                    self.writeCount += len(point)
+                logging.debug("%s point(s) written successfully",len(point))
             return True
 
         except Exception as e:
+            with self.lock:
+                self.errorCount += len(point)
             logging.error("Unable to write point : %s", e)
-            logging.debug("Point : %s", point)
+            logging.debug("Point : %s", point[0])
             return False
 
     # Close client
     def close(self):
 
         try:
+            # Flush the pending batches
+            self.writeApi.close()
+            logging.info("Influxdb : %s point(s) written, %s point(s) in error, %s retry(ies).",
+                         self.writeCount, self.errorCount, self.retryCount)
             self.client.close()
             logging.debug("Influxdb disconnected.")
         except Exception as e:
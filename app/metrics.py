@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+### Define the instrumentation of a run. ###
+# Timers, counters and gauges are collected during a run and summarized at its end.
+# When profiling is enabled, each stage is also run under cProfile and its memory
+# allocations are traced with tracemalloc : the trace covers the whole process, it is started
+# once for all the accounts run together with startTrace() and stopped after them.
+
+import logging
+import threading
+import time
+import datetime
+import io
+import tracemalloc
+
+# Constants
+PROFILE_TOP = 15 # number of functions kept in the profile of a stage
+MEMORY_TOP = 10 # number of allocation lines kept in the memory summary
+
+# Status of a stage
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+
+# Return the key of a metric : its name followed by its labels
+def getKey(name,labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# Start the trace of the memory allocations of the process, return True when it has been started
+def startTrace(enable):
+
+    if enable and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return True
+    return False
+
+
+# Stop the trace of the memory allocations, once the runs sharing it are over
+def stopTrace():
+    tracemalloc.stop()
+
+
+# Class Metrics
+class Metrics:
+
+    # Constructor
+    def __init__(self,enable=True,profile=False,traceMemory=False):
+
+        self.enable = enable
+        self.profile = profile
+        self.traceMemory = traceMemory
+        self.lock = threading.Lock()
+        self.startDate = datetime.datetime.now()
+        self.startTime = time.monotonic()
+        self.duration = None
+        self.timers = {} # (name, labels) : list of durations in seconds
+        self.counters = {} # (name, labels) : value
+        self.gauges = {} # (name, labels) : value
+        self.stages = {} # name : duration, status, memory and profile of the stage
+        self.runningStages = {} # name : start time, profiler and memory of the stages in progress
+        self.memoryTop = []
+
+
+    # State sent to another process : the lock and the stages in progress are not kept
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["runningStages"] = {}
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    # Record the duration of an operation
+    def observe(self,name,seconds,**labels):
+        if not self.enable:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.timers.setdefault(key, []).append(seconds)
+
+
+    # Increment a counter
+    def count(self,name,value=1,**labels):
+        if not self.enable:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    # Set a gauge
+    def gauge(self,name,value,**labels):
+        if not self.enable:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+
+    # Start a stage, it must be ended by the same thread
+    def startStage(self,name):
+
+        if not self.enable:
+            return
+
+        profiler = None
+        if self.profile:
+            import cProfile # only loaded when profiling is enabled
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Only one profiler can be active at a time on some Python versions
+                logging.warning("Unable to profile stage %s : %s",name,e)
+                profiler = None
+
+        memory = None
+        if tracemalloc.is_tracing():
+            memory = tracemalloc.get_traced_memory()[0]
+
+        with self.lock:
+            self.runningStages[name] = (time.monotonic(), profiler, memory)
+
+
+    # End a stage and record its duration, memory and profile
+    def endStage(self,name,status=STATUS_OK):
+
+        if not self.enable or name not in self.runningStages:
+            return
+
+        with self.lock:
+            startTime, profiler, memory = self.runningStages.pop(name)
+        myStage = {"duration": round(time.monotonic() - startTime, 3), "status": status}
+
+        # Memory is traced for the whole process, the delta is approximate when stages run concurrently
+        if memory is not None and tracemalloc.is_tracing():
+            myStage["memory"] = tracemalloc.get_traced_memory()[0] - memory
+
+        if profiler is not None:
+            import pstats
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+            myStage["profile"] = stream.getvalue()
+
+        with self.lock:
+            # A stage abandoned after its timeout keeps its status
+            if name in self.stages:
+                myStage["status"] = self.stages[name]["status"]
+            self.stages[name] = myStage
+
+
+    # Update the status of a stage
+    def setStageStatus(self,name,status):
+        with self.lock:
+            if name in self.stages:
+                self.stages[name]["status"] = status
+            else:
+                self.stages[name] = {"duration": None, "status": status}
+
+
+    # End of the run
+    def stop(self):
+
+        self.duration = round(time.monotonic() - self.startTime, 3)
+
+        if tracemalloc.is_tracing() and self.traceMemory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.gauge("memory_current_bytes", current)
+            self.gauge("memory_peak_bytes", peak)
+            snapshot = tracemalloc.take_snapshot()
+            self.memoryTop = [str(myStat) for myStat in snapshot.statistics("lineno")[:MEMORY_TOP]]
+
+
+    # Return the status of the run : ok when every stage is ok
+    def getStatus(self):
+        for myStage in self.stages.values():
+            if myStage["status"] != STATUS_OK:
+                return STATUS_ERROR
+        return STATUS_OK
+
+
+    # Return the summary of the run, profiles excepted
+    def getSummary(self):
+
+        with self.lock:
+            summary = {
+                "start": self.startDate.strftime("%Y-%m-%d %H:%M:%S"),
+                "duration": self.duration,
+                "status": self.getStatus(),
+                "stages": {name: {key: value for key, value in myStage.items() if key != "profile"}
+                           for name, myStage in self.stages.items()},
+                "timers": {getKey(name, labels): {"count": len(durations),
+                                                  "total": round(sum(durations), 3),
+                                                  "max": round(max(durations), 3)}
+                           for (name, labels), durations in self.timers.items()},
+                "counters": {getKey(name, labels): value for (name, labels), value in self.counters.items()},
+                "gauges": {getKey(name, labels): value for (name, labels), value in self.gauges.items()},
+            }
+        return summary
+
+
+    # Write the summary of the run into the log
+    def logSummary(self):
+
+        summary = self.getSummary()
+        logging.info("Run started at %s, ended in %s s with status %s.",summary["start"],summary["duration"],summary["status"])
+        for name, myStage in summary["stages"].items():
+            logging.info("Stage %s : %s s, status %s%s",name,myStage["duration"],myStage["status"],
+                         f", memory {myStage['memory']} bytes" if "memory" in myStage else "")
+        for name, myTimer in summary["timers"].items():
+            logging.info("Timer %s : %s call(s), %s s, max %s s",name,myTimer["count"],myTimer["total"],myTimer["max"])
+        for name, value in summary["counters"].items():
+            logging.info("Counter %s : %s",name,value)
+        for name, value in summary["gauges"].items():
+            logging.info("Gauge %s : %s",name,value)
+
+        # Profiles are only available when profiling is enabled
+        for name, myStage in self.stages.items():
+            if "profile" in myStage:
+                logging.info("Profile of stage %s :\n%s",name,myStage["profile"])
+        if self.memoryTop:
+            logging.info("Top memory allocations :\n%s","\n".join(self.memoryTop))
@@ -3,6 +3,7 @@
 import paho.mqtt.client as mqtt
 import paho.mqtt
 import time
+import threading
 import logging
 import ssl
 
@@ -15,6 +16,10 @@ class Mqtt:
         self.isSsl = isSsl
         self.qos = qos
         self.retain = retain
+        self.messages = {}
+        self.publishCount = 0 # number of messages handed to the broker
+        self.publishBytes = 0 # size of their payloads
+        self.countLock = threading.Lock() # the counters are updated by the threads of the accounts sharing the client
         # Create instance
         self.mqtt = mqtt.Client(client_id=clientId)
         self.client = mqtt.Client(client_id=clientId)
@@ -51,6 +56,14 @@ class Mqtt:
     # Callback on_publish
     def onPublish(self,client, userdata, mid):
         logging.debug("Mqtt on_publish callback : message published")
+
+    # Callback on_message
+    def onMessage(self,client, userdata, message):
+        myPayload = message.payload.decode('utf-8', errors='replace')
+        logging.debug("Mqtt on_message callback : payload %s received on topic %s, retain %s",myPayload,message.topic,message.retain)
+        # Retained messages are replayed on each subscription, only live ones are kept
+        if not message.retain:
+            self.messages[message.topic] = myPayload
             
     # Connect
     def connect(self,host,port):
@@ -87,14 +100,40 @@ class Mqtt:
         self.client.disconnect
   
 
-    # Publish
-    def publish(self,topic,payload):
+    # Subscribe
+    def subscribe(self,topic):
+
+        logging.debug("Mqtt subscribe : subscription to topic %s...",topic)
+        self.client.message_callback_add(topic, self.onMessage)
+        self.client.subscribe(topic, self.qos)
+
+
+    # Return the last live message received on a topic
+    def getMessage(self,topic):
+        return self.messages.get(topic)
+
+
+    # Publish, return True when the message has been handed to the connected broker
+    def publish(self,topic,payload,qos=None,retain=None):
 
+        if qos is None: qos = self.qos
+        if retain is None: retain = self.retain
         logging.debug("Mqtt publish : publication...")
         myPayload = str(payload)
-        logging.debug("Publishing payload %s to topic %s, qos %s, retain %s",payload,topic, self.qos, self.retain)
-        self.client.publish(topic, payload=myPayload, qos=self.qos, retain=self.retain)
+        logging.debug("Publishing payload %s to topic %s, qos %s, retain %s",payload,topic, qos, retain)
+        if not self.isConnected:
+            logging.debug("Mqtt publish : broker is not connected")
+            return False
+        info = self.client.publish(topic, payload=myPayload, qos=qos, retain=retain)
         if self.isSsl:
             time.sleep(1)
         else:
             time.sleep(200/1000) # 200ms
+        # The result of the publication alone tells whether the message is sent : a message handed to the
+        # client is not queued again when the connection drops right after
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        with self.countLock:
+            self.publishCount += 1
+            self.publishBytes += len(myPayload.encode('utf-8'))
+        return True
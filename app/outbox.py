@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+### Define durable outbox of Mqtt messages. ###
+# Messages which cannot be published are stored in the SQLite database
+# and published in the same order once the broker is back.
+# Stored messages are committed once by stage, with commit() or drain().
+
+import logging
+import datetime
+
+
+# Class Outbox
+class Outbox:
+
+    # Constructor
+    def __init__(self,db,mqtt,qos,retain):
+
+        self.db = db
+        self.mqtt = mqtt
+        self.qos = qos # qos and retain of the messages stored, even when there is no connection to the broker
+        self.retain = retain
+        self.pendingCount = self.count()
+
+
+    # Return True when the broker can receive messages
+    def isConnected(self):
+        return self.mqtt is not None and self.mqtt.isConnected
+
+
+    # Return the number of messages waiting in the outbox
+    def count(self):
+
+        self.db.cur.execute("SELECT count(*) FROM outbox")
+        return self.db.cur.fetchone()[0]
+
+
+    # Publish a message, or store it in the outbox when it cannot be published
+    def publish(self,topic,payload):
+
+        # Messages are published directly only when nothing is waiting, to keep the order
+        if self.isConnected() and self.pendingCount == 0:
+            if self.mqtt.publish(topic,payload):
+                return True
+
+        self.push(topic,payload)
+        return False
+
+
+    # Store a message into the outbox
+    def push(self,topic,payload):
+
+        # A retained state supersedes the previous one waiting on the same topic
+        if self.retain:
+            self.db.cur.execute("DELETE FROM outbox WHERE topic = ? AND retain = 1", [topic])
+            self.pendingCount -= self.db.cur.rowcount
+
+        logging.debug("Store message of topic %s into outbox",topic)
+        self.db.cur.execute("INSERT INTO outbox (topic, payload, qos, retain, created) VALUES (?, ?, ?, ?, ?)",
+                            [topic, str(payload), self.qos, self.retain, datetime.datetime.now()])
+        self.pendingCount += 1
+
+
+    # Commit the messages stored into the outbox
+    def commit(self):
+        self.db.commit()
+
+
+    # Publish the messages of the outbox in their order of arrival
+    def drain(self):
+
+        if not self.isConnected():
+            self.commit()
+            return 0
+
+        self.db.cur.execute("SELECT id, topic, payload, qos, retain FROM outbox ORDER BY id")
+        queryResult = self.db.cur.fetchall()
+
+        publishedIdList = []
+        for myId, topic, payload, qos, retain in queryResult:
+            if not self.mqtt.publish(topic,payload,qos,bool(retain)):
+                logging.warning("Broker unavailable, %s message(s) kept in outbox.",len(queryResult) - len(publishedIdList))
+                break
+            publishedIdList.append([myId])
+
+        # Remove published messages
+        self.db.cur.executemany("DELETE FROM outbox WHERE id = ?", publishedIdList)
+        self.db.commit()
+        self.pendingCount -= len(publishedIdList)
+
+        return len(publishedIdList)
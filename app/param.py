@@ -24,6 +24,8 @@ class Params:
     self.grdfUsername = 'xxx'
     self.grdfPassword = 'xxx'
     self.grdfStartDate = '2020-01-01'
+    self.gapRetryMax = 0 # requests made to fill a gap in the measures before giving up, 0 disables the backfill
+    self.gapMaxRequests = 10 # requests made to fill gaps by PCE and by run
     
     # Mqtt params
     self.mqttHost = '192.168.x.y'
@@ -38,6 +40,18 @@ class Params:
  
     # Run params
     self.scheduleTime = None
+    self.parallelStages = True # run the sinks concurrently
+    self.stageTimeout = 600 # seconds, 0 for no timeout
+    self.scheduleMode = 'fixed' # fixed : run at schedule time, adaptive : run when GRDF usually publishes
+    self.scheduleRetryMin = 15 # minutes, first retry of the adaptive mode
+    self.scheduleRetryMax = 240 # minutes, longest retry of the adaptive mode
+    self.scheduleMargin = 30 # minutes, the adaptive window starts before the usual arrival time
+
+    # Multi-account params
+    self.accountsFile = None # json file of the GRDF accounts, None for a single account
+    self.accountsWorkers = 4 # maximum number of accounts run concurrently by a process
+    self.accountsProcesses = 1 # number of processes sharing the accounts, 1 to run them all in the main process
+    self.accountName = None # name of the account of a multi-account run
     
     # Publication params
     self.standalone = False
@@ -48,6 +62,10 @@ class Params:
     # Publication in HA long term statistics 
     self.hassLts = False    
     self.hassLtsDelete = False
+    self.hassLtsIncremental = True
+    self.hassLtsCorrectionDays = 7 # number of last days sent again on each incremental import
+    self.hassLtsChunkSize = 500 # maximum number of statistics per import command
+    self.hassLtsPipeline = 4 # maximum number of import commands waiting for their result
     self.hassToken = ""  # Long-Lived Access Token
     self.hassStatisticsUri = "/api/services/recorder/import_statistics"
     self.hassHost = "http://192.168.x.y:8213"  
@@ -60,12 +78,32 @@ class Params:
     # Database params
     self.dbInit = False
     self.dbPath = '/data'
+    self.snapshotEnable = False # binary snapshot file of the measures, for faster loads of the database
+
+    # Export params
+    self.exportEnable = False # columnar export of the measures, requires pyarrow
+    self.exportPath = None # None to export to the export directory of the database path
+    self.exportFormat = 'parquet' # parquet or arrow
     
     # Debug param
     self.debug = False
+
+    # Instrumentation params
+    self.metricsEnable = False
+    self.metricsProfile = False # cProfile of each stage
+    self.metricsTraceMemory = False # tracemalloc of the run
+    self.metricsPort = None # port of the Prometheus endpoint, None to disable it
     
     # Threshold param
     self.thresholdPercentage = 80
+
+    # Degree days param
+    self.hddBaseTemperature = 18.0 # °C, base temperature of the heating degree days
+
+    # Anomaly detector param
+    self.anomalyEnable = False
+    self.anomalyThreshold = 4.0 # score (in standard deviations) from which a day is an anomaly
+    self.anomalyAlpha = 0.1 # weight of a new day in the rolling statistics
     
     # Influx db
     self.influxEnable = False
@@ -74,7 +112,14 @@ class Params:
     self.influxBucket = None
     self.influxOrg = None
     self.influxToken = None
-    self.influxHorizon = None
+    self.influxHorizon = None # number of days exported, None for all history
+    self.influxBatchSize = 1000 # 0 to write each point synchronously
+    self.influxFlushInterval = 1000 # ms
+    self.influxGzip = False
+    self.influxMaxRetries = 5
+    self.influxRetryInterval = 5000 # ms
+    self.influxJitterInterval = 0 # ms
+    self.influxMaxError = 20 # maximum number of points in error before abort
 
     # Price params
     self.priceKwhDefault = 0.07
@@ -91,6 +136,13 @@ class Params:
     self.getFromArgs()
     
     
+  # State sent to another process : the parser of the command line is not kept
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop("parser", None)
+    return state
+
+
   # Set arguments list
   def initArg(self):
     
@@ -147,6 +199,8 @@ class Params:
     if "GRDF_USERNAME" in os.environ: self.grdfUsername = os.environ["GRDF_USERNAME"]
     if "GRDF_PASSWORD" in os.environ: self.grdfPassword = os.environ["GRDF_PASSWORD"]
     if "GRDF_STARTDATE" in os.environ: self.grdfStartDate = os.environ["GRDF_STARTDATE"]
+    if "GAP_RETRY_MAX" in os.environ: self.gapRetryMax = int(os.environ["GAP_RETRY_MAX"])
+    if "GAP_MAX_REQUESTS" in os.environ: self.gapMaxRequests = int(os.environ["GAP_MAX_REQUESTS"])
 
       
     if "MQTT_HOST" in os.environ: self.mqttHost = os.environ["MQTT_HOST"]
@@ -160,6 +214,16 @@ class Params:
     if "MQTT_SSL" in os.environ: self.mqttSsl = _isItTrue(os.environ["MQTT_SSL"])
       
     if "SCHEDULE_TIME" in os.environ: self.scheduleTime = os.environ["SCHEDULE_TIME"]
+    if "PARALLEL_STAGES" in os.environ: self.parallelStages = _isItTrue(os.environ["PARALLEL_STAGES"])
+    if "STAGE_TIMEOUT" in os.environ: self.stageTimeout = int(os.environ["STAGE_TIMEOUT"])
+    if "SCHEDULE_MODE" in os.environ: self.scheduleMode = os.environ["SCHEDULE_MODE"].lower()
+    if "SCHEDULE_RETRY_MIN" in os.environ: self.scheduleRetryMin = int(os.environ["SCHEDULE_RETRY_MIN"])
+    if "SCHEDULE_RETRY_MAX" in os.environ: self.scheduleRetryMax = int(os.environ["SCHEDULE_RETRY_MAX"])
+    if "SCHEDULE_MARGIN" in os.environ: self.scheduleMargin = int(os.environ["SCHEDULE_MARGIN"])
+
+    if "ACCOUNTS_FILE" in os.environ and os.environ["ACCOUNTS_FILE"]: self.accountsFile = os.environ["ACCOUNTS_FILE"]
+    if "ACCOUNTS_WORKERS" in os.environ: self.accountsWorkers = int(os.environ["ACCOUNTS_WORKERS"])
+    if "ACCOUNTS_PROCESSES" in os.environ: self.accountsProcesses = int(os.environ["ACCOUNTS_PROCESSES"])
       
     if "STANDALONE_MODE" in os.environ: self.standalone = _isItTrue(os.environ["STANDALONE_MODE"])
     if "HASS_DISCOVERY" in os.environ: self.hassDiscovery = _isItTrue(os.environ["HASS_DISCOVERY"])
@@ -168,6 +232,10 @@ class Params:
     
     if "HASS_LTS" in os.environ: self.hassLts = _isItTrue(os.environ["HASS_LTS"])
     if "HASS_LTS_DELETE" in os.environ: self.hassLtsDelete = _isItTrue(os.environ["HASS_LTS_DELETE"])
+    if "HASS_LTS_INCREMENTAL" in os.environ: self.hassLtsIncremental = _isItTrue(os.environ["HASS_LTS_INCREMENTAL"])
+    if "HASS_LTS_CORRECTION_DAYS" in os.environ: self.hassLtsCorrectionDays = int(os.environ["HASS_LTS_CORRECTION_DAYS"])
+    if "HASS_LTS_CHUNK_SIZE" in os.environ: self.hassLtsChunkSize = int(os.environ["HASS_LTS_CHUNK_SIZE"])
+    if "HASS_LTS_PIPELINE" in os.environ: self.hassLtsPipeline = int(os.environ["HASS_LTS_PIPELINE"])
     if "HASS_LTS_TOKEN" in os.environ: self.hassToken = os.environ["HASS_LTS_TOKEN"]
     if "HASS_LTS_URI" in os.environ: self.hassStatisticsUri = os.environ["HASS_LTS_URI"]
     if "HASS_LTS_HOST" in os.environ: self.hassHost = os.environ["HASS_LTS_HOST"]
@@ -178,6 +246,11 @@ class Params:
     if "HASS_SSL_KEYFILE" in os.environ: self.hassSslKeyfile = os.environ["HASS_SSL_KEYFILE"] 
          
     if "THRESHOLD_PERCENTAGE" in os.environ: self.thresholdPercentage = int(os.environ["THRESHOLD_PERCENTAGE"])
+    if "HDD_BASE_TEMPERATURE" in os.environ: self.hddBaseTemperature = float(os.environ["HDD_BASE_TEMPERATURE"])
+
+    if "ANOMALY_ENABLE" in os.environ: self.anomalyEnable = _isItTrue(os.environ["ANOMALY_ENABLE"])
+    if "ANOMALY_THRESHOLD" in os.environ: self.anomalyThreshold = float(os.environ["ANOMALY_THRESHOLD"])
+    if "ANOMALY_ALPHA" in os.environ: self.anomalyAlpha = float(os.environ["ANOMALY_ALPHA"])
     
     if "INFLUXDB_ENABLE" in os.environ: self.influxEnable = _isItTrue(os.environ["INFLUXDB_ENABLE"])
     if "INFLUXDB_HOST" in os.environ: self.influxHost = os.environ["INFLUXDB_HOST"]
@@ -185,16 +258,33 @@ class Params:
     if "INFLUXDB_ORG" in os.environ: self.influxOrg = os.environ["INFLUXDB_ORG"]
     if "INFLUXDB_BUCKET" in os.environ: self.influxBucket = os.environ["INFLUXDB_BUCKET"]
     if "INFLUXDB_TOKEN" in os.environ: self.influxToken = os.environ["INFLUXDB_TOKEN"]
-    if "INFLUXDB_HORIZON" in os.environ: self.influxHorizon = os.environ["INFLUXDB_HORIZON"]
+    if "INFLUXDB_HORIZON" in os.environ and os.environ["INFLUXDB_HORIZON"]: self.influxHorizon = int(os.environ["INFLUXDB_HORIZON"])
+    if "INFLUXDB_BATCH_SIZE" in os.environ: self.influxBatchSize = int(os.environ["INFLUXDB_BATCH_SIZE"])
+    if "INFLUXDB_FLUSH_INTERVAL" in os.environ: self.influxFlushInterval = int(os.environ["INFLUXDB_FLUSH_INTERVAL"])
+    if "INFLUXDB_GZIP" in os.environ: self.influxGzip = _isItTrue(os.environ["INFLUXDB_GZIP"])
+    if "INFLUXDB_MAX_RETRIES" in os.environ: self.influxMaxRetries = int(os.environ["INFLUXDB_MAX_RETRIES"])
+    if "INFLUXDB_RETRY_INTERVAL" in os.environ: self.influxRetryInterval = int(os.environ["INFLUXDB_RETRY_INTERVAL"])
+    if "INFLUXDB_JITTER_INTERVAL" in os.environ: self.influxJitterInterval = int(os.environ["INFLUXDB_JITTER_INTERVAL"])
+    if "INFLUXDB_MAX_ERROR" in os.environ: self.influxMaxError = int(os.environ["INFLUXDB_MAX_ERROR"])
       
     if "DB_INIT" in os.environ: self.dbInit = _isItTrue(os.environ["DB_INIT"])
     if "DB_PATH" in os.environ: self.dbPath = os.environ["DB_PATH"]
+    if "SNAPSHOT_ENABLE" in os.environ: self.snapshotEnable = _isItTrue(os.environ["SNAPSHOT_ENABLE"])
+
+    if "EXPORT_ENABLE" in os.environ: self.exportEnable = _isItTrue(os.environ["EXPORT_ENABLE"])
+    if "EXPORT_PATH" in os.environ: self.exportPath = os.environ["EXPORT_PATH"]
+    if "EXPORT_FORMAT" in os.environ: self.exportFormat = os.environ["EXPORT_FORMAT"]
 
     if "PRICE_KWH" in os.environ: self.priceKwhDefault = os.environ["PRICE_KWH"]    
     if "PRICE_FIX" in os.environ: self.priceFixDefault = os.environ["PRICE_FIX"]     
     if "PRICE_PATH" in os.environ: self.pricePath = os.environ["PRICE_PATH"]     
 
     if "DEBUG" in os.environ: self.debug = _isItTrue(os.environ["DEBUG"])
+
+    if "METRICS_ENABLE" in os.environ: self.metricsEnable = _isItTrue(os.environ["METRICS_ENABLE"])
+    if "METRICS_PROFILE" in os.environ: self.metricsProfile = _isItTrue(os.environ["METRICS_PROFILE"])
+    if "METRICS_TRACEMALLOC" in os.environ: self.metricsTraceMemory = _isItTrue(os.environ["METRICS_TRACEMALLOC"])
+    if "METRICS_PORT" in os.environ and os.environ["METRICS_PORT"]: self.metricsPort = int(os.environ["METRICS_PORT"])
   
   
   # Get params from arguments in command line
@@ -240,6 +330,30 @@ class Params:
     elif self.mqttHost is None:
       logging.error("Parameter MQTT host is mandatory.")
       return False
+    elif self.scheduleMode not in ('fixed','adaptive'):
+      logging.error("Parameter schedule mode must be fixed or adaptive.")
+      return False
+    elif self.gapRetryMax < 0 or self.gapMaxRequests < 0:
+      logging.error("Parameters gap retry max and gap max requests must be positive.")
+      return False
+    elif self.anomalyThreshold <= 0:
+      logging.error("Parameter anomaly threshold must be positive.")
+      return False
+    elif not 0 < self.anomalyAlpha <= 1:
+      logging.error("Parameter anomaly alpha must be between 0 and 1.")
+      return False
+    elif self.accountsWorkers < 1:
+      logging.error("Parameter accounts workers must be at least 1.")
+      return False
+    elif self.accountsProcesses < 1:
+      logging.error("Parameter accounts processes must be at least 1.")
+      return False
+    elif self.exportFormat not in ('parquet','arrow'):
+      logging.error("Parameter export format must be parquet or arrow.")
+      return False
+    elif self.accountsFile is not None and not os.path.exists(self.accountsFile):
+      logging.error("Accounts file %s not found.", self.accountsFile)
+      return False
     else:
       if self.standalone == False and self.hassDiscovery == False:
         logging.warning("Both Standalone mode and Home assistant discovery are disable. No value will be published to MQTT ! Please check your parameters.")
@@ -255,9 +369,25 @@ class Params:
                  self.mqttHost, self.mqttPort, self.mqttClientId,
                  self.mqttQos,self.mqttTopic,self.mqttRetain,
                  self.mqttSsl),
+    logging.info("Gap backfill : Retries by gap = %s, Requests by PCE = %s", self.gapRetryMax, self.gapMaxRequests)
     logging.info("Standlone mode : Enable = %s", self.standalone)
     logging.info("Home Assistant discovery : Enable = %s, Topic prefix = %s, Device name = %s",
                  self.hassDiscovery, self.hassPrefix, self.hassDeviceName)
+    logging.info("Home Assistant LTS : Enable = %s, Delete = %s, Incremental = %s, Correction days = %s, Chunk size = %s, Pipeline = %s",
+                 self.hassLts, self.hassLtsDelete, self.hassLtsIncremental, self.hassLtsCorrectionDays, self.hassLtsChunkSize, self.hassLtsPipeline)
+    logging.info("InfluxDB config : Enable = %s, host = %s, port = %s, org = %s, bucket = %s, horizon (days) = %s",
+                 self.influxEnable, self.influxHost, self.influxPort, self.influxOrg, self.influxBucket, self.influxHorizon)
+    logging.info("InfluxDB batching : Batch size = %s, Flush interval = %s ms, Gzip = %s, Max retries = %s, Retry interval = %s ms, Jitter interval = %s ms, Max errors = %s",
+                 self.influxBatchSize, self.influxFlushInterval, self.influxGzip, self.influxMaxRetries, self.influxRetryInterval,
+                 self.influxJitterInterval, self.influxMaxError)
     logging.info("Threshold options : Warning percentage = %s", self.thresholdPercentage)
-    logging.info("Database options : Force reinitialization = %s, Path = %s", self.dbInit, self.dbPath)
+    logging.info("Degree days options : Base temperature = %s °C", self.hddBaseTemperature)
+    logging.info("Anomaly detector : Enable = %s, Threshold = %s, Alpha = %s", self.anomalyEnable, self.anomalyThreshold, self.anomalyAlpha)
+    logging.info("Database options : Force reinitialization = %s, Path = %s, Snapshot file = %s", self.dbInit, self.dbPath, self.snapshotEnable)
+    logging.info("Export options : Enable = %s, Path = %s, Format = %s", self.exportEnable, self.exportPath, self.exportFormat)
+    logging.info("Run options : Parallel stages = %s, Stage timeout = %s s", self.parallelStages, self.stageTimeout)
+    logging.info("Schedule options : Mode = %s, Time = %s, Retry = %s to %s min, Margin = %s min",
+                 self.scheduleMode, self.scheduleTime, self.scheduleRetryMin, self.scheduleRetryMax, self.scheduleMargin)
+    logging.info("Multi-account : Accounts file = %s, Workers = %s, Processes = %s", self.accountsFile, self.accountsWorkers, self.accountsProcesses)
     logging.info("Debug mode : Enable = %s", self.debug)
+    logging.info("Instrumentation : Enable = %s, Profile = %s, Trace memory = %s, Prometheus port = %s", self.metricsEnable, self.metricsProfile, self.metricsTraceMemory, self.metricsPort)
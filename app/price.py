@@ -7,6 +7,7 @@ import datetime
 from gazpar import Pce
 #import pandas
 import csv
+import hashlib
 
 PRICE_DATE_FORMAT = "%Y-%m-%d"
 
@@ -52,6 +53,14 @@ class Prices():
             return
 
 
+    # Return a signature of the prices, it changes when the file or the default prices change
+    def getSignature(self):
+
+        signature = [(self.defaultKwhPrice, self.defaultFixPrice)]
+        signature += [(myPrice.pceId, myPrice.startDate, myPrice.endDate, myPrice.kwhPrice, myPrice.fixPrice) for myPrice in self.pricesList]
+        return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+
+
     # Return prices of a single Pce
     def getPricesByPce(self,pceId):
 
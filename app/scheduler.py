@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+### Define the adaptive scheduler. ###
+# GRDF publishes the measure of a day at a variable time of the following day(s).
+# The estimated arrival time of new measures is recorded by PCE, and the next runs are
+# scheduled around the usual arrival time of each PCE : from the start of its window, runs are
+# retried at growing intervals until the expected measures land, then the scheduler
+# sleeps until the window of the next day.
+
+import logging
+import datetime
+
+import database
+from gazpar import TYPE_I
+
+# Constants
+DEFAULT_TIME = "06:00" # start of the window when no schedule time is set and nothing is learned yet
+ARRIVAL_HISTORY = 30 # number of last arrivals used to learn the window
+ARRIVAL_MIN_COUNT = 3 # minimum number of arrivals before the learned window is used
+ARRIVAL_QUANTILE = 0.25 # the window starts at the arrival time reached by this share of the arrivals
+DEFAULT_LAG = 1 # number of days between a measure and its publication when nothing is learned yet
+ACTIVE_DAYS = 14 # PCEs without informative measure over these last days are not waited for
+
+
+# Return the value of a sorted list at a quantile
+def _getQuantile(valueList,quantile):
+    return valueList[int(quantile * (len(valueList) - 1))]
+
+
+# Return the estimated arrival of a measure found by a run, the previous run did not find it
+# The measure landed between both runs : the middle of this interval is kept, limited to the longest retry
+# interval when the previous run is older (first run of a window). The learned window thus settles around
+# the arrivals, instead of following the runs which found the measures and moving earlier by the margin.
+def getArrival(previousRun,foundRun,retryMax):
+
+    interval = datetime.timedelta(minutes=retryMax)
+    if previousRun is not None and previousRun < foundRun:
+        interval = min(foundRun - previousRun, interval)
+    return foundRun - interval / 2
+
+
+# Class Scheduler
+class Scheduler:
+
+    # Constructor
+    def __init__(self,dbPath,defaultTime,retryMin,retryMax,margin):
+
+        self.dbPath = dbPath
+        self.defaultTime = datetime.datetime.strptime(defaultTime, "%H:%M").time()
+        self.retryMin = retryMin # minutes
+        self.retryMax = retryMax # minutes
+        self.margin = margin # minutes before the learned arrival time
+        self.retryCount = 0
+
+
+    # Return the PCEs followed by the scheduler : the ones which received an informative measure recently
+    # PCEs with published measures only, or which no longer receive measures, would never land
+    def getPceList(self,db,now):
+
+        db.cur.execute("SELECT pce FROM measures WHERE type = ? GROUP BY pce HAVING max(date) >= ?",
+                       [TYPE_I, (now.date() - datetime.timedelta(days=ACTIVE_DAYS)).strftime(database.DATABASE_DATE_FORMAT)])
+        return [row[0] for row in db.cur.fetchall()]
+
+
+    # Return the learned start time of the window of a PCE and its publication lag in days
+    def getWindow(self,db,pceId):
+
+        arrivalList = db.getArrivalList(pceId, ARRIVAL_HISTORY)
+        if len(arrivalList) < ARRIVAL_MIN_COUNT:
+            logging.debug("Only %s arrival(s) recorded for PCE %s, default window at %s.",len(arrivalList),pceId,self.defaultTime)
+            return self.defaultTime, DEFAULT_LAG
+
+        minuteList = sorted(myArrival.hour * 60 + myArrival.minute for myDate, myArrival in arrivalList)
+        lagList = sorted((myArrival.date() - myDate.date()).days for myDate, myArrival in arrivalList)
+        minutes = max(0, _getQuantile(minuteList, ARRIVAL_QUANTILE) - self.margin)
+
+        return datetime.time(minutes // 60, minutes % 60), _getQuantile(lagList, 0.5)
+
+
+    # Return True when the expected measure of a PCE is stored
+    def isLanded(self,db,pceId,expectedDate):
+
+        db.cur.execute("SELECT count(*) FROM measures WHERE pce = ? AND type = ? AND date >= ?",
+                       [pceId, TYPE_I, expectedDate.strftime(database.DATABASE_DATE_FORMAT)])
+        return db.cur.fetchone()[0] > 0
+
+
+    # Return the date time of the next run
+    def getNextRun(self,now):
+
+        myDb = database.Database(self.dbPath)
+        myDb.open()
+        try:
+            windowList = []
+            for pceId in self.getPceList(myDb, now):
+                windowTime, lag = self.getWindow(myDb, pceId)
+                windowList.append((pceId, windowTime, self.isLanded(myDb, pceId, now.date() - datetime.timedelta(days=lag))))
+        finally:
+            myDb.close()
+
+        # No PCE to wait for : run at the default window
+        if not windowList:
+            self.retryCount = 0
+            windowStart = datetime.datetime.combine(now.date(), self.defaultTime)
+            if windowStart <= now:
+                windowStart += datetime.timedelta(days=1)
+            logging.info("No PCE with recent informative measures, next window at %s.",windowStart)
+            return windowStart
+
+        # The next run is the earliest one of the PCEs
+        nextRun = None
+        waitingList = []
+        for pceId, windowTime, landed in windowList:
+            windowStart = datetime.datetime.combine(now.date(), windowTime)
+            if landed:
+                # Measures of the day are there : sleep until the window of the next day
+                if windowStart <= now:
+                    windowStart += datetime.timedelta(days=1)
+            elif now >= windowStart:
+                # Window started and measures not received yet : retry
+                waitingList.append(pceId)
+                continue
+            nextRun = windowStart if nextRun is None else min(nextRun, windowStart)
+
+        if not waitingList:
+            self.retryCount = 0
+            logging.info("Expected measures received or window not started, next window at %s.",nextRun)
+            return nextRun
+
+        # Retry at growing intervals
+        delay = min(self.retryMin * (2 ** self.retryCount), self.retryMax)
+        self.retryCount += 1
+        retryRun = now + datetime.timedelta(minutes=delay)
+        logging.info("Expected measures of %s PCE(s) not received yet, retry %s in %s minutes.",len(waitingList),self.retryCount,delay)
+        return retryRun if nextRun is None else min(nextRun, retryRun)
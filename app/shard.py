@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+### Define the sharding of the accounts between worker processes. ###
+# In multi-account mode, the accounts can be spread over several processes so the decoding,
+# calculation and publication of their measures use several cores. Accounts are assigned to
+# the shards with a consistent hash of their name : an account keeps its shard from run to
+# run, and only a few accounts move when the number of processes changes.
+
+import bisect
+import hashlib
+
+# Constants
+SHARD_REPLICAS = 64 # points of each shard on the hash ring, to balance the accounts
+
+
+# Return the position of a key on the hash ring
+def _getHash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+# Class HashRing
+class HashRing:
+
+    # Constructor
+    def __init__(self,shardCount,replicas=SHARD_REPLICAS):
+
+        self.shardCount = shardCount
+        self.ring = sorted((_getHash(f"shard-{shardNo}#{replica}"), shardNo)
+                           for shardNo in range(shardCount) for replica in range(replicas))
+        self.hashList = [hashValue for hashValue, shardNo in self.ring]
+
+
+    # Return the shard of a key : the first point of the ring after the key
+    def getShard(self,key):
+        i = bisect.bisect(self.hashList, _getHash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+
+# Return the shards with at least one account, as (number of the shard in the ring, accounts) tuples
+# The shards left are run by worker processes numbered from 0 in this order
+def getShardList(accountList,shardCount):
+
+    myRing = HashRing(shardCount)
+    shardList = [[] for shardNo in range(shardCount)]
+    for myAccount in accountList:
+        shardList[myRing.getShard(myAccount.name)].append(myAccount)
+    return [(shardNo, shard) for shardNo, shard in enumerate(shardList) if shard]
+
+
+# Class MetricsCollector : stands for the Prometheus exporter in a worker process,
+# the metrics of the runs are sent back to the parent which updates the exporter
+class MetricsCollector:
+
+    # Constructor
+    def __init__(self):
+        self.updateList = []
+
+    # Keep the metrics of a run
+    def update(self,metrics,labels=()):
+        self.updateList.append((metrics, labels))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+### Define the binary snapshot of the database. ###
+# At the end of a run, the PCEs loaded by the sinks are written to a binary file : one section
+# by PCE, holding its measures and thresholds as columns of fixed-size numbers. On the next run,
+# the file is mapped in memory and the PCEs whose data did not change since (same data version
+# in the database) are rebuilt from the columns, without parsing the dates of each row.
+# The file is versioned, checksummed and bound to the database by its data token : an invalid
+# or foreign file is ignored and the PCEs are loaded from the database.
+
+import os
+import sys
+import mmap
+import json
+import zlib
+import array
+import struct
+import logging
+import datetime
+
+import database
+from gazpar import TYPE_I, TYPE_P
+
+# Constants
+SNAPSHOT_NAME = "gazpar2mqtt.snapshot"
+SNAPSHOT_MAGIC = b"G2MSNAP\0"
+SNAPSHOT_VERSION = 2 # format of the file, a file of another format is ignored
+HEADER = struct.Struct("<8sHH32sQII4x") # magic, format, reserved, data token, payload length, crc32, PCE count
+SECTION = struct.Struct("<IQII") # length of the PCE json, data version, measure count, threshold count
+TYPE_LIST = (TYPE_I, TYPE_P)
+NONE_INT = -2 ** 63 # stands for None in integer columns, None is NaN in float columns
+SECONDS_PER_DAY = 86400
+
+# Columns of the measures : attribute, array type code
+MEASURE_COLUMNS = (
+    ("type", "b"),
+    ("date", "i"),
+    ("periodStart", "q"),
+    ("periodEnd", "q"),
+    ("startIndex", "q"),
+    ("endIndex", "q"),
+    ("volume", "q"),
+    ("volumeGross", "d"),
+    ("energy", "q"),
+    ("energyGross", "d"),
+    ("price", "d"),
+    ("conversionFactor", "d"),
+    ("temperature", "d"),
+)
+THRESHOLD_COLUMNS = (
+    ("date", "i"),
+    ("energy", "q"),
+)
+
+
+# Return the size of a column padded to 8 bytes, so every column is aligned in the file
+def _getPaddedSize(count,typeCode):
+    size = count * array.array(typeCode).itemsize
+    return size + (-size) % 8
+
+
+# Convert a value of a measure or a threshold to a number of a column
+def _toNumber(attribute,typeCode,value):
+    if attribute == "type":
+        return TYPE_LIST.index(value)
+    if attribute == "date":
+        return value.toordinal()
+    if attribute in ("periodStart", "periodEnd"):
+        return value.toordinal() * SECONDS_PER_DAY + value.hour * 3600 + value.minute * 60 + value.second
+    if value is None:
+        return NONE_INT if typeCode == "q" else float("nan")
+    return value
+
+
+# Convert a column of numbers back to the values of a measure or a threshold
+def _toValueList(attribute,numberList):
+    if attribute == "type":
+        return [TYPE_LIST[number] for number in numberList]
+    if attribute == "date":
+        return [datetime.datetime.fromordinal(number) for number in numberList]
+    if attribute in ("periodStart", "periodEnd"):
+        return [datetime.datetime.fromordinal(number // SECONDS_PER_DAY) + datetime.timedelta(seconds=number % SECONDS_PER_DAY)
+                for number in numberList]
+    return [None if number == NONE_INT or number != number else number for number in numberList]
+
+
+# Return the bytes of the columns of objects
+def _getColumnBytes(objectList,columnList):
+
+    chunkList = []
+    for attribute, typeCode in columnList:
+        column = array.array(typeCode, [_toNumber(attribute, typeCode, getattr(myObject, attribute)) for myObject in objectList])
+        chunkList.append(column.tobytes())
+        chunkList.append(b"\0" * ((-len(chunkList[-1])) % 8))
+    return chunkList
+
+
+# Write the snapshot of PCEs, with the data version of each of them
+def write(path,dataToken,versionList,pceList):
+
+    chunkList = []
+    pceCount = 0
+    for myPce in pceList:
+        pceJson = json.dumps([myPce.pceId, myPce.alias, _toText(myPce.activationDate), myPce.frequenceReleve,
+                              myPce.state, myPce.ownerName, myPce.postalCode]).encode('utf-8')
+        try:
+            columnChunks = _getColumnBytes(myPce.measureList, MEASURE_COLUMNS) + _getColumnBytes(myPce.thresholdList, THRESHOLD_COLUMNS)
+        except (TypeError, ValueError, OverflowError) as e:
+            # Values which do not fit the columns : the PCE is left out and loaded from the database
+            logging.debug("PCE %s is not written to the snapshot file : %s", myPce.pceId, e)
+            continue
+        chunkList.append(SECTION.pack(len(pceJson), versionList.get(myPce.pceId, 0), len(myPce.measureList), len(myPce.thresholdList)))
+        chunkList.append(pceJson + b"\0" * ((-len(pceJson)) % 8))
+        chunkList += columnChunks
+        pceCount += 1
+    payload = b"".join(chunkList)
+
+    # The file is replaced at once, a reader never sees a partial file
+    filePath = os.path.join(path, SNAPSHOT_NAME)
+    with open(filePath + ".tmp", "wb") as file:
+        file.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, dataToken.encode('ascii'), len(payload),
+                               zlib.crc32(payload), pceCount))
+        file.write(payload)
+    os.replace(filePath + ".tmp", filePath)
+    logging.debug("Snapshot file %s written : %s PCE(s), %s bytes", filePath, pceCount, HEADER.size + len(payload))
+
+
+# Return the PCEs of the snapshot whose data version is still the one of the database, by PCE id
+# An invalid file returns no PCE
+def read(path,dataToken,versionList):
+
+    filePath = os.path.join(path, SNAPSHOT_NAME)
+    if not os.path.exists(filePath) or os.path.getsize(filePath) < HEADER.size:
+        return {}
+
+    with open(filePath, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as myMap:
+        view = memoryview(myMap)
+        try:
+            magic, formatVersion, reserved, fileToken, payloadLength, crc, pceCount = HEADER.unpack_from(view, 0)
+            if magic != SNAPSHOT_MAGIC or formatVersion != SNAPSHOT_VERSION:
+                logging.warning("Snapshot file %s has an unknown format, it is ignored.", filePath)
+                return {}
+            if fileToken.decode('ascii') != dataToken:
+                logging.info("Snapshot file %s belongs to previous data of the database, it is ignored.", filePath)
+                return {}
+            if HEADER.size + payloadLength != len(view) or zlib.crc32(view[HEADER.size:]) != crc:
+                logging.warning("Snapshot file %s is corrupted, it is ignored.", filePath)
+                return {}
+            return _readSections(view, pceCount, versionList)
+        finally:
+            view.release()
+
+
+# Return the PCEs of the sections whose data version is the one of the database
+def _readSections(view,pceCount,versionList):
+
+    pceList = {}
+    offset = HEADER.size
+    for i in range(pceCount):
+        jsonLength, version, measureCount, thresholdCount = SECTION.unpack_from(view, offset)
+        offset += SECTION.size
+        pceRow = json.loads(bytes(view[offset:offset + jsonLength]))
+        offset += jsonLength + (-jsonLength) % 8
+
+        # Sections of the PCEs which changed are skipped
+        isValid = versionList.get(pceRow[0], 0) == version # PCEs unchanged since the upgrade have no version yet
+        columnList = []
+        for columns, count in ((MEASURE_COLUMNS, measureCount), (THRESHOLD_COLUMNS, thresholdCount)):
+            valueList = {}
+            for attribute, typeCode in columns:
+                size = _getPaddedSize(count, typeCode)
+                if isValid:
+                    itemSize = array.array(typeCode).itemsize
+                    valueList[attribute] = _toValueList(attribute, view[offset:offset + count * itemSize].cast(typeCode).tolist())
+                offset += size
+            columnList.append(valueList)
+        if not isValid:
+            continue
+
+        # Rebuild the PCE as loaded from the database
+        myPce = database.Pce(pceRow)
+        measureColumns, thresholdColumns = columnList
+        for row in zip(*(measureColumns[attribute] for attribute, typeCode in MEASURE_COLUMNS)):
+            myPce.measureList.append(database.Measure(myPce, (myPce.pceId,) + row))
+        for row in zip(*(thresholdColumns[attribute] for attribute, typeCode in THRESHOLD_COLUMNS)):
+            myPce.thresholdList.append(database.Threshold(myPce, (myPce.pceId,) + row))
+        pceList[myPce.pceId] = myPce
+    return pceList
+
+
+# Return the text of a date time as stored in the database
+def _toText(value):
+    if value is None:
+        return None
+    return value.strftime(database.DATABASE_DATETIME_FORMAT)
+
+
+# Class FileSnapshot : snapshot of the database completed by the binary snapshot file
+class FileSnapshot(database.Snapshot):
+
+    def __init__(self,path):
+
+        super().__init__(path)
+        self.dataToken = None
+        self.versionList = None # data version of each PCE when the snapshot was loaded
+        self.mappedList = set() # PCEs rebuilt from the file
+
+
+    # Load the unchanged PCEs from the file, the others from the database
+    def _load(self,myDb):
+
+        self.dataToken = myDb.getConfig(database.DATA_TOKEN_KEY)
+        self.versionList = myDb.getDataVersions()
+        filePceList = {}
+        if sys.byteorder == "little" and self.dataToken:
+            try:
+                filePceList = read(self.path, self.dataToken, self.versionList)
+            except Exception as e:
+                logging.warning("Unable to read snapshot file : %s", e)
+
+        pceList = []
+        for myPce in myDb.iterPce(False):
+            if myPce.pceId in filePceList:
+                pceList.append(filePceList[myPce.pceId])
+                self.mappedList.add(myPce.pceId)
+            else:
+                myDb._loadMeasures(myPce)
+                myDb._loadThresholds(myPce)
+                pceList.append(myPce)
+        logging.info("Snapshot : %s PCE(s) read from snapshot file, %s PCE(s) loaded from database.",
+                     len(self.mappedList), len(pceList) - len(self.mappedList))
+        return pceList
+
+
+    # Write the snapshot file when PCEs have been loaded from the database
+    def save(self):
+
+        if self.pceList is None or not self.dataToken or sys.byteorder != "little":
+            return
+        if len(self.mappedList) == len(self.pceList):
+            logging.debug("Snapshot file is up to date.")
+            return
+        write(self.path, self.dataToken, self.versionList, self.pceList)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+### Define the stages of a run. ###
+# Once the data is stored into the database, each sink (Mqtt, Home Assistant LTS, Influxdb)
+# is run as an independent stage. Stages run concurrently in their own thread, an error or
+# a timeout in a stage does not stop the others.
+# A stage which times out is asked to stop : it ends at its next check of isStopped(), and the run
+# waits for it, so it never uses the connections of the run once they are closed.
+
+import logging
+import threading
+import time
+
+# Status of a stage
+STATUS_PENDING = "pending"
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+
+# Stage run by the current thread
+_current = threading.local()
+
+
+# Exception raised in a stage asked to stop
+class StageStopped(Exception):
+    pass
+
+
+# Return True when the stage of the current thread has been asked to stop
+# Stages check it between two PCEs, and end once their work in progress is saved
+def isStopped():
+
+    myStage = getattr(_current, "stage", None)
+    return myStage is not None and myStage.stopEvent.is_set()
+
+
+# Raise StageStopped when the stage of the current thread has been asked to stop
+def checkStop():
+
+    if isStopped():
+        raise StageStopped(f"stage {_current.stage.name} stopped after its timeout")
+
+
+# Class Stage
+class Stage:
+
+    # Constructor
+    def __init__(self,name,function,*args):
+
+        self.name = name
+        self.function = function
+        self.args = args
+        self.status = STATUS_PENDING
+        self.duration = None
+        self.stopEvent = threading.Event() # set when the stage must stop
+
+
+    # Run the stage, errors are isolated from the other stages
+    def run(self,metrics=None):
+
+        logging.debug("Stage %s started.",self.name)
+        if metrics is not None:
+            metrics.startStage(self.name)
+        startTime = time.monotonic()
+        _current.stage = self
+        try:
+            self.function(*self.args)
+            status = STATUS_OK
+        except StageStopped as e:
+            status = STATUS_TIMEOUT
+            logging.warning("Stage %s stopped : %s",self.name,e)
+        except Exception as e:
+            status = STATUS_ERROR
+            logging.error("Stage %s failed : %s",self.name,e)
+            logging.debug("Full traceback:", exc_info=True)
+        finally:
+            _current.stage = None
+        self.duration = time.monotonic() - startTime
+        if metrics is not None:
+            metrics.endStage(self.name,status)
+
+        # A stage stopped after its timeout keeps its status
+        if self.status == STATUS_PENDING:
+            self.status = status
+        logging.info("Stage %s ended with status %s in %.1f s.",self.name,status,self.duration)
+
+
+# Run the stages, concurrently when parallel is True
+# A stage still running after the timeout (in seconds) is asked to stop, and the run waits until it ends
+def runStages(stageList,parallel=True,timeout=None,metrics=None):
+
+    if not parallel or len(stageList) < 2:
+        for myStage in stageList:
+            myStage.run(metrics)
+        return stageList
+
+    threadList = []
+    for myStage in stageList:
+        myThread = threading.Thread(target=myStage.run, args=(metrics,), name=f"{threading.current_thread().name}/{myStage.name}", daemon=True)
+        myThread.start()
+        threadList.append((myStage,myThread))
+
+    # All stages start together, so they share the same deadline
+    deadline = None
+    if timeout:
+        deadline = time.monotonic() + timeout
+
+    for myStage, myThread in threadList:
+        if deadline is None:
+            myThread.join()
+        else:
+            myThread.join(max(0, deadline - time.monotonic()))
+        if myThread.is_alive():
+            myStage.status = STATUS_TIMEOUT
+            myStage.stopEvent.set()
+            logging.error("Stage %s did not end within %s seconds, it is asked to stop.",myStage.name,timeout)
+            if metrics is not None:
+                metrics.setStageStatus(myStage.name,STATUS_TIMEOUT)
+
+    # Stopped stages still use the Mqtt client, the database and the snapshot of the run until they end
+    for myStage, myThread in threadList:
+        if myThread.is_alive():
+            myThread.join()
+            logging.info("Stage %s stopped.",myStage.name)
+
+    return stageList
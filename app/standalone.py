@@ -7,6 +7,8 @@ TOPIC_PUBLISHED = "/published" # published
 TOPIC_HISTO = "/histo" # Histo
 TOPIC_STATUS = "/status" # status
 TOPIC_THRESOLD = "/thresold" # Thresold
+TOPIC_DIAGNOSTIC = "/diagnostic" # Summary of the last run
+TOPIC_ANOMALY = "/anomaly" # Anomaly detector
 
 
 class Standalone:
@@ -20,5 +22,6 @@ class Standalone:
     self.publishedTopic = prefix + TOPIC_PUBLISHED + '/'
     self.histoTopic = prefix + TOPIC_HISTO + '/'
     self.statusTopic = prefix + TOPIC_STATUS + '/'
-    self.thresoldTopic = prefix + TOPIC_THRESOLD + '/'
+    self.thresholdTopic = prefix + TOPIC_THRESOLD + '/'
+    self.anomalyTopic = prefix + TOPIC_ANOMALY + '/'
     
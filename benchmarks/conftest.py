@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+### Offline stand-ins and datasets of the benchmark suite. ###
+# GRDF, the Mqtt broker, the Home Assistant websocket and Influxdb are replaced by
+# stand-ins working in memory, so the hot paths of gazpar2mqtt are timed without network.
+# Datasets are generated by dataset.py for 1, 10 and 100 PCEs over 3 years of daily measures,
+# other numbers of PCEs are set with BENCHMARK_PCE_COUNTS, e.g. BENCHMARK_PCE_COUNTS=1000.
+
+import os
+import sys
+import json
+import types
+import datetime
+
+import pytest
+
+# Constants
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+PCE_COUNTS = tuple(int(pceCount) for pceCount in os.environ.get("BENCHMARK_PCE_COUNTS", "1,10,100").split(","))
+
+sys.path.insert(0, APP_PATH)
+
+import param
+import metrics
+import mqtt
+import hass_ws
+
+from dataset import getDataset, getPceList, createDatabase
+
+
+# Results are saved as JSON in benchmarks/results, whatever the current directory
+def pytest_configure(config):
+    if config.getoption("benchmark_storage", None) == "file://./.benchmarks":
+        config.option.benchmark_storage = "file://" + RESULTS_PATH
+
+
+########################################################################################################################
+#### Stand-ins
+########################################################################################################################
+
+# Response of the GRDF stand-in
+class StandInResponse:
+
+    def __init__(self, url, data):
+        self.url = url
+        self.text = json.dumps(data)
+        self.status_code = 200
+        self.elapsed = datetime.timedelta(0)
+
+
+# Session replaying the GRDF api from a dataset
+class StandInGrdfSession:
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.hooks = {"response": []}
+
+    def get(self, url):
+        from urllib.parse import urlparse, parse_qs
+        path = urlparse(url).path
+        if path.endswith("/e-conso/pce"):
+            data = self.dataset["pce"]
+        elif path.endswith("/seuils"):
+            data = self.dataset["seuils"][path.split("/")[-2]]
+        else:
+            query = parse_qs(urlparse(url).query)
+            pceId = query["pceList[]"][0]
+            data = {pceId: {"releves": self.dataset[path.split("/")[-1]][pceId]}}
+        response = StandInResponse(url, data)
+        for hook in self.hooks["response"]:
+            hook(response)
+        return response
+
+
+# Paho client of the Mqtt broker stand-in, messages are only counted
+class StandInMqttClient:
+
+    def __init__(self, client_id=None, **kwargs):
+        self.publishCount = 0
+
+    def username_pw_set(self, username, password):
+        pass
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        return (0, 1)
+
+    def message_callback_add(self, topic, callback):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.publishCount += 1
+        return types.SimpleNamespace(rc=0, mid=self.publishCount)
+
+
+# Websocket of the Home Assistant stand-in, statistics are acknowledged without being kept
+class StandInWebSocket:
+
+    def __init__(self, sslopt=None):
+        self.connected = False
+        self.responseList = []
+
+    def connect(self, url, timeout=5):
+        self.connected = True
+        self.responseList.append({"type": "auth_required"})
+
+    def close(self):
+        self.connected = False
+
+    def send(self, text):
+        data = json.loads(text)
+        if data["type"] == "auth":
+            self.responseList.append({"type": "auth_ok"})
+        elif data["type"] == "recorder/list_statistic_ids":
+            self.responseList.append({"id": data["id"], "type": "result", "success": True, "result": []})
+        else:
+            self.responseList.append({"id": data["id"], "type": "result", "success": True, "result": {}})
+
+    def recv(self):
+        return json.dumps(self.responseList.pop(0))
+
+
+# Write api of the Influxdb stand-in, points are only counted
+class StandInWriteApi:
+
+    def __init__(self):
+        self.pointCount = 0
+
+    def write(self, bucket, org, record):
+        self.pointCount += len(record)
+
+    def close(self):
+        pass
+
+
+# Client of the Influxdb stand-in
+class StandInInfluxClient:
+
+    def __init__(self, url=None, token=None, org=None, enable_gzip=False):
+        pass
+
+    def write_api(self, write_options=None, **callbacks):
+        return StandInWriteApi()
+
+    def close(self):
+        pass
+
+
+########################################################################################################################
+#### Fixtures
+########################################################################################################################
+
+@pytest.fixture(params=PCE_COUNTS, ids=lambda pceCount: f"{pceCount}pce")
+def pceCount(request):
+    return request.param
+
+
+@pytest.fixture
+def dataset(pceCount):
+    return getDataset(pceCount)
+
+
+@pytest.fixture
+def pceList(pceCount):
+    return getPceList(pceCount)
+
+
+# Path of a database filled with the dataset, created once by number of PCEs
+@pytest.fixture
+def dbPath(pceCount, tmp_path_factory):
+    path = tmp_path_factory.getbasetemp() / f"db_{pceCount}"
+    if not path.exists():
+        createDatabase(str(path), getPceList(pceCount))
+    return str(path)
+
+
+# Parameters of a run reading the database, without any environment nor command line
+@pytest.fixture
+def myParams(dbPath, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["gazpar2mqtt"])
+    myParams = param.Params()
+    myParams.dbPath = dbPath
+    myParams.pricePath = dbPath
+    return myParams
+
+
+@pytest.fixture
+def myMetrics():
+    return metrics.Metrics(False)
+
+
+# Mqtt broker stand-in, the pause after each publication is not timed
+@pytest.fixture
+def myMqtt(monkeypatch):
+    monkeypatch.setattr(mqtt.mqtt, "Client", StandInMqttClient)
+    monkeypatch.setattr(mqtt, "time", types.SimpleNamespace(sleep=lambda seconds: None))
+    myMqtt = mqtt.Mqtt("benchmark", "", "", False, 1, True)
+    myMqtt.connect("localhost", 1883)
+    return myMqtt
+
+
+@pytest.fixture
+def standInHomeAssistant(monkeypatch):
+    monkeypatch.setattr(hass_ws.websocket, "WebSocket", StandInWebSocket)
+
+
+@pytest.fixture
+def standInInflux(monkeypatch):
+    import influxdb
+    import influxdb_client
+    monkeypatch.setattr(influxdb_client, "InfluxDBClient", StandInInfluxClient)
+    monkeypatch.setattr(influxdb, "WRITE_SLEEP", 0)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+### Synthetic GRDF dataset generator. ###
+# Generate the GRDF json (pce, informatives, publiees, seuils) of N PCEs over Y years, with
+# seasonal consumption driven by the temperature, a drifting conversion factor, missing days,
+# index resets (meter replacement) and published periods of irregular length.
+# The dataset feeds the GRDF stand-in of the benchmark suite, or is written to a directory
+# with a prefilled gazpar2mqtt.db, usable as DB_PATH, to size a deployment :
+#   python benchmarks/dataset.py --pce 1000 --years 3 --output /tmp/dataset
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import datetime
+import argparse
+import resource
+import functools
+
+# Constants
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+END_DATE = datetime.date(2026, 1, 1) # fixed, so the datasets are identical between runs
+YEARS = 3
+SEED = 2026
+GAS_DAY_HOUR = "T06:00:00+01:00" # a gas day starts at 6:00
+PUBLISHED_PERIOD_MIN = 28 # days of a published period
+PUBLISHED_PERIOD_MAX = 33
+MISSING_DAY_RATE = 0.01 # share of the days without reading, their volume is carried by the next reading
+INDEX_RESET_RATE = 0.0003 # daily probability of a meter replacement
+HDD_BASE = 18 # °C, base temperature of the heating
+CONVERSION_FACTOR = 11.2 # kWh/m3, mean conversion factor
+CONVERSION_DRIFT = 0.02 # kWh/m3, daily random walk of the conversion factor
+CONVERSION_MIN = 10.5
+CONVERSION_MAX = 11.9
+
+sys.path.insert(0, APP_PATH)
+
+import gazpar
+import database
+
+
+########################################################################################################################
+#### Generation
+########################################################################################################################
+
+# Return the id of a PCE
+def getPceId(pceNo):
+    return f"{pceNo + 1:014d}"
+
+
+# Return the GRDF description of a PCE
+def getPceJson(pceId):
+    return {"alias": f"Maison {pceId[-3:]}", "pce": pceId, "dateActivation": "2019-01-01T00:00:00",
+            "frequenceReleve": "1M", "etat": "Actif", "nomTitulaire": "Dupont", "codePostal": "75000"}
+
+
+# Return a GRDF measure
+def getReleve(startDate, endDate, startIndex, endIndex, conversionFactor, temperature):
+
+    if startIndex is None:
+        volume = energy = None
+    else:
+        volume = endIndex - startIndex
+        energy = round(volume * conversionFactor)
+    return {
+        "dateDebutReleve": startDate.isoformat() + GAS_DAY_HOUR,
+        "dateFinReleve": endDate.isoformat() + GAS_DAY_HOUR,
+        "journeeGaziere": startDate.isoformat() if (endDate - startDate).days == 1 else None,
+        "indexDebut": startIndex,
+        "indexFin": endIndex,
+        "volumeBrutConsomme": None if volume is None else float(volume),
+        "volumeConverti": volume,
+        "energieConsomme": energy,
+        "temperature": temperature,
+        "coeffConversion": None if volume is None else round(conversionFactor, 3),
+    }
+
+
+# Return the days of a PCE : date, start and end index of the meter, conversion factor, temperature
+# and whether the reading is missing. The index restarts from a low value after a meter replacement
+def getDays(pceNo, years=YEARS, endDate=END_DATE, seed=SEED):
+
+    rng = random.Random(seed * 100003 + pceNo)
+    startDate = endDate - datetime.timedelta(days=365 * years)
+    heating = rng.uniform(0.3, 1.2) # m3 by degree day, the size and insulation of the house
+    base = rng.uniform(1, 3) # m3 by day, hot water and cooking
+    index = rng.randint(1000, 20000)
+    conversionFactor = CONVERSION_FACTOR
+    dayList = []
+    myDate = startDate
+    while myDate < endDate:
+        # Temperature : sinusoid with the minimum mid-january, and the weather of the day
+        season = math.cos(2 * math.pi * (myDate.timetuple().tm_yday - 15) / 365)
+        temperature = round(12 - 9 * season + rng.gauss(0, 3), 1)
+        volume = max(1, round(base + heating * max(0, HDD_BASE - temperature) + rng.gauss(0, 0.5)))
+        conversionFactor = min(CONVERSION_MAX, max(CONVERSION_MIN, conversionFactor + rng.gauss(0, CONVERSION_DRIFT)))
+        if rng.random() < INDEX_RESET_RATE:
+            index = rng.randint(1, 50)
+        dayList.append((myDate, index, index + volume, conversionFactor, temperature, rng.random() < MISSING_DAY_RATE))
+        index += volume
+        myDate += datetime.timedelta(days=1)
+    return dayList
+
+
+# Return the daily measures of a PCE
+# The reading following missing days starts from the last known index and carries their volume
+def getInformatives(dayList):
+
+    releveList = []
+    lastIndex = None
+    previousIndex = None
+    for myDate, startIndex, endIndex, conversionFactor, temperature, isMissing in dayList:
+        if startIndex != previousIndex:
+            lastIndex = startIndex # meter replacement, the volume before it is lost
+        previousIndex = endIndex
+        if isMissing:
+            releveList.append(getReleve(myDate, myDate + datetime.timedelta(days=1), None, None, conversionFactor, temperature))
+        else:
+            releveList.append(getReleve(myDate, myDate + datetime.timedelta(days=1), lastIndex, endIndex, conversionFactor, temperature))
+            lastIndex = endIndex
+    return releveList
+
+
+# Return the published measures of a PCE : periods of irregular length, closed at each meter replacement
+# The period still running at the end date is not published yet
+def getPubliees(dayList, pceNo, seed=SEED):
+
+    rng = random.Random(seed * 100019 + pceNo)
+    releveList = []
+    periodStart = None # (date, index) of the start of the period
+    periodEnd = None
+    energy = 0
+    previousIndex = None
+
+    for myDate, startIndex, endIndex, conversionFactor, temperature, isMissing in dayList:
+        if periodStart and startIndex != previousIndex:
+            # Meter replacement : the period is closed with the last index of the old meter
+            releveList.append(_getPeriod(periodStart, myDate, previousIndex, energy))
+            periodStart = None
+        if periodStart is None:
+            periodStart = (myDate, startIndex)
+            periodEnd = myDate + datetime.timedelta(days=rng.randint(PUBLISHED_PERIOD_MIN, PUBLISHED_PERIOD_MAX))
+            energy = 0
+        energy += (endIndex - startIndex) * conversionFactor
+        previousIndex = endIndex
+        if myDate + datetime.timedelta(days=1) >= periodEnd:
+            releveList.append(_getPeriod(periodStart, myDate + datetime.timedelta(days=1), endIndex, energy))
+            periodStart = None
+    return releveList
+
+
+# Return a published measure, its conversion factor is the mean of the period weighted by the volume
+def _getPeriod(periodStart, endDate, endIndex, energy):
+
+    startDate, startIndex = periodStart
+    volume = endIndex - startIndex
+    conversionFactor = energy / volume if volume else CONVERSION_FACTOR
+    return getReleve(startDate, endDate, startIndex, endIndex, conversionFactor, None)
+
+
+# Return the GRDF thresholds of a PCE, by month of the last year and in line with its consumption
+def getSeuils(dayList, endDate=END_DATE):
+
+    energyList = [0] * 12
+    for myDate, startIndex, endIndex, conversionFactor, temperature, isMissing in dayList:
+        if myDate.year == endDate.year - 1:
+            energyList[myDate.month - 1] += (endIndex - startIndex) * conversionFactor
+    return {"seuils": [{"valeur": round(energy * 1.1) or 100, "annee": endDate.year - 1, "mois": month + 1}
+                       for month, energy in enumerate(energyList)]}
+
+
+# Return the GRDF json of a PCE : pce, informatives, publiees and seuils
+def getPceData(pceNo, years=YEARS, endDate=END_DATE, seed=SEED):
+
+    pceId = getPceId(pceNo)
+    dayList = getDays(pceNo, years, endDate, seed)
+    return {"pce": getPceJson(pceId), "informatives": getInformatives(dayList),
+            "publiees": getPubliees(dayList, pceNo, seed), "seuils": getSeuils(dayList, endDate)}
+
+
+# Return the GRDF json of the PCEs, indexed by PCE id, as replayed by the GRDF stand-in
+@functools.lru_cache(maxsize=None)
+def getDataset(pceCount, years=YEARS, endDate=END_DATE, seed=SEED):
+
+    dataset = {"pce": [], "informatives": {}, "publiees": {}, "seuils": {}}
+    for pceNo in range(pceCount):
+        pceData = getPceData(pceNo, years, endDate, seed)
+        pceId = pceData["pce"]["pce"]
+        dataset["pce"].append(pceData["pce"])
+        for kind in ("informatives", "publiees", "seuils"):
+            dataset[kind][pceId] = pceData[kind]
+    return dataset
+
+
+# Return a PCE with its measures and thresholds
+def getPce(pceData):
+
+    myPce = gazpar.Pce(pceData["pce"])
+    for measure in pceData["informatives"]:
+        myPce.addMeasure(gazpar.Measure(myPce, measure, gazpar.TYPE_I))
+    for measure in pceData["publiees"]:
+        myPce.addMeasure(gazpar.Measure(myPce, measure, gazpar.TYPE_P))
+    for threshold in pceData["seuils"]["seuils"]:
+        myPce.addThreshold(gazpar.Threshold(myPce, threshold))
+    return myPce
+
+
+# Return the PCEs of a dataset with their measures and thresholds
+def getPceList(pceCount, years=YEARS, endDate=END_DATE, seed=SEED):
+
+    dataset = getDataset(pceCount, years, endDate, seed)
+    return [getPce({"pce": pceJson, "informatives": dataset["informatives"][pceJson["pce"]],
+                    "publiees": dataset["publiees"][pceJson["pce"]], "seuils": dataset["seuils"][pceJson["pce"]]})
+            for pceJson in dataset["pce"]]
+
+
+# Create a database in a directory filled with the PCEs, given as a list or one by one by a generator
+def createDatabase(path, pceList):
+
+    myDb = database.Database(path, True)
+    myDb.connect("benchmark", "benchmark", "benchmark")
+    for myPce in pceList:
+        myPce.store(myDb)
+        for myMeasure in myPce.measureList:
+            myMeasure.store(myDb)
+        for myThreshold in myPce.thresholdList:
+            myThreshold.store(myDb)
+        myDb.commit()
+    myDb.close()
+
+
+########################################################################################################################
+#### Files
+########################################################################################################################
+
+# Write the dataset of a PCE as GRDF responses : informatives/<pce>.json, publiees/<pce>.json and seuils/<pce>.json
+def writePceData(path, pceData):
+
+    pceId = pceData["pce"]["pce"]
+    for kind in ("informatives", "publiees"):
+        with open(os.path.join(path, kind, pceId + ".json"), "w") as file:
+            json.dump({pceId: {"releves": pceData[kind]}}, file)
+    with open(os.path.join(path, "seuils", pceId + ".json"), "w") as file:
+        json.dump(pceData["seuils"], file)
+
+
+# Load a dataset written by the generator, as replayed by the GRDF stand-in
+def loadDataset(path):
+
+    with open(os.path.join(path, "pce.json")) as file:
+        dataset = {"pce": json.load(file), "informatives": {}, "publiees": {}, "seuils": {}}
+    for pceJson in dataset["pce"]:
+        pceId = pceJson["pce"]
+        for kind in ("informatives", "publiees"):
+            with open(os.path.join(path, kind, pceId + ".json")) as file:
+                dataset[kind][pceId] = json.load(file)[pceId]["releves"]
+        with open(os.path.join(path, "seuils", pceId + ".json")) as file:
+            dataset["seuils"][pceId] = json.load(file)
+    return dataset
+
+
+# Generate the dataset one PCE at a time, so the memory does not grow with the number of PCEs
+def generate(path, pceCount, years, endDate, seed, withDb):
+
+    for kind in ("informatives", "publiees", "seuils"):
+        os.makedirs(os.path.join(path, kind), exist_ok=True)
+    dbFile = os.path.join(path, database.DATABASE_NAME)
+    if withDb and os.path.exists(dbFile):
+        os.remove(dbFile)
+
+    pceJsonList = []
+
+    def iterPce():
+        for pceNo in range(pceCount):
+            pceData = getPceData(pceNo, years, endDate, seed)
+            pceJsonList.append(pceData["pce"])
+            writePceData(path, pceData)
+            if withDb:
+                yield getPce(pceData)
+            if (pceNo + 1) % 100 == 0:
+                logging.info("%s PCE generated", pceNo + 1)
+
+    if withDb:
+        createDatabase(path, iterPce())
+    else:
+        for myPce in iterPce():
+            pass
+    with open(os.path.join(path, "pce.json"), "w") as file:
+        json.dump(pceJsonList, file)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic GRDF dataset and a prefilled database.")
+    parser.add_argument("--pce", type=int, default=100, help="number of PCEs")
+    parser.add_argument("--years", type=int, default=YEARS, help="years of measures")
+    parser.add_argument("--end", default=END_DATE.isoformat(), help="end date of the measures (YYYY-MM-DD)")
+    parser.add_argument("--seed", type=int, default=SEED, help="seed of the random generator")
+    parser.add_argument("--output", required=True, help="directory of the dataset")
+    parser.add_argument("--no-db", action="store_true", help="do not create the database")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+    startTime = time.time()
+    generate(args.output, args.pce, args.years, datetime.date.fromisoformat(args.end), args.seed, not args.no_db)
+    logging.info("%s PCE x %s years generated in %s in %.1f s, peak memory %.0f MB", args.pce, args.years, args.output,
+                 time.time() - startTime, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
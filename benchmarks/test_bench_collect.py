@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+### Benchmarks of the collection : GRDF api, measures and storage. ###
+
+import datetime
+
+import gazpar
+import database
+
+from conftest import StandInGrdfSession
+from dataset import END_DATE, YEARS, createDatabase
+
+# Constants
+ROUNDS = 3 # rounds of the benchmarks needing a fresh database
+
+
+# Construction of the measures from the GRDF json
+def test_measure_construction(benchmark, dataset):
+
+    myPceList = [gazpar.Pce(pceJson) for pceJson in dataset["pce"]]
+
+    def construct():
+        return [gazpar.Measure(myPce, measure, gazpar.TYPE_I)
+                for myPce in myPceList for measure in dataset["informatives"][myPce.pceId]]
+
+    measureList = benchmark(construct)
+    assert len(measureList) == sum(len(releveList) for releveList in dataset["informatives"].values())
+
+
+# Collection of the PCEs, measures and thresholds through the GRDF api stand-in
+def test_grdf_collection(benchmark, dataset):
+
+    startDate = END_DATE - datetime.timedelta(days=365 * YEARS)
+
+    def collect():
+        myGrdf = gazpar.Grdf()
+        myGrdf.session = StandInGrdfSession(dataset)
+        myGrdf.session.hooks["response"].append(myGrdf._onResponse)
+        myGrdf.getPceList()
+        for myPce in myGrdf.pceList:
+            myGrdf.getPceMeasures(myPce, startDate, END_DATE, gazpar.TYPE_I)
+            myGrdf.getPceMeasures(myPce, startDate, END_DATE, gazpar.TYPE_P)
+            myGrdf.getPceThreshold(myPce)
+        return myGrdf
+
+    myGrdf = benchmark(collect)
+    assert myGrdf.countPce() == len(dataset["pce"])
+
+
+# Storage of a single measure already stored, the most frequent case of a daily run
+def test_measure_store(benchmark, pceList, dbPath):
+
+    myDb = database.Database(dbPath)
+    myDb.open()
+    myMeasure = pceList[0].getLastMeasureOk(gazpar.TYPE_I)
+    changed = benchmark(myMeasure.store, myDb)
+    myDb.close()
+    assert not changed
+
+
+# Storage of all the measures into an empty database
+def test_bulk_store(benchmark, pceList, tmp_path):
+
+    roundNo = iter(range(ROUNDS))
+
+    def setup():
+        return (str(tmp_path / f"db_{next(roundNo)}"), pceList), {}
+
+    benchmark.pedantic(createDatabase, setup=setup, rounds=ROUNDS)
+
+
+# Storage of all the measures into a database already holding them : nothing changes
+def test_bulk_store_unchanged(benchmark, pceList, dbPath):
+
+    myDb = database.Database(dbPath)
+    myDb.open()
+
+    def store():
+        changeCount = 0
+        for myPce in pceList:
+            for myMeasure in myPce.measureList:
+                changeCount += myMeasure.store(myDb)
+        myDb.commit()
+        return changeCount
+
+    changeCount = benchmark.pedantic(store, rounds=ROUNDS)
+    myDb.close()
+    assert changeCount == 0
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+### Benchmarks of the processing of the stored data : calculation, prices and loading. ###
+
+import gazpar
+import database
+import price
+import changeset
+import snapshot
+import gazpar2mqtt
+
+# Constants
+ROUNDS = 3 # rounds of the slowest benchmarks
+
+
+# Calculation of the calendar and rolling measures of the PCEs
+def test_calculate_measures(benchmark, pceList, dbPath):
+
+    myDb = database.Database(dbPath)
+    myDb.open()
+
+    def calculate():
+        for myPce in pceList:
+            myPce.calculateMeasures(myDb, 80, gazpar.TYPE_I)
+
+    benchmark.pedantic(calculate, rounds=ROUNDS)
+    myDb.close()
+    assert all(myPce.isCalculated for myPce in pceList)
+
+
+# Update of the price of all the measures, with the default prices or a prices file
+def test_price_update(benchmark, pceList, myParams, tmp_path):
+
+    # One price range by year for each PCE
+    with open(tmp_path / price.FILE_NAME, "w") as priceFile:
+        priceFile.write("pce;start;end;kwh;fix\n")
+        for myPce in pceList:
+            for year in range(2022, 2027):
+                priceFile.write(f"{myPce.pceId};{year}-01-01;{year}-12-31;0.1{year % 10};0.9\n")
+
+    myDb = database.Database(myParams.dbPath)
+    myDb.open()
+    myPrices = price.Prices(str(tmp_path), myParams.priceKwhDefault, myParams.priceFixDefault)
+    myDefaultPrices = price.Prices(str(tmp_path / "none"), myParams.priceKwhDefault, myParams.priceFixDefault)
+
+    def update():
+        gazpar2mqtt._writePrices(myParams, myDb, pceList, myPrices, changeset.ChangeSet(True))
+        gazpar2mqtt._writePrices(myParams, myDb, pceList, myDefaultPrices, changeset.ChangeSet(True))
+
+    benchmark.pedantic(update, rounds=ROUNDS)
+    myDb.close()
+
+
+# Loading of the whole database in memory
+def test_database_load(benchmark, pceCount, dbPath):
+
+    def load():
+        myDb = database.Database(dbPath)
+        myDb.open()
+        myDb.load()
+        myDb.close()
+        return myDb
+
+    myDb = benchmark.pedantic(load, rounds=ROUNDS)
+    assert len(myDb.pceList) == pceCount
+
+
+# Loading of the whole database from the binary snapshot file, on a warm start
+def test_snapshot_file_load(benchmark, pceCount, dbPath):
+
+    mySnapshot = snapshot.FileSnapshot(dbPath)
+    mySnapshot.getPceList()
+    mySnapshot.save()
+
+    def load():
+        mySnapshot = snapshot.FileSnapshot(dbPath)
+        mySnapshot.getPceList()
+        return mySnapshot
+
+    mySnapshot = benchmark.pedantic(load, rounds=ROUNDS)
+    assert len(mySnapshot.mappedList) == pceCount
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+### Benchmarks of the sinks : Mqtt, Home Assistant discovery and LTS, Influxdb. ###
+
+import types
+
+import pytest
+
+import gazpar
+import database
+import price
+import changeset
+import gazpar2mqtt
+
+# Constants
+ROUNDS = 3 # rounds of the slowest benchmarks
+RUN_DATE = "01/01/2026 - 06:00:00" # date of the run published in the status topics
+
+
+# GRDF connection holding the calculated PCEs, as after the collection step of a run
+@pytest.fixture
+def myGrdf(pceList, dbPath):
+
+    myDb = database.Database(dbPath)
+    myDb.open()
+    for myPce in pceList:
+        myPce.calculateMeasures(myDb, 80, gazpar.TYPE_I)
+    myDb.close()
+    return types.SimpleNamespace(isConnected=True, pceList=pceList)
+
+
+# Measures of the PCEs as loaded from the database
+@pytest.fixture
+def loadedPceList(dbPath):
+
+    myDb = database.Database(dbPath)
+    myDb.open()
+    myDb.load()
+    myDb.close()
+    return myDb.pceList
+
+
+# Publication of all the values to the Mqtt broker stand-in, in standalone or Home Assistant discovery mode
+@pytest.mark.parametrize("mode", ["standalone", "discovery"])
+def test_mqtt_publication(benchmark, mode, myParams, myMqtt, myGrdf, myMetrics):
+
+    myParams.standalone = mode == "standalone"
+    myParams.hassDiscovery = mode == "discovery"
+    myParams.mqttRetain = False # every value and config is published on each run
+
+    benchmark.pedantic(gazpar2mqtt._runMqttStage, args=(myParams, myMqtt, myGrdf, RUN_DATE, changeset.ChangeSet(True), myMetrics),
+                       rounds=ROUNDS)
+    assert myMqtt.publishCount > 0
+
+
+# Construction of the Home Assistant LTS statistics arrays
+def test_lts_arrays(benchmark, loadedPceList):
+
+    measureListList = [[myMeasure for myMeasure in myPce.measureList if myMeasure.type == measureType]
+                       for myPce in loadedPceList for measureType in (gazpar.TYPE_I, gazpar.TYPE_P)]
+
+    def build():
+        return [gazpar2mqtt._getLtsStats(measureList, attribute, 0)
+                for measureList in measureListList for attribute in ("volumeGross", "energyGross", "price")]
+
+    statsList = benchmark(build)
+    assert sum(len(stats) for stats in statsList) == 3 * sum(len(measureList) for measureList in measureListList)
+
+
+# Import of all the statistics to the Home Assistant websocket stand-in, the snapshot is loaded in each round
+def test_lts_import(benchmark, myParams, myGrdf, myMetrics, standInHomeAssistant):
+
+    myParams.hassHost = "http://localhost:8123"
+
+    def setup():
+        return (myParams, myGrdf, changeset.ChangeSet(True), database.Snapshot(myParams.dbPath), myMetrics), {}
+
+    benchmark.pedantic(gazpar2mqtt._runLtsStage, setup=setup, rounds=ROUNDS)
+
+
+# Construction of the Influxdb points of the measures
+def test_influx_points(benchmark, loadedPceList, myParams, standInInflux):
+
+    import influxdb
+    myInflux = influxdb.InfluxDb('v2')
+    myPrices = price.Prices(myParams.pricePath, myParams.priceKwhDefault, myParams.priceFixDefault)
+    measureList = [myMeasure for myPce in loadedPceList for myMeasure in myPce.measureList if myMeasure.type == gazpar.TYPE_I]
+
+    pointList = benchmark(lambda: [myInflux.setMeasurePoint(myMeasure, myPrices) for myMeasure in measureList])
+    assert len(pointList) == len(measureList)
+
+
+# Export of all the points to the Influxdb stand-in, the watermarks and the snapshot are reset before each round
+def test_influx_export(benchmark, myParams, myGrdf, myMetrics, standInInflux):
+
+    myParams.influxHost = "localhost"
+    myPrices = price.Prices(myParams.pricePath, myParams.priceKwhDefault, myParams.priceFixDefault)
+
+    def setup():
+        myDb = database.Database(myParams.dbPath)
+        myDb.open()
+        myDb.cur.execute("DELETE FROM config WHERE key LIKE ?", [database.INFLUX_WATERMARK_KEY + "%"])
+        myDb.commit()
+        myDb.close()
+        return (myParams, myGrdf, myPrices, database.Snapshot(myParams.dbPath), myMetrics), {}
+
+    benchmark.pedantic(gazpar2mqtt._runInfluxStage, setup=setup, rounds=ROUNDS)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+### Check the startup cost of gazpar2mqtt. ###
+# The program is imported in a fresh interpreter with -X importtime : the libraries of the
+# optional sinks must not be loaded before they are needed. Its cumulative import time depends
+# on the machine, it is only checked against a budget given with IMPORT_BUDGET (seconds).
+# Run with : IMPORT_BUDGET=0.35 python -m pytest benchmarks/test_importtime.py, or directly to display the slowest imports.
+
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+# Constants
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+IMPORT_BUDGET = float(os.environ["IMPORT_BUDGET"]) if "IMPORT_BUDGET" in os.environ else None # seconds, cumulative import time of gazpar2mqtt
+IMPORT_TRIES = 3 # the fastest try is kept, to limit the noise of the machine
+LAZY_MODULES = ("influxdb_client", "websocket", "schedule", "http.server", "cProfile", "pyarrow") # loaded on demand
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+# Return the cumulative import time in seconds of each module imported with a module
+def getImportTimes(module):
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=APP_PATH, capture_output=True, text=True, check=True)
+    importTimes = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            importTimes[match.group(4)] = int(match.group(2)) / 1000000
+    return importTimes
+
+
+# Return the modules loaded by the import of a module
+def getLoadedModules(module):
+
+    result = subprocess.run([sys.executable, "-c", f"import sys, {module}; print('\\n'.join(sys.modules))"],
+                            cwd=APP_PATH, capture_output=True, text=True, check=True)
+    return set(result.stdout.split())
+
+
+@pytest.mark.skipif(IMPORT_BUDGET is None, reason="no IMPORT_BUDGET given")
+def test_import_time_budget():
+
+    importTime = min(getImportTimes("gazpar2mqtt")["gazpar2mqtt"] for i in range(IMPORT_TRIES))
+    assert importTime <= IMPORT_BUDGET, f"gazpar2mqtt imported in {importTime:.3f} s, budget is {IMPORT_BUDGET} s"
+
+
+def test_sinks_loaded_on_demand():
+
+    loadedModules = getLoadedModules("gazpar2mqtt")
+    assert not [module for module in LAZY_MODULES if module in loadedModules]
+
+
+if __name__ == "__main__":
+
+    importTimes = getImportTimes("gazpar2mqtt")
+    print(f"gazpar2mqtt imported in {importTimes['gazpar2mqtt']:.3f} s" + (f" (budget {IMPORT_BUDGET} s)" if IMPORT_BUDGET else ""))
+    for module, seconds in sorted(importTimes.items(), key=lambda item: item[1], reverse=True)[1:16]:
+        print(f"{seconds:8.3f} s  {module}")
@@ -19,6 +19,17 @@ cp /app_temp/mqtt.py "$APP/mqtt.py"
 cp /app_temp/price.py "$APP/price.py"
 cp /app_temp/standalone.py "$APP/standalone.py"
 cp /app_temp/hass_ws.py "$APP/hass_ws.py"
+cp /app_temp/outbox.py "$APP/outbox.py"
+cp /app_temp/stage.py "$APP/stage.py"
+cp /app_temp/metrics.py "$APP/metrics.py"
+cp /app_temp/exporter.py "$APP/exporter.py"
+cp /app_temp/scheduler.py "$APP/scheduler.py"
+cp /app_temp/changeset.py "$APP/changeset.py"
+cp /app_temp/accounts.py "$APP/accounts.py"
+cp /app_temp/shard.py "$APP/shard.py"
+cp /app_temp/snapshot.py "$APP/snapshot.py"
+cp /app_temp/export.py "$APP/export.py"
+cp /app_temp/anomaly.py "$APP/anomaly.py"
 
 if [ ! -f "$APP/param.py" ]; then
     echo "param.py non existing, copying default to /app..."